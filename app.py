@@ -1,27 +1,73 @@
 import ngrok
 import os
+import json
 import redis
 import asyncio
 import logging
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
+from pydantic import ValidationError
 
 from wpp.api.wpp_message import WppMessage
 from wpp.api.wpp_webhook import UserWppWebhook
 from wpp.buffer import MessageBuffer
 from wpp.memory import RedisManager
+from wpp.workers import start_media_pool, shutdown_media_pool
+from wpp.outbound import OutboundQueue, OutboundSender, DeliveryReceipts
+from wpp.metrics import Metrics
+from wpp.routing import ConversationRouter
+from wpp.admission import Admission, AdmissionController
+from wpp.logging_config import configure_logging, stop_logging
+from wpp.schemas.wpp_webhook import (
+    WppPayload,
+    PAYLOAD_TYPE_FIELDS,
+    MessageStatusCallback,
+    DeliveryCallback,
+    callback_kind,
+    parse_callback,
+)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Records are written by a background thread, never on the request path
+configure_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Fields that make up what a message says, compared by loop detection
+CONTENT_FIELDS = {"text", *PAYLOAD_TYPE_FIELDS}
 
 redis_client = redis.Redis.from_url(
     os.getenv("REDIS_URL", "redis://localhost:6379"), decode_responses=True
 )
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # CPU-bound media work (PDF rendering, JPEG encoding) runs in this pool
+    start_media_pool(redis_client)
+
+    # Outbound messages are queued in Redis and delivered by these workers
+    sender = OutboundSender(
+        redis_client,
+        WppMessage(
+            os.getenv("WPP_INSTANCE_ID", ""),
+            os.getenv("WPP_INSTANCE_TOKEN", ""),
+            os.getenv("WPP_CLIENT_TOKEN", ""),
+            redis=redis_client,
+        ),
+    )
+    sender.start()
+
+    yield
+
+    sender.stop()
+    shutdown_media_pool()
+    stop_logging()
+
+
+app = FastAPI(lifespan=lifespan)
+
 # Global message buffer instance
 message_buffer = None
 
@@ -49,6 +95,18 @@ def get_message_buffer():
     return message_buffer
 
 
+def handle_callback(callback) -> None:
+    """Record a non-message callback (receipt, presence, instance event)."""
+    kind = callback_kind(callback)
+    Metrics(redis_client).incr(f"webhook.callback.{kind}")
+
+    if isinstance(callback, MessageStatusCallback):
+        DeliveryReceipts(redis_client).record(callback.status, callback.ids, callback.momment)
+    elif isinstance(callback, DeliveryCallback) and not callback.error:
+        ids = [message_id for message_id in (callback.messageId, callback.zaapId) if message_id]
+        DeliveryReceipts(redis_client).record("delivered", ids[:1], callback.momment)
+
+
 @app.post("/wpp_webhook")
 async def recieve_wpp_message(
     request: Request,
@@ -66,30 +124,133 @@ async def recieve_wpp_message(
     if token != wpp_token:
         return JSONResponse("Permission Denied", status_code=403)
     
-    data = await request.json()
-    logger.info(f"Received webhook data: {data}")
+    # Validated straight from the body bytes, without an intermediate dict
+    raw = await request.body()
+
+    try:
+        payload = parse_callback(raw)
+    except ValidationError as e:
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            body = None
+
+        kind = callback_kind(body)
+        Metrics(redis_client).incr(f"webhook.invalid.{kind}")
+
+        if kind == "message":
+            # A user or bot message we could not read: worth knowing which one and why
+            locations = sorted({".".join(str(part) for part in error["loc"]) for error in e.errors()})
+            logger.warning(
+                "Ignoring invalid %s callback %s: %s validation errors at %s",
+                body.get('type'), body.get('messageId'), e.error_count(), ', '.join(locations),
+            )
+        else:
+            logger.warning("Ignoring malformed webhook event: %s validation errors", e.error_count())
+        return JSONResponse("Evento ignorado", status_code=200)
+
+    # Receipts, presence and instance events never reach the message path
+    if not isinstance(payload, WppPayload):
+        try:
+            handle_callback(payload)
+        except Exception as e:
+            logger.warning("Error recording %s callback: %s", payload.type, e)
+        return JSONResponse("Evento registrado", status_code=200)
+
+    # Formatted (and sampled) lazily: the payload is only rendered if this record is written
+    logger.info("Received webhook data: %s", raw, extra={"event": "webhook.received"})
 
     # Handle revoked messages
-    if data.get('notification') == "REVOKE":
+    if payload.notification == "REVOKE":
         return JSONResponse("Mensagem processada com sucesso!", status_code=200)
     
     # Check for duplicate messages
     redis_manager = RedisManager(redis_client, "wpp_webhook")
-    message_id = data.get('messageId')
+    message_id = payload.messageId
     
     if message_id and redis_manager.redis.exists(message_id):
         return JSONResponse("Message already processed", status_code=200)
 
     # Skip group messages
-    if data.get("isGroup"):
+    if payload.isGroup:
         return JSONResponse("Group messages are not supported", status_code=400)
     
     # Extract phone number
-    phone = data.get("phone")
+    phone = payload.phone
     
     if not phone:
         return JSONResponse("Phone number required", status_code=400)
 
+    # Bot messages are buffered and rate limited per conversation, not under the shared bot phone
+    router = ConversationRouter(redis_client)
+    is_bot = router.is_bot(phone)
+
+    if is_bot:
+        conversation = router.resolve(payload.instanceId, phone)
+        conversation_id = conversation["id"] if conversation else None
+        buffer_id = router.session_key(conversation_id) if conversation_id else phone
+        content = payload.model_dump_json(include=CONTENT_FIELDS, exclude_none=True)
+    else:
+        conversation = None
+        conversation_id = router.conversation_id(phone, payload.instanceId)
+        buffer_id = phone
+        content = ""
+
+    admission = AdmissionController(redis_client)
+    decision = admission.admit(buffer_id, conversation_id, is_bot=is_bot, content=content)
+
+    if decision.action == Admission.REJECT:
+        # Z-API does not retry rejected messages: the message joins the turn
+        # that is about to run, or the user is told to send it again
+        if get_message_buffer().coalesce(phone, payload.model_dump(exclude_unset=True), buffer_id=buffer_id):
+            if message_id:
+                redis_manager.redis.set(message_id, "1", ex=300)
+            return JSONResponse("Mensagem adicionada ao buffer", status_code=200)
+
+        logger.warning("Message from %s not admitted (%s)", phone, decision.reason)
+
+        if admission.should_notify(buffer_id, decision.retry_after):
+            OutboundQueue(redis_client).enqueue(
+                phone,
+                "send_message",
+                {"message": "Recebemos muitas mensagens de uma vez. Aguarde alguns instantes e envie novamente, por favor."},
+                key=f"{message_id}:admission",
+            )
+
+        return JSONResponse(
+            "Muitas mensagens, tente novamente em instantes",
+            status_code=429,
+            headers={"Retry-After": decision.retry_after_header},
+        )
+    if decision.action == Admission.COALESCE:
+        # Joins the turn the buffer is about to run; with no open buffer it is
+        # buffered as usual below, never dropped
+        if get_message_buffer().coalesce(phone, payload.model_dump(exclude_unset=True), buffer_id=buffer_id):
+            if message_id:
+                redis_manager.redis.set(message_id, "1", ex=300)
+            return JSONResponse("Mensagem adicionada ao buffer", status_code=200)
+
+        logger.info("Bot message for %s over its rate with no open buffer, buffering it", buffer_id)
+
+    if decision.action == Admission.DROP:
+        logger.info("Message from %s dropped (%s)", phone, decision.reason)
+
+        # A looping negotiation is ended: its user is told and the channel goes to the next in line
+        if decision.reason == "loop" and conversation:
+            try:
+                outbound = OutboundQueue(redis_client)
+                outbound.enqueue(
+                    conversation["user_phone"],
+                    "send_message",
+                    {"message": "O atendimento da Porto Seguro ficou repetindo as mesmas respostas e foi interrompido. Envie uma nova mensagem para tentarmos novamente."},
+                    key=f"{message_id}:loop",
+                )
+                router.hand_over(conversation_id, outbound, key=message_id)
+            except Exception as e:
+                logger.error("Error ending looping conversation %s: %s", conversation_id, e)
+
+        return JSONResponse("Mensagem ignorada", status_code=200)
+
     try:
         # Create WppMessage instance for this request
         wpp = WppMessage(wpp_id, wpp_token, wpp_secret)
@@ -99,10 +260,11 @@ async def recieve_wpp_message(
         buffer.wpp = wpp  # Update the WppMessage instance
         
         # Add message to buffer
-        buffer_added = await buffer.add_message(phone, data)
+        data = payload.model_dump(exclude_unset=True)
+        buffer_added = await buffer.add_message(phone, data, buffer_id=buffer_id)
         
         if buffer_added:
-            logger.info(f"Message added to buffer for {phone}")
+            logger.info("Message added to buffer for %s", phone)
             
             # Mark message as processed to prevent duplicates
             if message_id:
@@ -110,11 +272,14 @@ async def recieve_wpp_message(
             
             return JSONResponse("Mensagem adicionada ao buffer", status_code=200)
         else:
-            # User is already being processed, process immediately as fallback
-            logger.info(f"User {phone} already being processed, falling back to immediate processing")
+            # User is already being processed, process immediately as fallback,
+            # once the running turn has written its memory
+            logger.info("User %s already being processed, falling back to immediate processing", phone)
             
-            hook = UserWppWebhook(data, redis_client, wpp)
-            hook.process_event()
+            hook = UserWppWebhook(payload, redis_client, wpp)
+            async with buffer.turn_lock(buffer_id):
+                with admission.track():
+                    await asyncio.to_thread(hook.process_event)
             
             # Mark message as processed
             if message_id:
@@ -123,7 +288,7 @@ async def recieve_wpp_message(
             return JSONResponse("Mensagem processada imediatamente", status_code=200)
             
     except Exception as e:
-        logger.error(f"Error processing webhook message: {e}")
+        logger.error("Error processing webhook message: %s", e)
         return JSONResponse("Erro interno do servidor", status_code=500)
 
 
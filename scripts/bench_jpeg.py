@@ -0,0 +1,86 @@
+"""
+Benchmark the bounded-size JPEG encoder against the previous encode loop.
+
+Each (encoder, image) pair runs in a fresh process so the reported peak RSS
+belongs to that run only.
+
+Usage (from the repository root, so the wpp package is importable):
+    PYTHONPATH=. uv run python scripts/bench_jpeg.py photos/*.jpg
+"""
+
+import io
+import sys
+import time
+import resource
+import multiprocessing
+
+from PIL import Image
+
+from wpp.media.image import MAX_BYTES, encode_jpeg, open_image
+
+
+def legacy_encode(image: Image.Image) -> bytes:
+    """The encode loop previously inlined in UserWppWebhook.__process_image."""
+    if image.mode == 'RGBA':
+        image = image.convert('RGB')
+
+    quality = 90
+    max_size = (1024, 1024)
+    img_byte_arr = io.BytesIO()
+
+    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    image.save(img_byte_arr, format="JPEG", quality=quality, optimize=True)
+    img_size = img_byte_arr.tell()
+
+    while img_size > MAX_BYTES and quality > 30:
+        img_byte_arr = io.BytesIO()
+        quality -= 30
+        image.save(img_byte_arr, format="JPEG", quality=quality, optimize=True)
+        img_size = img_byte_arr.tell()
+
+    size = 1024
+    while img_size > MAX_BYTES and size > 64:
+        size = int(size * 0.75)
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format="JPEG", quality=quality, optimize=True)
+        img_size = img_byte_arr.tell()
+
+    return img_byte_arr.getvalue()
+
+
+def run(method: str, path: str, queue: multiprocessing.Queue) -> None:
+    with open(path, "rb") as f:
+        data = f.read()
+
+    start = time.perf_counter()
+    if method == "legacy":
+        encoded = legacy_encode(Image.open(io.BytesIO(data)))
+    else:
+        encoded = encode_jpeg(open_image(data))
+    elapsed = time.perf_counter() - start
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, len(encoded), peak_kb))
+
+
+def main(paths: list[str]) -> None:
+    if not paths:
+        print(__doc__)
+        sys.exit(1)
+
+    print(f"{'image':40} {'method':8} {'time (ms)':>10} {'bytes':>10} {'peak RSS (MB)':>14}")
+
+    for path in paths:
+        for method in ("legacy", "bounded"):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run, args=(method, path, queue))
+            process.start()
+            elapsed, size, peak_kb = queue.get()
+            process.join()
+
+            print(f"{path[-40:]:40} {method:8} {elapsed * 1000:10.1f} {size:10d} {peak_kb / 1024:14.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
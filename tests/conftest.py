@@ -0,0 +1,40 @@
+import itertools
+
+import fakeredis
+import pytest
+
+
+_message_ids = itertools.count(1)
+
+
+@pytest.fixture
+def redis_client():
+    """In-memory Redis with Lua scripting, decoding responses like the app's client."""
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def make_payload(phone: str = "5511999990001", text: str = "Oi", **overrides) -> dict:
+    """A Z-API ReceivedCallback for a text message, as posted to /wpp_webhook."""
+    payload = {
+        "isStatusReply": False,
+        "connectedPhone": "5511900000000",
+        "waitingMessage": False,
+        "isEdit": False,
+        "isGroup": False,
+        "isNewsletter": False,
+        "instanceId": "instance-1",
+        "messageId": f"MSG{next(_message_ids)}",
+        "phone": phone,
+        "fromMe": False,
+        "momment": 1760832000000,
+        "status": "RECEIVED",
+        "chatName": "Cliente",
+        "senderName": "Cliente",
+        "broadcast": False,
+        "forwarded": False,
+        "type": "ReceivedCallback",
+        "fromApi": False,
+        "text": {"message": text},
+    }
+    payload.update(overrides)
+    return payload
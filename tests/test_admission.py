@@ -0,0 +1,152 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as webhook_app
+from wpp.admission import Admission, AdmissionController
+from wpp.buffer import MessageBuffer
+from wpp.routing import BOT_PHONE, ConversationRouter
+
+from tests.conftest import make_payload
+
+
+USER_PHONE = "5511999990001"
+
+
+@pytest.fixture
+def admission(redis_client, monkeypatch):
+    monkeypatch.setenv("ADMISSION_NUMBER_BURST", "2")
+    monkeypatch.setenv("ADMISSION_NUMBER_RATE", "0.001")
+    monkeypatch.setenv("ADMISSION_LOOP_REPEATS", "2")
+    return AdmissionController(redis_client)
+
+
+def test_user_over_rate_is_rejected(admission):
+    assert admission.admit(USER_PHONE).admitted
+    assert admission.admit(USER_PHONE).admitted
+
+    decision = admission.admit(USER_PHONE)
+    assert decision.action == Admission.REJECT
+    assert decision.reason == "rate_limited"
+    assert decision.retry_after > 0
+
+
+def test_bot_over_rate_is_coalesced_not_dropped(admission):
+    for index in range(2):
+        assert admission.admit("bot_session:c", "c", is_bot=True, content=f"msg {index}").admitted
+
+    decision = admission.admit("bot_session:c", "c", is_bot=True, content="other")
+    assert decision.action == Admission.COALESCE
+    assert decision.reason == "rate_limited"
+
+
+def test_overload_rejects_users(admission):
+    admission.max_inflight = 1
+    with admission.track():
+        decision = admission.admit(USER_PHONE)
+    assert decision.action == Admission.REJECT
+    assert decision.reason == "overloaded"
+
+
+def test_repeated_exchange_is_a_loop(admission):
+    admission.number_burst = 100
+    admission.record_agent_message("c", "1")
+
+    actions = [admission.admit("bot_session:c", "c", is_bot=True, content="Opção inválida").action for _ in range(3)]
+    assert actions == [Admission.ADMIT, Admission.ADMIT, Admission.DROP]
+
+    # The user writing again resets the loop detection
+    admission.admit(USER_PHONE, "c")
+    assert admission.admit("bot_session:c", "c", is_bot=True, content="Opção inválida").admitted
+
+
+def test_long_negotiation_is_not_a_loop(admission):
+    admission.number_burst = 100
+    for index in range(20):
+        admission.record_agent_message("c", f"answer {index}")
+        assert admission.admit("bot_session:c", "c", is_bot=True, content=f"question {index}").admitted
+
+
+def test_notice_once_per_window(admission):
+    assert admission.should_notify(USER_PHONE, 5)
+    assert not admission.should_notify(USER_PHONE, 5)
+
+
+@pytest.fixture
+def client(redis_client, monkeypatch):
+    monkeypatch.setenv("WPP_INSTANCE_ID", "instance-1")
+    monkeypatch.setenv("WPP_INSTANCE_TOKEN", "token")
+    monkeypatch.setenv("WPP_CLIENT_TOKEN", "secret")
+    monkeypatch.setenv("ADMISSION_NUMBER_BURST", "1")
+    monkeypatch.setenv("ADMISSION_NUMBER_RATE", "0.001")
+    monkeypatch.setenv("ADMISSION_LOOP_REPEATS", "1")
+
+    buffer = MessageBuffer(redis_client, None)
+    buffered = []
+
+    async def add_message(phone, data, buffer_id=None):
+        buffered.append((buffer_id, data["messageId"]))
+        return True
+
+    monkeypatch.setattr(buffer, "add_message", add_message)
+    monkeypatch.setattr(webhook_app, "redis_client", redis_client)
+    monkeypatch.setattr(webhook_app, "message_buffer", buffer)
+
+    test_client = TestClient(webhook_app.app)
+    test_client.buffered = buffered
+    return test_client
+
+
+def post(client, payload):
+    return client.post("/wpp_webhook", content=json.dumps(payload), headers={"z-api-token": "token"})
+
+
+def test_bot_message_over_rate_joins_open_buffer(client, redis_client):
+    conversation_id, _ = ConversationRouter(redis_client).open(USER_PHONE, "instance-1")
+    session = ConversationRouter.session_key(conversation_id)
+
+    first = make_payload(BOT_PHONE, "Escolha uma opção")
+    assert post(client, first).status_code == 200
+    assert client.buffered == [(session, first["messageId"])]
+
+    # The buffered turn has not run yet: the next bot message is over the bucket
+    redis_client.set(f"msg_buffer:{session}", json.dumps([{"data": first, "message_id": first["messageId"]}]), ex=10)
+    payload = make_payload(BOT_PHONE, "Digite o CPF")
+
+    response = post(client, payload)
+
+    assert response.status_code == 200
+    assert response.json() == "Mensagem adicionada ao buffer"
+    messages = json.loads(redis_client.get(f"msg_buffer:{session}"))
+    assert [m["message_id"] for m in messages[1:]] == [payload["messageId"]]
+    assert len(client.buffered) == 1
+
+
+def test_bot_message_over_rate_without_open_buffer_is_buffered(client, redis_client):
+    ConversationRouter(redis_client).open(USER_PHONE, "instance-1")
+
+    post(client, make_payload(BOT_PHONE, "Escolha uma opção"))
+    payload = make_payload(BOT_PHONE, "Digite o CPF")
+
+    response = post(client, payload)
+
+    assert response.status_code == 200
+    assert [message_id for _, message_id in client.buffered][-1] == payload["messageId"]
+
+
+def test_looping_bot_message_is_dropped_and_channel_released(client, redis_client, monkeypatch):
+    monkeypatch.setenv("ADMISSION_NUMBER_BURST", "100")
+    router = ConversationRouter(redis_client)
+    router.open(USER_PHONE, "instance-1")
+
+    # ADMISSION_LOOP_REPEATS=1: the second identical exchange is a loop
+    assert post(client, make_payload(BOT_PHONE, "Opção inválida")).json() != "Mensagem ignorada"
+
+    payload = make_payload(BOT_PHONE, "Opção inválida")
+    response = post(client, payload)
+
+    assert response.json() == "Mensagem ignorada"
+    assert payload["messageId"] not in [message_id for _, message_id in client.buffered]
+    assert router.resolve("instance-1") is None
+    assert redis_client.llen(f"outbound:q:{USER_PHONE}") == 1
@@ -0,0 +1,131 @@
+import json
+
+import pytest
+
+from wpp.api import wpp_webhook
+from wpp.api.wpp_webhook import UserWppWebhook
+from wpp.genai.router import FAST, ModelRouter
+from wpp.genai.stateful import MockResponsesBackend
+from wpp.media.handle import MediaHandle
+from wpp.outbound import OutboundQueue
+from wpp.conversation import SharedConversation
+
+from tests.conftest import make_payload
+
+
+USER_PHONE = "5511999990001"
+PAGE = "data:image/jpeg;base64,AAAA"
+
+
+def call(name: str, **arguments) -> dict:
+    return {"type": "function_call", "call_id": f"call_{name}", "name": name, "arguments": json.dumps(arguments)}
+
+
+def answer(text: str) -> list:
+    return [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": text}]}]
+
+
+def has_image(chain: list) -> bool:
+    return any(
+        part.get("type") == "input_image"
+        for item in chain
+        if isinstance(item.get("content"), list)
+        for part in item["content"]
+    )
+
+
+@pytest.fixture
+def webhook(redis_client, monkeypatch):
+    rendered = []
+
+    def get_media_content(self, index=-1, query=None):
+        rendered.append(index)
+        return [PAGE]
+
+    monkeypatch.setattr(UserWppWebhook, "get_media_content", get_media_content)
+    monkeypatch.setattr(ModelRouter, "classify_step1", lambda self, *args: FAST)
+    monkeypatch.setattr(ModelRouter, "classify_step2", lambda self, *args: FAST)
+
+    webhook = UserWppWebhook(make_payload(USER_PHONE, "Mandei a foto do carro"), redis_client, None)
+    webhook.user_input = {"text": "Mandei a foto do carro"}
+    webhook.message_type = "text"
+    webhook.memory = {
+        "step": 2,
+        "user_phone": USER_PHONE,
+        "conversation_id": f"instance-1:{USER_PHONE}",
+        "chat_history2": [],
+        "shared_conversation": SharedConversation({"user": USER_PHONE}),
+        "media": [
+            MediaHandle(url="https://example.com/carro.jpg", mime_type="image/jpeg", kind="image", number=1).model_dump(),
+        ],
+    }
+    webhook.rendered = rendered
+    return webhook
+
+
+def run_step2(webhook, monkeypatch, responder):
+    backend = MockResponsesBackend(responder)
+    monkeypatch.setattr(wpp_webhook, "STATE_BACKEND", "mock")
+    monkeypatch.setattr(wpp_webhook, "get_backend", lambda: backend)
+    webhook._UserWppWebhook__process_step2()
+    return backend
+
+
+def test_new_attachments_are_announced_once_without_rendering(webhook):
+    assert webhook._UserWppWebhook__announce_pending_media() == "[Anexo 1: imagem]"
+    assert webhook._UserWppWebhook__announce_pending_media() == ""
+    assert webhook.rendered == []
+
+
+def test_attachment_is_not_rendered_unless_the_model_asks(webhook, monkeypatch, redis_client):
+    backend = run_step2(webhook, monkeypatch, lambda chain, tools: answer("ok"))
+
+    assert webhook.rendered == []
+    assert not any(has_image(request["input"]) for request in backend.requests)
+    assert "[Anexo 1: imagem]" in json.dumps(backend.requests[0]["input"], ensure_ascii=False)
+
+
+def test_requested_attachment_is_shown_before_anything_is_sent(webhook, monkeypatch, redis_client):
+    def responder(chain, tools):
+        if chain[-1].get("type") == "function_call_output":
+            return answer("feito")
+        if has_image(chain):
+            return [call("send_message", message="Vi a foto do para-choque", to="user")]
+        # The first pass also tries to answer before seeing the picture
+        return [call("view_attachment", numero=1), call("send_message", message="Recebi", to="user")]
+
+    backend = run_step2(webhook, monkeypatch, responder)
+
+    assert webhook.rendered == [0]
+    # Second pass: the whole turn is sent again, with the picture
+    assert [has_image(request["input"]) for request in backend.requests] == [False, False, True, False]
+
+    queue = OutboundQueue(redis_client)
+    sent = [json.loads(raw)["payload"]["message"] for raw in redis_client.lrange(queue.queue_key(USER_PHONE), 0, -1)]
+    assert sent == ["Vi a foto do para-choque"]
+
+    # Memory keeps the note, not the pages
+    assert PAGE not in json.dumps(webhook.memory["chat_history2"])
+
+
+def test_unknown_attachment(webhook):
+    assert webhook.view_attachment(7) == "O anexo 7 não existe."
+    assert webhook.requested_media == []
+
+
+def test_step1_never_renders_media(webhook, monkeypatch):
+    policies = []
+
+    class Caller:
+        def __init__(self, policy):
+            policies.append(policy.name)
+
+        def call_task(self, make_task):
+            raise TimeoutError("slow")
+
+    monkeypatch.setattr(wpp_webhook, "ResilientCaller", Caller)
+    webhook.memory["step"] = 1
+    webhook._UserWppWebhook__process_step1()
+
+    assert policies == ["step1.fast"]
+    assert webhook.rendered == []
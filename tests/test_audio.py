@@ -0,0 +1,61 @@
+import pytest
+
+from wpp.media.audio import GAP_MARKER, AudioTranscriber
+
+
+URL = "https://example.com/note.ogg"
+
+
+@pytest.fixture
+def transcriber(redis_client, monkeypatch):
+    transcriber = AudioTranscriber(redis_client)
+    monkeypatch.setattr(transcriber, "_download", lambda url: b"voice note")
+    return transcriber
+
+
+def cached_keys(redis_client):
+    return redis_client.keys("audio_transcript*")
+
+
+def test_transcript_is_cached_by_content_and_url(redis_client, transcriber, monkeypatch):
+    monkeypatch.setattr(AudioTranscriber, "_transcribe_bytes", staticmethod(lambda audio: "bateram no meu carro"))
+
+    assert transcriber.transcribe(URL, seconds=5) == "bateram no meu carro"
+    assert len(cached_keys(redis_client)) == 2
+
+
+def test_empty_transcript_is_not_cached(redis_client, transcriber, monkeypatch):
+    monkeypatch.setattr(AudioTranscriber, "_transcribe_bytes", staticmethod(lambda audio: "  "))
+
+    assert transcriber.transcribe(URL, seconds=5) == "  "
+    assert cached_keys(redis_client) == []
+
+
+def test_transcript_with_a_gap_is_not_cached(redis_client, transcriber, monkeypatch):
+    monkeypatch.setattr(AudioTranscriber, "_transcribe_chunked", lambda self, audio: (f"oi {GAP_MARKER}", False))
+    monkeypatch.setattr("wpp.media.audio.shutil.which", lambda name: "/usr/bin/ffmpeg")
+
+    assert transcriber.transcribe(URL, seconds=600) == f"oi {GAP_MARKER}"
+    assert cached_keys(redis_client) == []
+
+
+def test_failed_chunk_is_marked_as_a_gap(transcriber, monkeypatch):
+    def transcribe(audio):
+        if audio == b"2":
+            raise TimeoutError("whisper")
+        return f"parte {audio.decode()}"
+
+    monkeypatch.setattr(AudioTranscriber, "_transcribe_bytes", staticmethod(transcribe))
+
+    assert transcriber._transcribe_parts([b"1", b"2", b"3"]) == (f"parte 1 {GAP_MARKER} parte 3", False)
+    assert transcriber._transcribe_parts([b"1", b"3"]) == ("parte 1 parte 3", True)
+
+
+def test_note_fails_when_every_chunk_fails(transcriber, monkeypatch):
+    def transcribe(audio):
+        raise TimeoutError("whisper")
+
+    monkeypatch.setattr(AudioTranscriber, "_transcribe_bytes", staticmethod(transcribe))
+
+    with pytest.raises(TimeoutError):
+        transcriber._transcribe_parts([b"1", b"2"])
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from wpp import buffer as buffer_module
+from wpp.api.wpp_webhook import UserWppWebhook
+from wpp.buffer import CombinedMessageProcessor
+from wpp.schemas.wpp_webhook import WppPayload
+
+from tests.conftest import make_payload
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    """Payloads the combined turn runs with, and how often payloads were validated."""
+    seen = []
+    validations = []
+    adapter = buffer_module.PAYLOAD_ADAPTER
+
+    class CountingAdapter:
+        def validate_python(self, data):
+            validations.append(data["messageId"])
+            return adapter.validate_python(data)
+
+    def model_validate(cls, data, **kwargs):
+        raise AssertionError("payload validated again")
+
+    def process(self):
+        seen.append(self.data)
+        return None
+
+    monkeypatch.setattr(buffer_module, "PAYLOAD_ADAPTER", CountingAdapter())
+    monkeypatch.setattr(WppPayload, "model_validate", classmethod(model_validate))
+    monkeypatch.setattr(UserWppWebhook, "_process_wpp_message", process)
+    return seen, validations
+
+
+def test_buffered_messages_are_validated_once(redis_client, processed):
+    seen, validations = processed
+    messages = [make_payload(text="meu carro"), make_payload(text="bateu")]
+    entries = [
+        {"data": data, "timestamp": f"2026-10-19T00:00:0{index}", "message_id": data["messageId"]}
+        for index, data in enumerate(messages)
+    ]
+
+    asyncio.run(CombinedMessageProcessor(redis_client, None, messages[0]["phone"], entries).process_combined_messages())
+
+    assert validations == [data["messageId"] for data in messages]
+    (payload,) = seen
+    assert payload.messageId == messages[0]["messageId"]
+    assert payload.text.message == "[Processando 2 mensagens recebidas] meu carro bateu"
+
+
+def test_with_text_resolves_the_type_again():
+    data = make_payload(image={
+        "mimeType": "image/jpeg",
+        "imageUrl": "https://example.com/a.jpg",
+        "thumbnailUrl": "https://example.com/a-thumb.jpg",
+        "caption": "",
+        "width": 800,
+        "height": 600,
+        "viewOnce": False,
+    })
+    del data["text"]
+    payload = WppPayload.model_validate(data)
+    assert payload.get_payload_type() == "image"
+
+    combined = payload.with_text("legenda")
+    assert combined.get_payload_type() == "text"
+    assert payload.get_payload_type() == "image"
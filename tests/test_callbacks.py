@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from wpp.schemas.wpp_webhook import (
+    DeliveryCallback,
+    MessageStatusCallback,
+    OtherCallback,
+    PresenceCallback,
+    WppPayload,
+    callback_kind,
+    parse_callback,
+)
+
+from tests.conftest import make_payload
+
+
+def test_received_message_is_a_payload():
+    callback = parse_callback(json.dumps(make_payload(text="Oi")))
+    assert isinstance(callback, WppPayload)
+    assert callback.text.message == "Oi"
+
+
+@pytest.mark.parametrize(
+    "body, model",
+    [
+        ({"type": "MessageStatusCallback", "status": "READ", "ids": ["a", "b"]}, MessageStatusCallback),
+        ({"type": "PresenceChatCallback", "phone": "5511999990001", "status": "COMPOSING"}, PresenceCallback),
+        ({"type": "DeliveryCallback", "phone": "5511999990001", "zaapId": "z1", "messageId": "m1"}, DeliveryCallback),
+        ({"type": "ConnectedCallback", "instanceId": "instance-1"}, OtherCallback),
+        ({"type": "SomethingNew", "instanceId": "instance-1"}, OtherCallback),
+    ],
+)
+def test_callbacks_are_validated_by_type(body, model):
+    assert type(parse_callback(json.dumps(body))) is model
+
+
+def test_receipt_is_not_validated_as_a_message():
+    # A receipt lacks the message fields; it must not fail the message schema
+    callback = parse_callback(b'{"type": "MessageStatusCallback", "status": "DELIVERED", "ids": ["a"]}')
+    assert callback.ids == ["a"]
+
+
+@pytest.mark.parametrize(
+    "body, kind",
+    [
+        ({"ids": ["a"], "status": "READ"}, "status"),
+        ({"lastSeen": 1760832000000}, "presence"),
+        ({"senderName": "Cliente"}, "message"),
+        ({"zaapId": "z1"}, "delivery"),
+        ({}, "other"),
+        ([], "other"),
+    ],
+)
+def test_legacy_bodies_without_type(body, kind):
+    assert callback_kind(body) == kind
+
+
+def test_kind_of_a_validated_model():
+    assert callback_kind(MessageStatusCallback(status="READ")) == "status"
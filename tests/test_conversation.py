@@ -0,0 +1,58 @@
+from wpp.conversation import MAX_ENTRIES, SharedConversation
+
+
+PARTICIPANTS = {"user": "5511999990001", "customer_service": "551130039303", "agent": "intermediary_agent"}
+
+
+def test_oldest_entries_are_evicted_and_counts_follow():
+    conversation = SharedConversation(PARTICIPANTS)
+    conversation.add("oi", "user", PARTICIPANTS["user"])
+    for index in range(MAX_ENTRIES):
+        conversation.add(f"resposta {index}", "agent", "")
+
+    assert len(conversation.entries) == MAX_ENTRIES
+    assert [entry["message"] for entry in conversation.history][0] == "resposta 0"
+    assert conversation.counts == {"user": 0, "customer_service": 0, "agent": MAX_ENTRIES}
+
+
+def test_round_trip_keeps_entries_counts_and_rendered_context():
+    conversation = SharedConversation(PARTICIPANTS)
+    conversation.add("oi", "user", PARTICIPANTS["user"])
+    conversation.add("Digite o CPF", "customer_service", PARTICIPANTS["customer_service"])
+    rendered = conversation.render()
+
+    loaded = SharedConversation.from_dict(conversation.to_dict())
+
+    assert list(loaded.history) == list(conversation.history)
+    assert loaded.counts == conversation.counts
+    assert loaded.rendered == rendered
+    assert loaded.current_context["last_speaker"] == "customer_service"
+
+
+def test_legacy_history_is_truncated_on_load():
+    legacy = {
+        "participants": PARTICIPANTS,
+        "conversation_history": [
+            {"timestamp": "", "speaker_role": "user" if index < 10 else "agent", "message": f"m{index}"}
+            for index in range(MAX_ENTRIES + 10)
+        ],
+    }
+
+    conversation = SharedConversation.from_dict(legacy)
+
+    assert len(conversation.entries) == MAX_ENTRIES
+    assert next(conversation.history)["message"] == "m10"
+    assert conversation.counts["user"] == 0
+    assert conversation.counts["agent"] == MAX_ENTRIES
+
+
+def test_changes_invalidate_the_rendered_context():
+    conversation = SharedConversation(PARTICIPANTS)
+    first = conversation.render()
+
+    conversation.add("oi", "user", PARTICIPANTS["user"])
+    assert conversation.rendered is None
+    assert conversation.render() != first
+
+    conversation.update_context(status="finished")
+    assert "finished" in conversation.render()
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from wpp.genai.limiter import HIGH, LOW, NORMAL, PrioritySemaphore
+
+
+def wait_for(condition, timeout: float = 2.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def queue_waiters(semaphore: PrioritySemaphore, priorities: list) -> tuple[list, list]:
+    """Start one waiter per priority, in order; each records its name when served and releases."""
+    served = []
+    threads = []
+
+    for name, priority in priorities:
+        def waiter(name=name, priority=priority):
+            assert semaphore.acquire(priority, timeout=2)
+            served.append(name)
+            semaphore.release()
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: semaphore.waiting == len(threads))
+
+    return served, threads
+
+
+def test_free_slots_are_taken_without_waiting():
+    semaphore = PrioritySemaphore(2)
+    assert semaphore.acquire(LOW, timeout=0)
+    assert semaphore.acquire(LOW, timeout=0)
+    assert not semaphore.acquire(HIGH, timeout=0.01)
+
+
+def test_waiters_are_served_by_priority_then_arrival():
+    semaphore = PrioritySemaphore(1)
+    assert semaphore.acquire(NORMAL)
+
+    served, threads = queue_waiters(
+        semaphore,
+        [("low-1", LOW), ("normal-1", NORMAL), ("high-1", HIGH), ("low-2", LOW), ("high-2", HIGH)],
+    )
+    semaphore.release()
+    for thread in threads:
+        thread.join(2)
+
+    assert served == ["high-1", "high-2", "normal-1", "low-1", "low-2"]
+    assert semaphore.active == 0
+
+
+def test_timed_out_waiter_is_skipped():
+    semaphore = PrioritySemaphore(1)
+    assert semaphore.acquire(NORMAL)
+
+    assert not semaphore.acquire(HIGH, timeout=0.01)
+    assert semaphore.waiting == 0
+
+    served, threads = queue_waiters(semaphore, [("low", LOW)])
+    semaphore.release()
+    threads[0].join(2)
+
+    # The slot went to the live waiter, not to the abandoned HIGH entry
+    assert served == ["low"]
+    assert semaphore.active == 0
@@ -0,0 +1,102 @@
+import pytest
+
+from wpp.api.wpp_webhook import UserWppWebhook
+from wpp.genai.menu_cache import MenuCache, is_personal, menu_body
+from wpp.routing import BOT_PHONE
+
+from tests.conftest import make_payload
+
+
+def list_menu(description: str, options: list[tuple[str, str]]) -> dict:
+    """A Porto Seguro listMessage as Z-API posts it."""
+    payload = make_payload(
+        BOT_PHONE,
+        listMessage={
+            "description": description,
+            "footerText": "Porto Seguro",
+            "title": "Atendimento",
+            "buttonText": "Ver opções",
+            "sections": [
+                {
+                    "title": "Serviços",
+                    "options": [
+                        {"title": title, "description": "", "rowId": row_id}
+                        for title, row_id in options
+                    ],
+                }
+            ],
+        },
+    )
+    del payload["text"]
+    return payload
+
+
+def webhook_input(redis_client, payload: dict) -> dict:
+    """The menu as the webhook extracts it for step 2."""
+    webhook = UserWppWebhook(payload, redis_client, None)
+    return webhook._UserWppWebhook__get_user_input()
+
+
+@pytest.fixture
+def generic_menu(redis_client):
+    return webhook_input(redis_client, list_menu(
+        "Escolha uma das opções abaixo",
+        [("Sinistro", "1"), ("Assistência 24h", "2"), ("Falar com atendente", "3")],
+    ))
+
+
+def test_numeric_option_ids_do_not_make_a_menu_personal(generic_menu):
+    assert "(1)" in generic_menu["text"]
+    assert menu_body(generic_menu) == "Escolha uma das opções abaixo"
+    assert not is_personal(generic_menu)
+
+
+def test_numbered_option_titles_are_not_personal(redis_client):
+    menu = webhook_input(redis_client, list_menu(
+        "Escolha uma opção", [("1 - Sinistro", "10"), ("2️⃣ Assistência", "20")]
+    ))
+    assert not is_personal(menu)
+
+
+@pytest.mark.parametrize("description, options", [
+    ("Confirma o CPF 123.456.789-00?", [("Sim", "1"), ("Não", "2")]),
+    ("Qual veículo?", [("Placa ABC1D23", "1"), ("Outro", "2")]),
+    ("Seus dados estão corretos?", [("Sim", "1"), ("Não", "2")]),
+    ("Protocolo 20251019 aberto. Deseja algo mais?", [("Sim", "1"), ("Não", "2")]),
+    ("Qual veículo?", [("ABC1D23", "1"), ("XYZ9876", "2")]),
+    ("Vistoria agendada para 19/10. Deseja remarcar?", [("Sim", "1"), ("Não", "2")]),
+])
+def test_personal_data_menus(redis_client, description, options):
+    assert is_personal(webhook_input(redis_client, list_menu(description, options)))
+
+
+def test_learned_choice_is_served_for_similar_problems(redis_client, generic_menu):
+    cache = MenuCache(redis_client)
+
+    assert cache.learn(generic_menu, "meu carro bateu no muro", "Sinistro")
+    assert cache.lookup(generic_menu, "o carro bateu") is None
+    assert cache.learn(generic_menu, "bati o carro no poste", "Sinistro")
+
+    assert cache.lookup(generic_menu, "o carro bateu no poste") == "Sinistro"
+    # Unrelated problems do not borrow the choice, whatever the menu's history
+    assert cache.lookup(generic_menu, "perdi a chave de casa") is None
+
+
+def test_ambiguous_history_is_not_served(redis_client, generic_menu):
+    cache = MenuCache(redis_client)
+    cache.learn(generic_menu, "carro bateu", "Sinistro")
+    cache.learn(generic_menu, "carro bateu e quebrou", "Assistência 24h")
+
+    assert cache.lookup(generic_menu, "carro bateu") is None
+
+
+def test_choice_must_be_an_option_on_screen(redis_client, generic_menu):
+    assert not MenuCache(redis_client).learn(generic_menu, "carro bateu", "Quero cancelar")
+
+
+def test_personal_menus_are_never_learned(redis_client):
+    menu = webhook_input(redis_client, list_menu("Confirma o CPF 123.456.789-00?", [("Sim", "1"), ("Não", "2")]))
+    cache = MenuCache(redis_client)
+
+    assert not cache.learn(menu, "carro bateu", "Sim")
+    assert not redis_client.exists(cache.menus_key)
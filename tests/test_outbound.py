@@ -0,0 +1,181 @@
+import json
+import time
+
+import pytest
+import requests
+
+from wpp.outbound import DeliveryReceipts, OutboundQueue, OutboundSender
+
+
+NUMBER = "5511999990001"
+
+
+class Response:
+    def __init__(self, status_code: int = 200, message_id: str = "") -> None:
+        self.status_code = status_code
+        self.message_id = message_id
+
+    def json(self) -> dict:
+        return {"messageId": self.message_id}
+
+
+class FakeWpp:
+    """Records sends; ``responses`` are returned (or raised) in order, then 200."""
+
+    def __init__(self, responses: list | None = None, on_send=None) -> None:
+        self.sent = []
+        self.responses = list(responses or [])
+        self.on_send = on_send
+
+    def send_message(self, number: str, message: str) -> Response:
+        self.sent.append((number, message))
+        if self.on_send:
+            self.on_send()
+
+        response = self.responses.pop(0) if self.responses else Response(200, f"id-{len(self.sent)}")
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def queue(redis_client):
+    return OutboundQueue(redis_client)
+
+
+def make_sender(redis_client, wpp, **attributes):
+    sender = OutboundSender(redis_client, wpp, workers=1)
+    sender.backoff = 0.001
+    for name, value in attributes.items():
+        setattr(sender, name, value)
+    return sender
+
+
+def test_enqueue_is_idempotent_and_marks_number_ready(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": "a"}, key="k1")
+    queue.enqueue(NUMBER, "send_message", {"message": "a"}, key="k1")
+    queue.enqueue(NUMBER, "send_message", {"message": "b"}, key="k2")
+
+    assert redis_client.llen(queue.queue_key(NUMBER)) == 2
+    assert redis_client.lrange(queue.ready_key, 0, -1) == [NUMBER]
+    assert redis_client.smembers(queue.ready_set_key) == {NUMBER}
+
+
+def test_list_message_is_queued_in_order(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": ["a", "b", "c"]}, key="k")
+
+    entries = [json.loads(raw) for raw in redis_client.lrange(queue.queue_key(NUMBER), 0, -1)]
+    assert [entry["payload"]["message"] for entry in entries] == ["a", "b", "c"]
+    assert [entry["key"] for entry in entries] == ["k:0", "k:1", "k:2"]
+
+
+def test_unknown_method_is_rejected(queue):
+    with pytest.raises(ValueError):
+        queue.enqueue(NUMBER, "delete_everything", {})
+
+
+def test_drain_sends_in_order_and_stores_results(redis_client, queue):
+    for index in range(3):
+        queue.enqueue(NUMBER, "send_message", {"message": f"m{index}"}, key=f"k{index}")
+
+    wpp = FakeWpp()
+    make_sender(redis_client, wpp)._drain(NUMBER)
+
+    assert wpp.sent == [(NUMBER, "m0"), (NUMBER, "m1"), (NUMBER, "m2")]
+    assert redis_client.llen(queue.queue_key(NUMBER)) == 0
+    assert queue.get_result("k1")["status"] == "sent"
+    assert not redis_client.smembers(queue.ready_set_key)
+    assert not redis_client.exists(f"{queue.namespace}:lock:{NUMBER}")
+
+
+def test_failed_send_is_retried_before_later_messages(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": "first"}, key="k1")
+    queue.enqueue(NUMBER, "send_message", {"message": "second"}, key="k2")
+
+    wpp = FakeWpp([requests.ConnectTimeout("down"), Response(503)])
+    make_sender(redis_client, wpp)._drain(NUMBER)
+
+    assert [message for _, message in wpp.sent] == ["first", "first", "first", "second"]
+    assert queue.get_result("k1")["attempts"] == 3
+
+
+def test_message_is_given_up_after_max_attempts(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": "never"}, key="k1")
+
+    wpp = FakeWpp([Response(500)] * 10)
+    make_sender(redis_client, wpp, max_attempts=2)._drain(NUMBER)
+
+    assert len(wpp.sent) == 2
+    assert queue.get_result("k1")["status"] == "failed"
+
+
+def test_rejected_message_is_not_retried(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": "bad"}, key="k1")
+
+    wpp = FakeWpp([Response(400)])
+    make_sender(redis_client, wpp)._drain(NUMBER)
+
+    assert len(wpp.sent) == 1
+    assert queue.get_result("k1")["status"] == "rejected"
+
+
+def test_reaper_requeues_number_of_dead_worker(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": "a"}, key="k1")
+    sender = make_sender(redis_client, FakeWpp())
+
+    # A worker popped the number and died while holding the lock
+    redis_client.lpop(queue.ready_key)
+    redis_client.set(f"{queue.namespace}:lock:{NUMBER}", "dead", ex=60)
+    assert sender.reap() == 0
+
+    # Once its lock expired the number is drained again, exactly once
+    redis_client.delete(f"{queue.namespace}:lock:{NUMBER}")
+    assert sender.reap() == 1
+    assert sender.reap() == 0
+    assert redis_client.lrange(queue.ready_key, 0, -1) == [NUMBER]
+
+
+def test_reaper_forgets_numbers_without_messages(redis_client, queue):
+    redis_client.sadd(queue.ready_set_key, NUMBER)
+    assert make_sender(redis_client, FakeWpp()).reap() == 0
+    assert not redis_client.smembers(queue.ready_set_key)
+
+
+def test_lock_is_kept_while_a_send_blocks(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": "slow"}, key="k1")
+    lock_key = f"{queue.namespace}:lock:{NUMBER}"
+    ttls = []
+
+    def slow_send():
+        time.sleep(2.5)
+        ttls.append(redis_client.ttl(lock_key))
+
+    make_sender(redis_client, FakeWpp(on_send=slow_send), lock_ttl=2)._drain(NUMBER)
+
+    # Without the heartbeat the 2 s lock would have expired during the send
+    assert ttls and ttls[0] > 0
+    assert queue.get_result("k1")["status"] == "sent"
+
+
+def test_worker_that_lost_its_lock_leaves_the_queue_alone(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": "a"}, key="k1")
+    queue.enqueue(NUMBER, "send_message", {"message": "b"}, key="k2")
+    lock_key = f"{queue.namespace}:lock:{NUMBER}"
+
+    def taken_over():
+        redis_client.set(lock_key, "other-worker")
+
+    wpp = FakeWpp(on_send=taken_over)
+    make_sender(redis_client, wpp)._drain(NUMBER)
+
+    assert len(wpp.sent) == 1
+    assert redis_client.llen(queue.queue_key(NUMBER)) == 2
+    assert redis_client.get(lock_key) == "other-worker"
+
+
+def test_receipts_are_indexed_by_message_id(redis_client, queue):
+    queue.enqueue(NUMBER, "send_message", {"message": "a"}, key="k1")
+    make_sender(redis_client, FakeWpp([Response(200, "zapi-1")]))._drain(NUMBER)
+
+    assert DeliveryReceipts(redis_client, queue).record("read", ["zapi-1"], int(time.time() * 1000)) == 1
+    assert "read" in queue.get_receipts("k1")
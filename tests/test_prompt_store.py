@@ -0,0 +1,90 @@
+import pytest
+import redis
+
+from wpp.api.wpp_webhook import UserWppWebhook
+from wpp.prompt_store import REF_TYPE, PromptNotFound, PromptStore
+
+from tests.conftest import make_payload
+
+
+SYSTEM = "Você é o assistente do segurado. " * 100
+
+
+@pytest.fixture
+def store(redis_client):
+    PromptStore._local.clear()
+    yield PromptStore(redis_client)
+    PromptStore._local.clear()
+
+
+def history(user_text: str = "Oi") -> list:
+    return [
+        {"role": "system", "content": [{"type": "text", "text": SYSTEM}]},
+        {"role": "user", "content": [{"type": "text", "text": user_text}]},
+    ]
+
+
+def test_large_blocks_round_trip_through_references(redis_client, store):
+    stored = store.dehydrate(history())
+
+    assert stored[0]["content"] == [{"type": REF_TYPE, "ref": store.digest(SYSTEM)}]
+    assert stored[1] == history()[1]
+
+    PromptStore._local.clear()
+    assert store.hydrate(stored) == history()
+
+
+def test_blocks_do_not_expire_by_default(redis_client, store):
+    store.dehydrate(history())
+    assert redis_client.ttl(store._key(store.digest(SYSTEM))) == -1
+
+
+def test_reading_a_block_refreshes_its_ttl(redis_client, monkeypatch):
+    monkeypatch.setenv("PROMPT_STORE_TTL", "100")
+    store = PromptStore(redis_client)
+    stored = store.dehydrate(history())
+    key = store._key(store.digest(SYSTEM))
+
+    redis_client.expire(key, 5)
+    PromptStore._local.clear()
+    store.hydrate(stored)
+
+    assert redis_client.ttl(key) > 5
+
+
+def test_missing_block_raises(redis_client, store):
+    stored = store.dehydrate(history())
+    redis_client.flushall()
+    PromptStore._local.clear()
+
+    with pytest.raises(PromptNotFound) as error:
+        store.hydrate(stored)
+    assert error.value.digests == [store.digest(SYSTEM)]
+
+
+def test_unreachable_store_raises(store, monkeypatch):
+    stored = store.dehydrate(history())
+    PromptStore._local.clear()
+
+    def mget(keys):
+        raise redis.ConnectionError("down")
+
+    monkeypatch.setattr(store.redis, "mget", mget)
+    with pytest.raises(PromptNotFound):
+        store.hydrate(stored)
+
+
+def test_lost_system_prompt_is_rebuilt_and_turns_kept(redis_client, store):
+    webhook = UserWppWebhook(make_payload(), redis_client, None)
+    stored = store.dehydrate(history("Meu carro bateu"))
+    lost = [store.digest(SYSTEM)]
+    redis_client.flushall()
+    PromptStore._local.clear()
+
+    rebuilt = webhook._UserWppWebhook__rebuild_step2_history(stored, lost)
+
+    assert rebuilt[0] == webhook._UserWppWebhook__get_step2_system_message()
+    assert rebuilt[1:] == history("Meu carro bateu")[1:]
+    # The new memory resolves again
+    PromptStore._local.clear()
+    assert webhook.prompts.hydrate(webhook.memory["chat_history2"]) == rebuilt
@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from wpp.api import wpp_webhook
+from wpp.api.wpp_webhook import UserWppWebhook
+from wpp.genai.resilience import CallPolicy, CircuitOpenError, ResilientCaller
+from wpp.genai.router import FAST, ModelRouter
+
+from tests.conftest import make_payload
+
+
+def test_policy_budget_is_capped_by_the_turn_deadline():
+    policy = CallPolicy("test.within", budget=25).within(time.monotonic() + 5)
+    assert 4 < policy.budget <= 5
+
+    assert CallPolicy("test.within", budget=25).within(time.monotonic() - 1).budget == 0
+
+
+def test_spent_deadline_times_out_without_calling():
+    calls = []
+    policy = CallPolicy("test.spent").within(time.monotonic())
+
+    with pytest.raises(TimeoutError):
+        ResilientCaller(policy).call(calls.append, 1)
+    assert calls == []
+
+
+class FakeCaller:
+    """Stands in for ResilientCaller, failing every call with ``error``."""
+
+    calls: list = []
+    error: Exception = TimeoutError("slow")
+
+    def __init__(self, policy: CallPolicy) -> None:
+        self.policy = policy
+
+    def call_task(self, make_task):
+        FakeCaller.calls.append((self.policy.name, self.policy.budget))
+        raise FakeCaller.error
+
+
+@pytest.fixture
+def step1(redis_client, monkeypatch):
+    FakeCaller.calls = []
+    monkeypatch.setattr(wpp_webhook, "ResilientCaller", FakeCaller)
+    monkeypatch.setattr(ModelRouter, "classify_step1", lambda self, *args: FAST)
+
+    webhook = UserWppWebhook(make_payload(text="meu carro bateu"), redis_client, None)
+    webhook.user_input = {"text": "meu carro bateu"}
+    webhook.message_type = "text"
+    return webhook._UserWppWebhook__process_step1
+
+
+@pytest.mark.parametrize("error", [TimeoutError("slow"), CircuitOpenError("open")])
+def test_step1_does_not_escalate_when_out_of_time_or_capacity(step1, error):
+    FakeCaller.error = error
+    response = step1()
+
+    assert [name for name, _ in FakeCaller.calls] == ["step1.fast"]
+    assert response["type"] == "message"
+
+
+def test_step1_escalation_shares_the_turn_deadline(step1):
+    FakeCaller.error = ValueError("empty")
+    step1()
+
+    (fast, fast_budget), (strong, strong_budget) = FakeCaller.calls
+    assert (fast, strong) == ("step1.fast", "step1.strong")
+    assert strong_budget <= fast_budget <= wpp_webhook.TURN_BUDGET
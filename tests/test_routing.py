@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from wpp.outbound import OutboundQueue
+from wpp.routing import ACTIVE, BOT_PHONE, CLAIMED, WAITING, ConversationRouter
+
+
+INSTANCE = "instance-1"
+FIRST, SECOND, THIRD = "5511999990001", "5511999990002", "5511999990003"
+
+
+@pytest.fixture
+def router(redis_client):
+    return ConversationRouter(redis_client)
+
+
+@pytest.fixture
+def queue(redis_client):
+    return OutboundQueue(redis_client)
+
+
+def expire_channel(redis_client, router):
+    channel_key, _ = router._channel_keys(INSTANCE, BOT_PHONE)
+    redis_client.delete(channel_key)
+
+
+def sent(redis_client, queue, phone):
+    return [json.loads(raw)["payload"]["message"] for raw in redis_client.lrange(queue.queue_key(phone), 0, -1)]
+
+
+def test_one_conversation_per_channel(router):
+    assert router.open(FIRST, INSTANCE)[1] == CLAIMED
+    assert router.open(FIRST, INSTANCE)[1] == ACTIVE
+    assert router.open(SECOND, INSTANCE)[1] == WAITING
+    assert router.resolve(INSTANCE)["user_phone"] == FIRST
+
+
+def test_hand_over_starts_the_next_conversation(redis_client, router, queue):
+    first, _ = router.open(FIRST, INSTANCE)
+    second, _ = router.open(SECOND, INSTANCE)
+
+    assert router.hand_over(first, queue, key="m1") == second
+    assert router.resolve(INSTANCE)["id"] == second
+    assert sent(redis_client, queue, BOT_PHONE) == ["Oi Porto!"]
+    assert len(sent(redis_client, queue, SECOND)) == 1
+
+
+def test_expired_channel_is_not_taken_by_whoever_writes_first(redis_client, router):
+    router.open(FIRST, INSTANCE)
+    second, _ = router.open(SECOND, INSTANCE)
+    router.open(THIRD, INSTANCE)
+    expire_channel(redis_client, router)
+
+    # Neither the former holder nor the last in line jumps the queue
+    assert router.open(FIRST, INSTANCE)[1] == WAITING
+    assert router.open(THIRD, INSTANCE)[1] == WAITING
+    assert router.open(SECOND, INSTANCE)[1] == CLAIMED
+    assert router.resolve(INSTANCE)["id"] == second
+
+
+def test_expired_channel_is_given_to_the_head_of_the_waitlist(redis_client, router, queue):
+    router.open(FIRST, INSTANCE)
+    second, _ = router.open(SECOND, INSTANCE)
+    third, _ = router.open(THIRD, INSTANCE)
+
+    # Held channels are left alone
+    assert router.promote_expired(queue) == []
+
+    expire_channel(redis_client, router)
+    assert router.promote_expired(queue) == [second]
+    assert router.resolve(INSTANCE)["id"] == second
+    assert sent(redis_client, queue, BOT_PHONE) == ["Oi Porto!"]
+    assert len(sent(redis_client, queue, SECOND)) == 1
+    assert router.open(SECOND, INSTANCE)[1] == ACTIVE
+
+    expire_channel(redis_client, router)
+    assert router.promote_expired(queue) == [third]
+    assert not redis_client.smembers(router.waiting_key)
+
+
+def test_free_channel_with_empty_waitlist_is_claimed_by_anyone(redis_client, router, queue):
+    router.open(FIRST, INSTANCE)
+    expire_channel(redis_client, router)
+
+    assert router.promote_expired(queue) == []
+    assert router.open(SECOND, INSTANCE)[1] == CLAIMED
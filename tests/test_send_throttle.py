@@ -0,0 +1,51 @@
+import pytest
+import requests
+
+from wpp.api import wpp_message
+from wpp.api.wpp_message import WppMessage
+from wpp.ratelimit import SendThrottle
+
+
+class Response:
+    def __init__(self, status_code: int, headers: dict | None = None) -> None:
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_post_has_a_timeout_and_records_timeouts(redis_client, monkeypatch):
+    calls = []
+
+    def post(url, headers=None, timeout=None, **kwargs):
+        calls.append(timeout)
+        raise requests.ReadTimeout("hung")
+
+    monkeypatch.setattr(wpp_message.requests, "post", post)
+    wpp = WppMessage("instance-1", "token", "secret", redis=redis_client)
+
+    with pytest.raises(requests.Timeout):
+        wpp.send_message("Oi", "5511999990001")
+
+    assert calls == [(wpp_message.CONNECT_TIMEOUT, wpp_message.READ_TIMEOUT)]
+    assert float(redis_client.get(wpp.throttle.factor_key)) == 0.5
+
+
+def test_throttle_backs_off_and_recovers(redis_client):
+    throttle = SendThrottle(redis_client, "instance-1")
+
+    throttle.record(None)
+    assert throttle._state()[0] == 0.5
+
+    throttle.record(Response(429, {"Retry-After": "2"}))
+    factor, cooldown = throttle._state()
+    assert factor == 0.25
+    assert 0 < cooldown <= 2
+
+    throttle.record(Response(200))
+    assert throttle._state()[0] == pytest.approx(0.25 + throttle.recovery)
+
+
+def test_throttle_factor_has_a_floor(redis_client):
+    throttle = SendThrottle(redis_client, "instance-1")
+    for _ in range(10):
+        throttle.record(None)
+    assert throttle._state()[0] == throttle.min_factor
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from wpp.genai.stateful import MockResponsesBackend, StatefulTask, ToolRoundsExceeded
+
+
+SYSTEM = {"role": "system", "content": [{"type": "text", "text": "Você representa o segurado."}]}
+
+
+def call(name: str, **arguments) -> dict:
+    return {"type": "function_call", "call_id": f"call_{name}", "name": name, "arguments": json.dumps(arguments)}
+
+
+def message(text: str) -> dict:
+    return {"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": text}]}
+
+
+def turn(redis_client, backend, history, user, tools=(), **kwargs):
+    task = StatefulTask(redis_client, backend, "instance-1:5511999990001", "model", list(tools), history, user, **kwargs)
+    return task.run(), task.prompt
+
+
+def test_next_turn_only_sends_the_new_input(redis_client):
+    backend = MockResponsesBackend()
+
+    answer, history = turn(redis_client, backend, [SYSTEM], "Oi")
+    assert answer == "mock: Oi"
+    assert backend.requests[0]["previous_response_id"] is None
+
+    answer, history = turn(redis_client, backend, history, "Bateram no meu carro")
+
+    request = backend.requests[-1]
+    assert answer == "mock: Bateram no meu carro"
+    assert request["previous_response_id"] is not None
+    assert request["input"] == [{"role": "user", "content": "Bateram no meu carro"}]
+
+
+def test_changed_history_is_sent_in_full(redis_client):
+    backend = MockResponsesBackend()
+    _, history = turn(redis_client, backend, [SYSTEM], "Oi")
+
+    # The stored history no longer matches what the provider holds
+    history[-1]["content"][0]["text"] = "outra resposta"
+    turn(redis_client, backend, history, "E agora?")
+
+    request = backend.requests[-1]
+    assert request["previous_response_id"] is None
+    assert len(request["input"]) == 4
+
+
+def test_expired_remote_state_falls_back_to_the_full_history(redis_client):
+    backend = MockResponsesBackend()
+    _, history = turn(redis_client, backend, [SYSTEM], "Oi")
+    backend.expire()
+
+    answer, _ = turn(redis_client, backend, history, "Ainda está aí?")
+
+    expired, resent = backend.requests[-2:]
+    assert expired["previous_response_id"] is not None
+    assert resent["previous_response_id"] is None
+    assert resent["input"][-1] == {"role": "user", "content": "Ainda está aí?"}
+    assert answer == "mock: Ainda está aí?"
+
+
+def test_tool_calls_are_run_and_recorded(redis_client):
+    sent = []
+
+    def send_message(message: str, to: str):
+        """Sends a message.
+
+        Args:
+            message (str): Text
+            to (str): user or bot
+        """
+        sent.append((to, message))
+
+    def responder(chain, tools):
+        if chain[-1].get("type") == "function_call_output":
+            return [message("pronto")]
+        return [call("send_message", message="Olá", to="user")]
+
+    answer, history = turn(redis_client, MockResponsesBackend(responder), [SYSTEM], "Oi", [send_message])
+
+    assert answer == "pronto"
+    assert sent == [("user", "Olá")]
+    assert [entry["role"] for entry in history] == ["system", "user", "assistant", "tool", "assistant"]
+
+
+def noop():
+    """Does nothing."""
+
+
+def test_out_of_rounds_returns_the_last_text(redis_client):
+    rounds = []
+
+    def responder(chain, tools):
+        rounds.append(1)
+        return ([message("Vou verificar")] if len(rounds) == 1 else []) + [call("noop")]
+
+    answer, history = turn(redis_client, MockResponsesBackend(responder), [SYSTEM], "Oi", [noop], max_tool_rounds=3)
+
+    assert answer == "Vou verificar"
+    assert history[2]["content"] == [{"type": "text", "text": "Vou verificar"}]
+
+
+def test_out_of_rounds_without_text_raises(redis_client):
+    backend = MockResponsesBackend(lambda chain, tools: [call("noop")])
+
+    with pytest.raises(ToolRoundsExceeded):
+        turn(redis_client, backend, [SYSTEM], "Oi", [noop], max_tool_rounds=3)
+    assert len(backend.requests) == 3
@@ -0,0 +1,57 @@
+import pytest
+
+from wpp.ratelimit import RedisTokenBucket
+
+
+@pytest.fixture
+def bucket(redis_client):
+    # Refill slow enough that nothing comes back during a test
+    return RedisTokenBucket(redis_client, "bucket:test", capacity=5, rate=0.01)
+
+
+def test_burst_then_wait(bucket):
+    assert [bucket.try_acquire() for _ in range(5)] == [0.0] * 5
+
+    wait = bucket.try_acquire()
+    assert wait == pytest.approx(1 / bucket.rate, rel=0.05)
+
+
+def test_wait_covers_only_the_missing_tokens(bucket):
+    assert bucket.try_acquire(cost=4) == 0.0
+    assert bucket.try_acquire(cost=3) == pytest.approx(2 / bucket.rate, rel=0.05)
+
+
+def test_reserve_is_kept_for_higher_priority(bucket):
+    assert bucket.try_acquire(cost=3) == 0.0
+
+    # 2 tokens left: a caller that must leave 2 behind waits, one without a reserve does not
+    assert bucket.try_acquire(cost=1, reserve=2) > 0
+    assert bucket.try_acquire(cost=1, reserve=0) == 0.0
+
+
+def test_denied_request_takes_no_tokens(bucket):
+    assert bucket.try_acquire(cost=4) == 0.0
+    assert bucket.try_acquire(cost=1, reserve=1) > 0
+    assert bucket.try_acquire(cost=1) == 0.0
+
+
+def test_cost_above_capacity_is_granted_on_a_full_bucket(bucket):
+    assert bucket.try_acquire(cost=50) == 0.0
+    assert bucket.try_acquire() > 0
+
+
+def test_reserve_cannot_block_a_full_bucket(bucket):
+    assert bucket.try_acquire(cost=4, reserve=5) == 0.0
+
+
+def test_acquire_times_out(bucket):
+    bucket.try_acquire(cost=5)
+    assert not bucket.acquire(timeout=0.05)
+
+
+def test_redis_errors_fail_open(bucket, monkeypatch):
+    def broken(*args, **kwargs):
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(bucket, "script", broken)
+    assert bucket.try_acquire(cost=100) == 0.0
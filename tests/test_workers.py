@@ -0,0 +1,22 @@
+import math
+import os
+
+from wpp.workers import START_METHOD, MediaWorkerPool
+
+
+def test_workers_are_not_forked_from_the_app_process():
+    pool = MediaWorkerPool(max_workers=1)
+    try:
+        assert pool.submit(math.sqrt, 16).result(timeout=60) == 4
+        assert pool.executor._mp_context.get_start_method() == START_METHOD
+        assert START_METHOD in ("forkserver", "spawn")
+    finally:
+        pool.shutdown()
+
+
+def test_worker_runs_in_another_process():
+    pool = MediaWorkerPool(max_workers=1)
+    try:
+        assert pool.submit(os.getpid).result(timeout=60) != os.getpid()
+    finally:
+        pool.shutdown()
@@ -0,0 +1,218 @@
+"""
+Admission control at the webhook.
+
+Caps how much work a single phone number and the instance as a whole can
+start: each number (or bot conversation) has a Redis token bucket, turns
+being processed are tracked in a shared in-flight set that new messages are
+shed against, and agent <-> bot ping-pong (the same exchange repeating) is
+detected and cut off.
+"""
+
+import os
+import math
+import hashlib
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from wpp.metrics import Metrics
+from wpp.ratelimit import RedisTokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class Admission:
+    """Outcome of an admission check."""
+
+    ADMIT = "admit"
+    # Answer 429 with Retry-After
+    REJECT = "reject"
+    # Acknowledge and drop silently
+    DROP = "drop"
+    # Fold into the conversation's open buffered turn (bot messages cannot be retried or lost)
+    COALESCE = "coalesce"
+
+    def __init__(self, action: str, reason: Optional[str] = None, retry_after: float = 0) -> None:
+        self.action = action
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def admitted(self) -> bool:
+        return self.action == self.ADMIT
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class AdmissionController:
+    """
+    Per-number rate limit, global load shedding and loop detection.
+
+    Keys:
+        <ns>:number:<id>     token bucket of a phone number or bot conversation
+        <ns>:inflight        sorted set of turns being processed -> expiry time
+        <ns>:loop:<cid>        hash of agent/bot exchange -> times seen since the user last wrote
+        <ns>:loop:<cid>:agent  digest of the agent's last message to the bot
+        <ns>:notice:<id>     a rejected number was already told to wait
+    """
+
+    def __init__(self, redis: Any, namespace: str = "admission") -> None:
+        """
+        Initialize the controller.
+
+        Args:
+            redis: Redis client instance
+            namespace: Prefix for the Redis keys
+        """
+        self.redis = redis
+        self.namespace = namespace
+        self.metrics = Metrics(redis)
+
+        # Messages per second a number may sustain, and its burst
+        self.number_rate = float(os.getenv("ADMISSION_NUMBER_RATE", "0.2"))
+        self.number_burst = float(os.getenv("ADMISSION_NUMBER_BURST", "10"))
+
+        # Turns processed at once across every worker before new users are shed
+        self.max_inflight = int(os.getenv("ADMISSION_MAX_INFLIGHT", "100"))
+        self.inflight_ttl = int(os.getenv("ADMISSION_INFLIGHT_TTL", "120"))
+        self.retry_after = float(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+        # Times the same agent message / bot reply exchange may repeat without the user before it is a loop
+        self.loop_repeats = int(os.getenv("ADMISSION_LOOP_REPEATS", "3"))
+        self.loop_window = int(os.getenv("ADMISSION_LOOP_WINDOW", "300"))
+
+        self.inflight_key = f"{namespace}:inflight"
+
+    def _loop_key(self, conversation_id: str) -> str:
+        return f"{self.namespace}:loop:{conversation_id}"
+
+    def inflight(self) -> int:
+        """Number of turns currently being processed, stale entries excluded."""
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(self.inflight_key, "-inf", time.time())
+        pipe.zcard(self.inflight_key)
+        return int(pipe.execute()[1])
+
+    @staticmethod
+    def _digest(content: str) -> str:
+        return hashlib.sha1(" ".join(content.lower().split()).encode("utf-8")).hexdigest()[:16]
+
+    def record_agent_message(self, conversation_id: str, message: str) -> None:
+        """Remember the agent's last message to the bot; the bot's next reply forms an exchange with it."""
+        try:
+            self.redis.set(f"{self._loop_key(conversation_id)}:agent", self._digest(message), ex=self.loop_window)
+        except Exception as e:
+            logger.warning("Erro ao registrar mensagem do agente: %s", e)
+
+    def admit(
+        self,
+        bucket_id: str,
+        conversation_id: Optional[str] = None,
+        is_bot: bool = False,
+        content: str = "",
+    ) -> Admission:
+        """
+        Decide whether an incoming message may start work.
+
+        Args:
+            bucket_id: Rate-limited id: the user's phone, or the bot session of a conversation
+            conversation_id: Conversation the message belongs to, if known
+            is_bot: Whether the message comes from the customer-service bot
+            content: Content of a bot message, compared for loop detection
+
+        Returns:
+            Admission: What to do with the message
+        """
+        try:
+            if is_bot:
+                # Bot messages continue conversations already admitted: only loops are cut
+                if conversation_id and self._is_looping(conversation_id, content):
+                    return self._deny(Admission.DROP, "loop")
+            else:
+                if conversation_id:
+                    loop_key = self._loop_key(conversation_id)
+                    self.redis.delete(loop_key, f"{loop_key}:agent")
+
+                if self.inflight() >= self.max_inflight:
+                    return self._deny(Admission.REJECT, "overloaded", self.retry_after)
+
+            bucket = RedisTokenBucket(
+                self.redis, f"{self.namespace}:number:{bucket_id}", self.number_burst, self.number_rate
+            )
+            wait = bucket.try_acquire()
+            if wait > 0:
+                # The bot cannot retry and its replies must be answered: the webhook
+                # folds its excess messages into the buffered turn instead of a turn of their own
+                return self._deny(Admission.COALESCE if is_bot else Admission.REJECT, "rate_limited", wait)
+        except Exception as e:
+            # Admission must never take the webhook down with Redis
+            logger.warning("Erro no controle de admissão: %s", e)
+
+        return Admission(Admission.ADMIT)
+
+    def should_notify(self, bucket_id: str, retry_after: float = 0) -> bool:
+        """
+        Whether to tell a rejected number to wait; at most once per Retry-After window.
+
+        Args:
+            bucket_id: Rate-limited id the message was rejected under
+            retry_after: Seconds until the number may send again
+
+        Returns:
+            bool: True the first time in the window
+        """
+        try:
+            window = max(1, math.ceil(retry_after or self.retry_after))
+            return bool(self.redis.set(f"{self.namespace}:notice:{bucket_id}", "1", nx=True, ex=window))
+        except Exception as e:
+            logger.warning("Erro ao registrar aviso de admissão: %s", e)
+            return False
+
+    def _deny(self, action: str, reason: str, retry_after: float = 0) -> Admission:
+        self.metrics.incr(f"admission.{reason}")
+        return Admission(action, reason, retry_after)
+
+    def _is_looping(self, conversation_id: str, content: str) -> bool:
+        key = self._loop_key(conversation_id)
+
+        # A long negotiation sends many bot messages; a loop sends the same
+        # reply to the same agent message over and over
+        agent = self.redis.get(f"{key}:agent") or b""
+        if isinstance(agent, bytes):
+            agent = agent.decode("utf-8")
+        exchange = self._digest(f"{agent}\n{content}")
+
+        pipe = self.redis.pipeline()
+        pipe.hincrby(key, exchange, 1)
+        pipe.expire(key, self.loop_window)
+        count = int(pipe.execute()[0])
+
+        if count == self.loop_repeats + 1:
+            logger.warning(
+                "Conversation %s repeated the same exchange with the bot %s times, "
+                "dropping bot messages until the user writes again",
+                conversation_id, count,
+            )
+        return count > self.loop_repeats
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """Count a turn as in flight while the block runs."""
+        token = uuid.uuid4().hex
+
+        try:
+            self.redis.zadd(self.inflight_key, {token: time.time() + self.inflight_ttl})
+        except Exception as e:
+            logger.warning("Erro ao registrar processamento em andamento: %s", e)
+
+        try:
+            yield
+        finally:
+            try:
+                self.redis.zrem(self.inflight_key, token)
+            except Exception as e:
+                logger.warning("Erro ao remover processamento em andamento: %s", e)
@@ -1,15 +1,44 @@
+import os
 import requests
 
+from typing import Any, Optional
+
+from wpp.ratelimit import SendThrottle
 from wpp.schemas.wpp_message import OptionsList
 
+# Seconds to connect to Z-API and to wait for its answer; a hung connection must not pin a sender
+CONNECT_TIMEOUT = float(os.getenv("ZAPI_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("ZAPI_READ_TIMEOUT", "20"))
+
 class WppMessage:
-    def __init__(self, instance_id: str, instance_token: str, client_token: str):
+    def __init__(self, instance_id: str, instance_token: str, client_token: str, redis: Optional[Any] = None):
 
         self.root = "https://api.z-api.io/instances"
 
         self.headers = {"client-token": client_token}
         self.instance = f"{instance_id}/token/{instance_token}"
 
+        # With Redis, sends are rate limited per instance and per number
+        self.throttle = SendThrottle(redis, instance_id) if redis is not None else None
+
+    def _post(self, url: str, number: str, **kwargs) -> requests.Response:
+
+        if self.throttle:
+            self.throttle.acquire(number)
+
+        try:
+            response = requests.post(url, headers=self.headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+        except requests.Timeout:
+            # Counted as a failed send: the rate backs off as for a 5xx
+            if self.throttle:
+                self.throttle.record(None)
+            raise
+
+        if self.throttle:
+            self.throttle.record(response)
+
+        return response
+
     def send_message(self, message: str | list, number: str, message_id: str = "") -> dict:      
 
         url = f"{self.root}/{self.instance}/send-text"
@@ -17,14 +46,14 @@ class WppMessage:
         if isinstance(message, list):
             for msg in message:
                 payload = {"phone": number, "message": msg}
-                response = requests.post(url, data=payload, headers=self.headers)
+                response = self._post(url, number, data=payload)
         else:
             payload = {"phone": number, "message": message}
 
             if message_id:
                 payload["messageId"] = message_id
 
-            response = requests.post(url, data=payload, headers=self.headers)
+            response = self._post(url, number, data=payload)
 
         return response
 
@@ -37,7 +66,7 @@ class WppMessage:
         if message:
             payload["caption"] = message
 
-        response = requests.post(url, data=payload, headers=self.headers)
+        response = self._post(url, number, data=payload)
 
         return response
 
@@ -47,7 +76,7 @@ class WppMessage:
         url = f"{self.root}/{self.instance}/send-video"
         payload = {"phone": number, "video": video_url, "caption": caption}
 
-        response = requests.post(url, data=payload, headers=self.headers)
+        response = self._post(url, number, data=payload)
 
         return response
 
@@ -58,7 +87,7 @@ class WppMessage:
 
         payload = {"phone": number, "message": message, "optionList": options}
 
-        response = requests.post(url, json=payload, headers=self.headers)
+        response = self._post(url, number, json=payload)
         return response
     
     def send_buttons_list(
@@ -83,7 +112,7 @@ class WppMessage:
 
         payload = {"phone": number, "message": message, "buttonList": button_list}
 
-        response = requests.post(url, json=payload, headers=self.headers)
+        response = self._post(url, number, json=payload)
         return response
     
     def send_buttons_action(self, message: str, number: str, buttons: list[dict[str, str]]) -> dict:
@@ -101,7 +130,7 @@ class WppMessage:
             "buttonActions": buttons_action
         }
 
-        response = requests.post(url, json=payload, headers=self.headers)
+        response = self._post(url, number, json=payload)
         return response
     
     def send_pix_button(self, message: str, number: str) -> dict:
@@ -110,5 +139,5 @@ class WppMessage:
 
         payload = {"phone": number, "pixKey": message, "type": "EVP"}
 
-        response = requests.post(url, json=payload, headers=self.headers)
+        response = self._post(url, number, json=payload)
         return response
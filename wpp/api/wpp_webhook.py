@@ -1,22 +1,33 @@
-import requests
-import pdf2image
-import io
-import base64
+import os
+import json
 import logging
+import time
+import threading
 from datetime import datetime
 from typing import Optional
 
-from PIL import Image
-
 from repenseai.genai.agent import Agent
 from repenseai.genai.tasks.api import Task
 
 from wpp.schemas.wpp_webhook import WppPayload
 from wpp.api.wpp_message import WppMessage
 from wpp.memory import RedisManager
+from wpp.outbound import OutboundQueue
+from wpp.routing import ConversationRouter, BOT_PHONE, CLAIMED, WAITING
+from wpp.admission import AdmissionController
+from wpp.conversation import SharedConversation
+from wpp.prompt_store import PromptNotFound, PromptStore
 
-from wpp.genai.prompts.step1 import PROMPT
+from wpp.genai.prompts.step1 import PROMPT, PROMPT_DELTA, DELTA_INPUT
 from wpp.genai.prompts.step2 import PROMPT2
+from wpp.genai.cache import ResponseCache, prompt_version
+from wpp.genai.router import ModelRouter, FAST, STRONG
+from wpp.genai.resilience import TURN_BUDGET, CallPolicy, CircuitOpenError, ResilientCaller
+from wpp.genai.limiter import LLMGovernor, estimate_tokens, HIGH, NORMAL, LOW
+from wpp.genai.stateful import STATE_BACKEND, StatefulTask, get_backend
+from wpp.genai.menu_cache import MenuCache
+from wpp.media.audio import AudioTranscriber, AudioTooLargeError
+from wpp.media.handle import MediaHandle, count_media_pages, strip_media
 
 from pydantic import BaseModel
 
@@ -24,6 +35,25 @@ import redis
 
 logger = logging.getLogger(__name__)
 
+STEP1_PROMPT_VERSION = prompt_version(PROMPT, PROMPT_DELTA, DELTA_INPUT)
+
+# Media handles kept per conversation (see get_media_content)
+MAX_MEDIA_HANDLES = 20
+
+# Rendered images and PDF pages attached to a single model turn
+MAX_TURN_MEDIA_PAGES = int(os.getenv("MAX_TURN_MEDIA_PAGES", "10"))
+
+# Long PDFs are processed in windows and only their relevant pages reach
+# the model, so this only guards against absurd uploads
+MAX_DOCUMENT_PAGES = int(os.getenv("MAX_DOCUMENT_PAGES", "60"))
+
+# Notes shown with an attachment for its triage verdict (wpp.media.triage)
+TRIAGE_NOTES = {
+    "blank": " (em branco)",
+    "duplicate": " (repetida)",
+    "not_document": " (parece uma foto, não um documento)",
+}
+
 
 class ExtractedData(BaseModel):
     nome: str
@@ -49,11 +79,12 @@ class Step2Response(BaseModel):
 class UserWppWebhook:
     def __init__(
         self,
-        data: dict, 
+        data: dict | WppPayload, 
         redis_client: redis.Redis,
         wpp: WppMessage,
     ):
-        self.data = WppPayload(**data)
+        # Payloads already validated at ingestion are reused as they are
+        self.data = data if isinstance(data, WppPayload) else WppPayload.model_validate(data)
         self.wpp = wpp
 
         self.redis_client = redis_client
@@ -68,29 +99,51 @@ class UserWppWebhook:
         self.cache = None
         self.memory = {}
 
+        self.outbound = OutboundQueue(redis_client)
+        self.prompts = PromptStore(redis_client)
+
+        self.router = ConversationRouter(redis_client)
+        self.is_bot_event = self.router.is_bot(self.data.phone)
+        self.conversation = None
+
+        # Number of send_message tool calls made during the current turn
+        self.sent_in_turn = 0
+        self.turn_cancelled = False
+
+        # Sends recorded by the step 2 tools, flushed once when the turn ends
+        self.effects = []
+        # Set by the end_conversation tool: the bot channel is released on flush
+        self.conversation_finished = False
+        # Attachments asked for by the view_attachment tool, and whether the
+        # turn already runs with them in view
+        self.requested_media = []
+        self.media_shown = False
+        self.effects_lock = threading.Lock()
+
         self.memory_time = 3600
 
     def __build_memory(self):
-        self.cache = RedisManager(self.redis_client, self.data.phone)
+        # Bot messages belong to the session of the conversation holding the channel
+        if self.is_bot_event:
+            memory_id = self.router.session_key(self.conversation['id'])
+        else:
+            memory_id = self.data.phone
+
+        self.cache = RedisManager(self.redis_client, memory_id)
         self.memory = self.cache.get_memory_dict()
 
         self.memory['chat_history'] = self.memory.get('chat_history', [])
         self.memory['chat_history2'] = self.memory.get('chat_history2', [])
         
-        # Initialize shared conversation if not exists
-        if 'shared_conversation' not in self.memory:
-            self.memory['shared_conversation'] = {
-                'participants': {
-                    'user': self.data.phone if self.data.phone != "551130039303" else 'unknown',
-                    'customer_service': "551130039303",
-                    'agent': 'intermediary_agent'
-                },
-                'conversation_history': [],
-                'current_context': {
-                    'status': 'active',
-                    'last_speaker': None
-                }
-            }
+        # Load the shared conversation, converting the legacy dict format if needed
+        self.memory['shared_conversation'] = SharedConversation.from_dict(
+            self.memory.get('shared_conversation'),
+            participants={
+                'user': self.conversation['user_phone'] if self.is_bot_event else self.data.phone,
+                'customer_service': BOT_PHONE,
+                'agent': 'intermediary_agent'
+            },
+        )
 
         self.memory['step'] = self.memory.get('step', 1)
     
@@ -98,81 +151,17 @@ class UserWppWebhook:
         """Add a message to the shared conversation history with role tracking."""
         if 'shared_conversation' not in self.memory:
             return
-            
-        conversation_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'speaker_role': speaker_role,  # 'user', 'customer_service', or 'agent'
-            'speaker_phone': self.data.phone,
-            'message': message,
-            'message_type': message_type
-        }
-        
-        self.memory['shared_conversation']['conversation_history'].append(conversation_entry)
-        self.memory['shared_conversation']['current_context']['last_speaker'] = speaker_role
-        
-        # Keep conversation history manageable (last 50 messages)
-        if len(self.memory['shared_conversation']['conversation_history']) > 50:
-            self.memory['shared_conversation']['conversation_history'] = \
-                self.memory['shared_conversation']['conversation_history'][-50:]
+
+        # speaker_role: 'user', 'customer_service', or 'agent'
+        self.memory['shared_conversation'].add(message, speaker_role, self.data.phone, message_type)
     
     def __get_conversation_context_for_agent(self) -> str:
         """Get formatted conversation context for the agent to understand the full conversation."""
         if 'shared_conversation' not in self.memory:
             return ""
-            
-        shared_conv = self.memory['shared_conversation']
-        context_parts = []
-        
-        # Add participant info
-        participants = shared_conv.get('participants', {})
-        context_parts.append(f"PARTICIPANTES DA CONVERSA:")
-        context_parts.append(f"- Usuário: {participants.get('user', 'unknown')}")
-        context_parts.append(f"- Atendimento Porto Seguro: {participants.get('customer_service', 'unknown')}")
-        context_parts.append(f"- Agente Intermediário (você): {participants.get('agent', 'intermediary_agent')}")
-        
-        # Add current context and status
-        current_context = shared_conv.get('current_context', {})
-        context_parts.append(f"\nSTATUS DA CONVERSA: {current_context.get('status', 'active')}")
-        context_parts.append(f"ÚLTIMO A FALAR: {current_context.get('last_speaker', 'unknown')}")
-        
-        if current_context.get('user_request'):
-            context_parts.append(f"\nSOLICITAÇÃO ORIGINAL DO USUÁRIO:")
-            user_request = current_context['user_request']
-            if isinstance(user_request, dict):
-                for key, value in user_request.items():
-                    context_parts.append(f"- {key}: {value}")
-            else:
-                context_parts.append(f"- {user_request}")
-        
-        # Add conversation flow summary
-        history = shared_conv.get('conversation_history', [])
-        if history:
-            context_parts.append(f"\nRESUMO DA CONVERSA ({len(history)} mensagens trocadas):")
-            
-            # Count messages by speaker
-            user_msgs = len([h for h in history if h.get('speaker_role') == 'user'])
-            cs_msgs = len([h for h in history if h.get('speaker_role') == 'customer_service'])
-            agent_msgs = len([h for h in history if h.get('speaker_role') == 'agent'])
-            
-            context_parts.append(f"- Mensagens do usuário: {user_msgs}")
-            context_parts.append(f"- Mensagens do atendimento: {cs_msgs}")
-            context_parts.append(f"- Suas mensagens como agente: {agent_msgs}")
-            
-            context_parts.append(f"\nÚLTIMAS 10 MENSAGENS:")
-            for entry in history[-10:]:  # Show last 10 messages
-                speaker = entry.get('speaker_role', 'unknown')
-                message = entry.get('message', '')
-                timestamp = entry.get('timestamp', '')
-                context_parts.append(f"[{timestamp[-8:-3] if timestamp else ''}] {speaker.upper()}: {message}")
-        
-        # Add next steps suggestion
-        context_parts.append(f"\nSUA FUNÇÃO COMO AGENTE INTERMEDIÁRIO:")
-        context_parts.append(f"- Facilitar a comunicação entre o usuário e o atendimento Porto Seguro")
-        context_parts.append(f"- Traduzir/clarificar mensagens quando necessário")
-        context_parts.append(f"- Manter o contexto da conversa para ambas as partes")
-        context_parts.append(f"- Usar as ferramentas send_message(message, to='user') ou send_message(message, to='bot')")
-        
-        return "\n".join(context_parts)
+
+        # Rendered once per change and cached with the conversation
+        return self.memory['shared_conversation'].render()
         
     def __get_text_input(self):
         if self.data.text and self.data.text.message:
@@ -184,38 +173,30 @@ class UserWppWebhook:
             return {
                 "image": self.data.image.imageUrl or "",
                 "text": self.data.image.caption or "",
+                "thumbnail": self.data.image.thumbnailUrl or "",
             }
         return {"text": ""}
 
     def __get_audio_input(self):
         if not self.data.audio or not self.data.audio.audioUrl:
             return {"text": ""}
-            
-        audio_selector = Agent(
-            model="whisper-1", 
-            model_type="audio", 
-        )
-
-        audio_task = Task(
-            agent=audio_selector,
-        )
 
         try:
-            audio = requests.get(self.data.audio.audioUrl).content
-            transcription = audio_task.run({"audio": audio})
+            transcriber = AudioTranscriber(self.redis_client)
+            transcription = transcriber.transcribe(
+                self.data.audio.audioUrl,
+                seconds=self.data.audio.seconds or 0,
+            )
 
-            if isinstance(transcription, dict):
-                return {
-                    "text": transcription.get("response", ""), 
-                    "audio_response": transcription
-                }
-            else:
-                return {
-                    "text": str(transcription), 
-                    "audio_response": transcription
-                }
+            return {
+                "text": transcription,
+                "audio_response": transcription
+            }
+        except AudioTooLargeError as e:
+            logger.warning("Audio rejected for %s: %s", self.data.phone, e)
+            return {"text": ""}
         except Exception as e:
-            logger.error(f"Error processing audio: {e}")
+            logger.error("Error processing audio: %s", e)
             return {"text": ""}
     
     def __get_video_input(self):
@@ -235,6 +216,7 @@ class UserWppWebhook:
                 "page_count": self.data.document.pageCount or 0,
                 "mime_type": self.data.document.mimeType or "",
                 "title": self.data.document.title or "",
+                "thumbnail": self.data.document.thumbnailUrl or "",
             }
         return {"text": ""}
     
@@ -399,7 +381,7 @@ class UserWppWebhook:
                         text_parts.extend(fallback_text_sources)
                 
             except Exception as e:
-                logger.error(f"Error in fallback extraction: {e}")
+                logger.error("Error in fallback extraction: %s", e)
             
             # Combine all parts into single text field
             full_text = " | ".join(text_parts) if text_parts else ""
@@ -408,8 +390,16 @@ class UserWppWebhook:
             if not full_text:
                 full_text = f"Mensagem interativa (tipo: {self.data.interactive.type})"
             
+            # The message itself, without the button ids embedded in text
+            body_parts = [
+                part.text
+                for part in (self.data.interactive.header, self.data.interactive.body)
+                if part and part.text
+            ]
+
             interactive_data = {
                 "text": full_text,
+                "body": " ".join(body_parts),
                 "interactive_type": self.data.interactive.type or "",
                 "message_type": "interactive_incoming",
                 "buttons": [],
@@ -479,6 +469,8 @@ class UserWppWebhook:
             
             return {
                 "text": full_text,
+                # The message itself, without the option ids embedded in text
+                "body": self.data.listMessage.description or "",
                 "message_type": "list_message_incoming",
                 "sections": [
                     {
@@ -513,36 +505,196 @@ class UserWppWebhook:
             "text": ""
         }
 
-    def __get_user_input(self):
+    # Input extractor of each message type, built once with the class
+    _INPUT_HANDLERS = {
+        "text": __get_text_input,
+        "image": __get_image_input,
+        "audio": __get_audio_input,
+        "video": __get_video_input,
+        "document": __get_document_input,
+        "location": __get_location_input,
+        "contact": __get_contact_input,
+        "payment": __get_payment_input,
+        "buttonsResponseMessage": __get_button_list_input,
+        "buttonReply": __get_button_action_input,
+        "interactive": __get_interactive_input,
+        "listMessage": __get_list_message_input,
+        "reaction": __get_reaction_input,
+    }
 
-        types_dict = {
-            "text": self.__get_text_input,
-            "image": self.__get_image_input,
-            "audio": self.__get_audio_input,
-            "video": self.__get_video_input,
-            "document": self.__get_document_input,
-            "location": self.__get_location_input,
-            "contact": self.__get_contact_input,
-            "payment": self.__get_payment_input,
-            "buttonsResponseMessage": self.__get_button_list_input,
-            "buttonReply": self.__get_button_action_input,
-            "interactive": self.__get_interactive_input,
-            "listMessage": self.__get_list_message_input,
-            "reaction": self.__get_reaction_input,
-        }
+    def __get_user_input(self):
 
-        input_function = types_dict.get(
+        input_function = self._INPUT_HANDLERS.get(
             self.message_type,
-            self.__default_message
+            UserWppWebhook.__default_message
         )
 
-        return input_function()   
+        return input_function(self)   
+
+    def __add_media_handle(self) -> Optional[MediaHandle]:
+        """Keep a lazy handle to the media of the current message; nothing is fetched here."""
+        handle = MediaHandle.from_input(self.user_input or {})
+
+        if handle:
+            media = self.memory.get('media', [])
+            self.memory['media_count'] = handle.number = self.memory.get('media_count', 0) + 1
+            media.append(handle.model_dump())
+            self.memory['media'] = media[-MAX_MEDIA_HANDLES:]
+
+        return handle
+
+    def get_media_content(self, index: int = -1, query: Optional[str] = None) -> list[str]:
+        """
+        Render a media handle from memory as JPEG data URLs (see view_attachment).
+
+        Args:
+            index: Position in memory['media'], the latest attachment by default
+            query: What to look for in long PDFs. Defaults to the extracted "problema"
+
+        Returns:
+            list[str]: One base64 data URL per relevant page (a single one for images)
+        """
+        media = self.memory.get('media', [])
+        if not media:
+            return []
+
+        if query is None:
+            extracted = self.memory.get('data') or self.memory.get('extracted_data') or {}
+            query = extracted.get('problema', '') if isinstance(extracted, dict) else ''
+
+        if index < 0:
+            index += len(media)
+
+        # Near-duplicates are only looked for among this conversation's earlier attachments
+        known_phashes = [stored['phash'] for stored in media[:index] if stored.get('phash')]
+
+        handle = MediaHandle(**media[index])
+        pages = handle.render(self.redis_client, query, known_phashes)
+
+        # Keep the content hash so later renders skip the URL lookup
+        media[index] = handle.model_dump()
+        return pages
+
+    def __announce_pending_media(self) -> str:
+        """
+        Tell the model about the attachments it has not heard of yet.
+
+        Only a text note goes with the turn; the content is downloaded and
+        rendered when the step asks for it (view_attachment).
+
+        Returns:
+            str: One note per new attachment, empty if there is none
+        """
+        notes = []
+
+        for stored in self.memory.get('media', []):
+            if stored.get('announced'):
+                continue
+
+            stored['announced'] = True
+            if stored['kind'] == 'pdf':
+                notes.append(
+                    f"[Anexo {stored['number']}: documento {stored.get('file_name') or 'documento.pdf'}"
+                    f" ({stored.get('page_count') or 0} páginas)]"
+                )
+            else:
+                notes.append(f"[Anexo {stored['number']}: imagem]")
+
+        return "\n".join(notes)
+
+    def __render_media(self, numbers: list[int], query: str = "") -> Optional[dict]:
+        """
+        Render the attachments the step asked to see.
+
+        The pages go with the current turn only: the histories kept in
+        memory are stored through strip_media.
+
+        Args:
+            numbers: Attachment numbers requested through view_attachment
+            query: What the turn is about, used to pick the relevant pages of long PDFs
+
+        Returns:
+            dict: A user message with a note per attachment followed by its
+            pages, or None if none of them is known
+        """
+        media = self.memory.get('media', [])
+        content = []
+        pages_left = MAX_TURN_MEDIA_PAGES
+
+        for index, stored in enumerate(media):
+            if stored.get('number') not in numbers:
+                continue
+
+            # Past the cap the note still says the attachment could not be shown
+            pages = []
+            if pages_left > 0:
+                try:
+                    pages = self.get_media_content(index, query)[:pages_left]
+                except Exception as e:
+                    logger.warning("Could not render media for %s: %s", self.data.phone, e)
+
+            pages_left -= len(pages)
+
+            triage = media[index].get('triage')
+            if media[index]['kind'] == 'pdf':
+                note = f"[Anexo {stored['number']}: {media[index].get('file_name') or 'documento.pdf'}"
+
+                # Long documents only bring their relevant pages: say which ones
+                selected = (media[index].get('pages') or [])[:len(pages)]
+                page_count = media[index].get('page_count') or 0
+                if pages and len(selected) < page_count:
+                    note += f", páginas {', '.join(str(page) for page in selected)} de {page_count}"
+                note += "]"
+            else:
+                note = f"[Anexo {stored['number']}: imagem]"
+            if triage in TRIAGE_NOTES:
+                note += TRIAGE_NOTES[triage]
+            elif not pages:
+                note += " (não foi possível abrir o arquivo)"
+
+            content.append({"type": "text", "text": note})
+            content.extend({"type": "image_url", "image_url": {"url": page}} for page in pages)
+
+        if not content:
+            return None
+
+        self.memory['media'] = media
+        return {"role": "user", "content": content}
+
+    def record_media(self) -> Optional[str]:
+        """
+        Record the attachment of an image or document message without a model turn.
+
+        Used when the message is buffered together with text that is processed
+        as a single turn: that turn tells the model about the attachment.
+
+        Returns:
+            str: A message for the user if the document was refused, otherwise None
+        """
+        if self.message_type not in ("image", "document"):
+            return None
+
+        if self.is_bot_event:
+            self.conversation = self.router.resolve(self.data.instanceId, self.data.phone)
+            if not self.conversation:
+                return None
+
+        self.__build_memory()
+        self.user_input = self.__get_user_input()
+
+        if self.message_type == "image":
+            self.__format_image_history()
+            return None
+
+        return self.__format_document_history()
 
     def __format_image_history(self):
-        # Store image messages as simple text in chat history
-        # The actual image processing happens in real-time, not from history
+        # Store image messages as simple text in chat history; the image
+        # itself is only rendered when a step asks for it (view_attachment)
         if self.user_input:
             image_caption = self.user_input.get("text", "")
+
+            self.__add_media_handle()
             
             content = {
                 "role": "user",
@@ -557,47 +709,6 @@ class UserWppWebhook:
             if self.cache:
                 self.cache.set_memory_dict(self.memory, self.memory_time)
 
-    @staticmethod
-    def __process_image(image: Image.Image) -> str:
-        # Convert to RGB if image is in RGBA mode
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
-        
-        # Initial quality and size parameters
-        quality = 90
-        max_size = (1024, 1024)
-        img_byte_arr = io.BytesIO()
-        
-        # First try: compress with JPEG and quality
-        image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        image.save(img_byte_arr, format="JPEG", quality=quality, optimize=True)
-
-        img_size = img_byte_arr.tell()
-        
-        # If still too large, reduce quality until acceptable
-        while img_size > 1048576 and quality > 30:
-            img_byte_arr = io.BytesIO()
-            quality -= 30
-            image.save(img_byte_arr, format="JPEG", quality=quality, optimize=True)
-            img_size = img_byte_arr.tell()
-        
-        # If still too large after quality reduction, reduce dimensions
-        size = 1024
-
-        while img_size > 1048576 and size > 64:
-            size = int(size * 0.75)
-            max_size = (size, size)
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format="JPEG", quality=quality, optimize=True)
-            img_size = img_byte_arr.tell()
-        
-        img_byte_arr = img_byte_arr.getvalue()
-        image_string = base64.b64encode(img_byte_arr).decode("utf-8")
-        
-        return f"data:image/jpeg;base64,{image_string}"
-
     def __format_document_history(self):
         if not self.user_input:
             return None
@@ -609,55 +720,155 @@ class UserWppWebhook:
             page_count = self.user_input.get("page_count", 0)
             if isinstance(page_count, str):
                 page_count = int(page_count) if page_count.isdigit() else 0
-            if page_count > 10:
-                return "O documento excede o limite de 10 páginas"
-            
-            try:
-                pdf = requests.get(self.user_input['document'], stream=True)
-                images = pdf2image.convert_from_bytes(pdf.content)
+            if page_count > MAX_DOCUMENT_PAGES:
+                return f"O documento excede o limite de {MAX_DOCUMENT_PAGES} páginas"
 
-                for image in images:
-                    image_string = self.__process_image(image)
-                    self.user_input['image'] = image_string
-                    self.__format_image_history()
-            except Exception as e:
-                logger.error(f"Error processing PDF: {e}")
-                return "Erro ao processar o documento PDF"
+            # The PDF is only downloaded and rasterized when a step asks
+            # for it (view_attachment)
+            self.__add_media_handle()
+
+            document_caption = self.user_input.get("text", "")
+            file_name = self.user_input.get("file_name", "") or "documento.pdf"
+
+            content = {
+                "role": "user",
+                "content": f"[Documento enviado: {file_name} ({page_count} páginas)]{': ' + document_caption if document_caption else ''}"
+            }
+
+            if self.memory.get("chat_history"):
+                self.memory['chat_history'].append(content)
+            else:
+                self.memory['chat_history'] = [content]
+
+            if self.cache:
+                self.cache.set_memory_dict(self.memory, self.memory_time)
         else:
             return "São suportados apenas documentos em PDF ou imagens"
 
-    def __process_step1(self):
-        agent = Agent(
-            model="gpt-4.1",
-            model_type="chat",
-            json_schema=Step1Response,
-        )
+    def __get_step1_slots(self) -> dict:
+        """Return the partially filled ExtractedData kept in memory across step 1 turns."""
+        slots = {field: "" for field in ExtractedData.model_fields}
+        stored = self.memory.get('extracted_data')
 
-        history = self.memory.get('chat_history', [])
+        if isinstance(stored, dict):
+            slots.update({k: v for k, v in stored.items() if k in slots and v})
 
-        if not history:
-            history = [
-                {
-                    "role": "system",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": PROMPT
-                        }
-                    ]
-                }
-            ]
+        return slots
 
-            self.memory['chat_history'] = history
+    def __merge_step1_slots(self, extracted: Optional[dict]) -> dict:
+        """Merge the fields returned by the model into the stored slots, never erasing a filled one."""
+        slots = self.__get_step1_slots()
 
-        task = Task(
-            user=self.user_input.get('text', '') if self.user_input else '',
-            history=history,
-            agent=agent,
-            simple_response=True,
-        )
+        if isinstance(extracted, dict):
+            for key, value in extracted.items():
+                if key in slots and value:
+                    slots[key] = value
 
-        response = task.run()
+        self.memory['extracted_data'] = slots
+        return slots
+
+    def __get_last_assistant_message(self) -> str:
+        for entry in reversed(self.memory.get('chat_history', [])):
+            if entry.get('role') != 'assistant':
+                continue
+
+            content = entry.get('content', '')
+            if isinstance(content, list):
+                return " ".join(part.get('text', '') for part in content if isinstance(part, dict))
+            return str(content)
+
+        return ""
+
+    def __process_step1(self):
+        # Only the current slots and the new text are sent, so the prompt size
+        # stays constant instead of growing with the whole dialogue.
+        history = [
+            {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": PROMPT + PROMPT_DELTA
+                    }
+                ]
+            }
+        ]
+
+        user_text = self.user_input.get('text', '') if self.user_input else ''
+        slots = self.__get_step1_slots()
+        last_message = self.__get_last_assistant_message()
+
+        # The response cache only serves turns without conversation-specific state
+        # (first contact greetings and generic questions)
+        cache = None
+        cache_key = None
+        if not any(slots.values()) and not last_message:
+            cache = ResponseCache(self.redis_client, "step1_cache")
+            cache_key = cache.make_key(STEP1_PROMPT_VERSION, [slots, last_message], user_text)
+
+        response = cache.get(cache_key) if cache else None
+
+        if response is None:
+            delta_input = DELTA_INPUT.format(
+                slots=json.dumps(slots, ensure_ascii=False),
+                last_message=last_message,
+                text=user_text,
+            )
+
+            router = ModelRouter(self.redis_client)
+            tier = router.classify_step1(self.message_type, user_text, slots)
+
+            # Escalation shares the turn's deadline instead of starting a new one
+            deadline = time.monotonic() + TURN_BUDGET
+
+            while True:
+                # Attempts and hedged requests each get their own Task
+                def make_task(model=router.model_for(tier)):
+                    return Task(
+                        user=delta_input,
+                        history=list(history),
+                        agent=Agent(
+                            model=model,
+                            model_type="chat",
+                            json_schema=Step1Response,
+                        ),
+                        simple_response=True,
+                    )
+
+                policy = CallPolicy(f"step1.{tier}", hedge=True).within(deadline)
+
+                start = time.perf_counter()
+                try:
+                    tokens = estimate_tokens(history, delta_input)
+                    with LLMGovernor(self.redis_client).slot(LOW, tokens):
+                        response = ResilientCaller(policy).call_task(make_task)
+                except (TimeoutError, CircuitOpenError) as e:
+                    # Out of time or capacity: the strong tier would not do better
+                    logger.error("Step 1 model call failed for %s: %r", self.data.phone, e)
+                    response = None
+                    break
+                except Exception as e:
+                    logger.error("Step 1 model call failed for %s: %r", self.data.phone, e)
+                    response = None
+                finally:
+                    router.record_latency("step1", tier, time.perf_counter() - start)
+
+                if tier == FAST and router.needs_escalation(response, Step1Response):
+                    logger.info("Escalating step 1 turn for %s to the strong tier", self.data.phone)
+                    tier = STRONG
+                    continue
+
+                break
+
+            if (
+                cache
+                and isinstance(response, dict)
+                and response.get('validation_status') in ('follow-up', 'error')
+                and not any((response.get('extracted_data') or {}).values())
+            ):
+                cache.set(cache_key, response)
+        else:
+            logger.info("Step 1 response served from cache for %s", self.data.phone)
 
         # Handle None response or missing output
         if not response:
@@ -666,6 +877,9 @@ class UserWppWebhook:
                 "message": "Ocorreu um erro interno. Por favor, tente novamente."
             }
 
+        # chat_history is kept as the conversation transcript; it is no longer replayed to the model
+        self.memory['chat_history'] = self.memory.get('chat_history', [])
+
         if self.user_input:
             self.memory['chat_history'].append(
                 {
@@ -673,7 +887,7 @@ class UserWppWebhook:
                     "content": [
                         {
                             "type": "text",
-                            "text": self.user_input.get('text', '')
+                            "text": user_text
                         }
                     ]
                 },
@@ -681,6 +895,7 @@ class UserWppWebhook:
 
         if isinstance(response, dict):
             message_text = response.get('mensagem', '')
+            response['extracted_data'] = self.__merge_step1_slots(response.get('extracted_data'))
         else:
             message_text = ''
 
@@ -701,34 +916,60 @@ class UserWppWebhook:
 
         return response
 
-    def __process_step2(self, data: Optional[dict] = None):
-        agent = Agent(
-            model="gpt-4.1",
-            model_type="chat",
-            tools=[self.send_message]
-        )
+    def __get_step2_system_message(self) -> dict:
+        # Enhanced system prompt with conversation context. The static
+        # prompt is its own part, so it is stored once for every conversation
+        conversation_context = self.__get_conversation_context_for_agent()
+
+        system_content = [
+            {
+                "type": "text",
+                "text": PROMPT2
+            }
+        ]
+        if conversation_context:
+            system_content.append(
+                {
+                    "type": "text",
+                    "text": f"\n\n# CONTEXTO DA CONVERSA ATUAL\n{conversation_context}"
+                }
+            )
 
-        history = self.memory.get('chat_history2', [])
+        return {
+            "role": "system",
+            "content": system_content
+        }
+
+    def __rebuild_step2_history(self, stored: list, lost: list) -> list:
+        # Keeps the turns that can still be read and puts a fresh system prompt in front
+        lost = set(lost)
+
+        def readable(message) -> bool:
+            content = message.get("content") if isinstance(message, dict) else None
+            return not isinstance(content, list) or not any(
+                isinstance(part, dict) and part.get("ref") in lost for part in content
+            )
+
+        turns = [
+            message for message in stored
+            if readable(message) and not (isinstance(message, dict) and message.get("role") == "system")
+        ]
+        history = [self.__get_step2_system_message()] + self.prompts.hydrate(turns)
+
+        self.memory['chat_history2'] = self.prompts.dehydrate(history)
+        return history
+
+    def __process_step2(self, data: Optional[dict] = None):
+        # Memory keeps references to the large prompt blocks (wpp.prompt_store)
+        stored = self.memory.get('chat_history2', [])
+        try:
+            history = self.prompts.hydrate(stored)
+        except PromptNotFound as e:
+            logger.warning("Rebuilding step 2 system prompt for %s: %s", self.data.phone, e)
+            history = self.__rebuild_step2_history(stored, e.digests)
 
         if not history:
-            # Enhanced system prompt with conversation context
-            conversation_context = self.__get_conversation_context_for_agent()
-            
-            enhanced_prompt = PROMPT2
-            if conversation_context:
-                enhanced_prompt += f"\n\n# CONTEXTO DA CONVERSA ATUAL\n{conversation_context}"
-            
-            history = [
-                {
-                    "role": "system",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": enhanced_prompt
-                        }
-                    ]
-                },               
-            ]
+            history = [self.__get_step2_system_message()]
 
             if data:
                 history.append(
@@ -743,18 +984,33 @@ class UserWppWebhook:
                     }
                 )
 
-            self.memory['chat_history2'] = history
+            self.memory['chat_history2'] = self.prompts.dehydrate(history)
 
-        task = Task(
-            user=self.user_input.get('text', '') if self.user_input else '',
-            history=history,
-            agent=agent,
-            simple_response=True,
-        )
+        user_text = self.user_input.get('text', '') if self.user_input else ''
+
+        # Known bot menus are answered from the choices learned in earlier conversations
+        menu_cache = None
+        problema = (self.memory.get('data') or {}).get('problema', '')
+
+        if self.is_bot_event and self.message_type in ("listMessage", "interactive"):
+            menu_cache = MenuCache(self.redis_client)
+            choice = menu_cache.lookup(self.user_input, problema)
+
+            if choice:
+                logger.info("Answering known bot menu for %s with: %s", self.data.phone, choice)
+                self.send_message(choice, "bot")
+
+                history = history + [
+                    {"role": "user", "content": [{"type": "text", "text": user_text}]},
+                    {"role": "assistant", "content": [{"type": "text", "text": f"[Opção enviada ao atendimento: {choice}]"}]},
+                ]
+                self.memory['chat_history2'] = self.prompts.dehydrate(history)
+                self.__flush_effects()
+
+                return choice
 
         # Determine event source more accurately
-        is_bot_event = self.data.phone == "551130039303"
-        event_source = "bot" if is_bot_event else "user"
+        event_source = "bot" if self.is_bot_event else "user"
         
         # Add conversation context to help the AI understand the flow
         conversation_context = {
@@ -764,11 +1020,106 @@ class UserWppWebhook:
             "conversation_id": self.memory.get('conversation_id', f"user_{self.data.phone}_conversation"),
             "current_step": self.memory.get('step', 2)
         }
-        
-        response = task.run(conversation_context)
+
+        # New attachments are announced; their content is only rendered if
+        # the model asks for it, and then only for this turn's input
+        turn_text = "\n".join(text for text in (self.__announce_pending_media(), user_text) if text)
+        media_pages = 0
+        turn_history = history
+
+        tools = [self.send_message, self.end_conversation]
+        if self.memory.get('media'):
+            tools.append(self.view_attachment)
+
+        router = ModelRouter(self.redis_client)
+        tier = router.classify_step2(event_source, self.message_type, user_text)
+
+        # Bot-side turns keep a live Porto Seguro session from timing out
+        priority = HIGH if self.is_bot_event else NORMAL
+
+        # Escalation shares the turn's deadline instead of starting a new one
+        deadline = time.monotonic() + TURN_BUDGET
+
+        while True:
+            if STATE_BACKEND == "local":
+                agent = Agent(
+                    model=router.model_for(tier),
+                    model_type="chat",
+                    tools=tools
+                )
+
+                task = Task(
+                    user=turn_text,
+                    history=list(turn_history),
+                    agent=agent,
+                    simple_response=True,
+                )
+            else:
+                # The provider keeps the conversation: only the new input and
+                # tool results are uploaded, chat_history2 stays the source of truth
+                task = StatefulTask(
+                    self.redis_client,
+                    get_backend(),
+                    self.memory.get('conversation_id', self.data.phone),
+                    router.model_for(tier),
+                    tools,
+                    list(turn_history),
+                    turn_text,
+                )
+
+            sent_before = self.sent_in_turn
+
+            # Step 2 calls have side effects (send_message), so they are never
+            # hedged or retried; only the deadline and the breaker apply
+            policy = CallPolicy(f"step2.{tier}", retries=0, hedge=False).within(deadline)
+
+            start = time.perf_counter()
+            try:
+                tokens = estimate_tokens(strip_media(turn_history), turn_text, images=media_pages)
+                with LLMGovernor(self.redis_client).slot(priority, tokens):
+                    response = ResilientCaller(policy).call(task.run, conversation_context)
+            except (TimeoutError, CircuitOpenError) as e:
+                # Out of time or capacity: the strong tier would not do better
+                logger.error("Step 2 model call failed for %s: %r", self.data.phone, e)
+                response = None
+
+                # A timed-out call keeps running in its thread; stop it from sending late messages
+                with self.effects_lock:
+                    self.turn_cancelled = True
+            except Exception as e:
+                logger.error("Step 2 model call failed for %s: %r", self.data.phone, e)
+                response = None
+            finally:
+                router.record_latency("step2", tier, time.perf_counter() - start)
+
+            if self.turn_cancelled:
+                break
+
+            # The model asked to see attachments: the turn runs again with them in view
+            if self.requested_media and not self.media_shown:
+                with self.effects_lock:
+                    self.media_shown = True
+
+                media_message = self.__render_media(self.requested_media, problema or user_text)
+                if media_message:
+                    media_pages = count_media_pages([media_message])
+                    turn_history = history + [media_message]
+                    continue
+
+            # Only escalate when the fast model did not send anything yet, otherwise
+            # the strong model would repeat messages already recorded
+            if tier == FAST and self.sent_in_turn == sent_before and router.needs_escalation(response):
+                logger.info("Escalating step 2 turn for %s to the strong tier", self.data.phone)
+                tier = STRONG
+                continue
+
+            break
 
         # Handle None response or missing output
         if not response:
+            # Messages sent before the failure still go out
+            self.__flush_effects()
+
             return {
                 "type": "message", 
                 "message": "Ocorreu um erro interno. Por favor, tente novamente."
@@ -776,7 +1127,7 @@ class UserWppWebhook:
 
         # Update chat_history2 with the updated prompt, but preserve the existing structure
         if hasattr(task, 'prompt') and task.prompt:
-            self.memory['chat_history2'] = task.prompt
+            self.memory['chat_history2'] = self.prompts.dehydrate(strip_media(task.prompt))
         else:
             # Fallback: Add the user input to the existing history if task.prompt is not available
             if self.user_input and self.user_input.get('text'):
@@ -789,34 +1140,46 @@ class UserWppWebhook:
                         }
                     ]
                 })
+
+        # Learn the option the model picked for this menu
+        if menu_cache is not None:
+            bot_phone = self.memory.get('bot_phone', BOT_PHONE)
+            bot_sends = [effect for effect in self.effects if effect["number"] == bot_phone]
+
+            if len(bot_sends) == 1:
+                menu_cache.learn(self.user_input, problema, bot_sends[0]["message"])
         
-        # Sync shared conversation data after step2 processing
-        self.__sync_shared_conversation()
+        # Persist the turn and hand its sends to the outbound queue, once
+        self.__flush_effects()
 
         return response
 
     def _process_wpp_message(self):
+        if self.is_bot_event:
+            self.conversation = self.router.resolve(self.data.instanceId, self.data.phone)
+
+            if not self.conversation:
+                logger.warning("Bot message %s does not belong to any active conversation", self.data.messageId)
+                return None
+
         self.__build_memory()
         
         # Log raw event from z-api
-        logger.info(f"Raw Z-API event from {self.data.phone}: {self.data}")
+        logger.info("Raw Z-API event from %s: %s", self.data.phone, self.data, extra={"event": "zapi.raw_event"})
         
         # Add conversation context to memory for better routing
         if 'conversation_id' not in self.memory:
-            if self.data.phone == "551130039303":
-                # This is a bot message, try to find the original user
-                original_user = self.memory.get('user_phone', 'unknown')
-                self.memory['conversation_id'] = f"user_{original_user}_bot_551130039303"
+            if self.is_bot_event:
+                self.memory['conversation_id'] = self.conversation['id']
             else:
-                # This is a user message
-                self.memory['conversation_id'] = f"user_{self.data.phone}_bot_551130039303"
+                self.memory['conversation_id'] = ConversationRouter.conversation_id(self.data.phone, self.data.instanceId)
         
         self.user_input = self.__get_user_input()
         
         # Track the incoming message in shared conversation
         if self.user_input and self.user_input.get('text'):
             # Determine speaker role based on phone number
-            if self.data.phone == "551130039303":
+            if self.is_bot_event:
                 speaker_role = "customer_service"
             else:
                 speaker_role = "user"
@@ -987,27 +1350,20 @@ class UserWppWebhook:
                     self.memory['data'] = step1_response.get('extracted_data')
 
                     self.memory['user_phone'] = self.data.phone
-                    self.memory['bot_phone'] = "551130039303" # 551130039303, 5519999872145
-                    
-                    # Create shared conversation ID for tracking
-                    conversation_id = f"conversation_{self.data.phone}_to_551130039303"
+                    self.memory['bot_phone'] = BOT_PHONE
+
+                    # Each delegated conversation gets its own bot-side session
+                    conversation_id = ConversationRouter.conversation_id(self.data.phone, self.data.instanceId)
                     self.memory['conversation_id'] = conversation_id
+                    self.memory['bot_session'] = ConversationRouter.session_key(conversation_id)
 
-                    # Initialize shared conversation history with role-based tracking
-                    if 'shared_conversation' not in self.memory:
-                        self.memory['shared_conversation'] = {
-                            'participants': {
-                                'user': self.data.phone,
-                                'customer_service': "551130039303", 
-                                'agent': 'intermediary_agent'
-                            },
-                            'conversation_history': [],
-                            'current_context': {
-                                'user_request': step1_response.get('extracted_data'),
-                                'status': 'initiated',
-                                'last_speaker': 'user'
-                            }
-                        }
+                    # Record the user's request in the shared conversation the agent will see
+                    shared_conversation = self.memory['shared_conversation']
+                    if not shared_conversation.current_context.get('user_request'):
+                        shared_conversation.update_context(
+                            user_request=step1_response.get('extracted_data'),
+                            status='initiated',
+                        )
 
                     # Save updated memory to user's context
                     if self.cache:
@@ -1018,23 +1374,41 @@ class UserWppWebhook:
                         'step': 2,
                         'data': step1_response.get('extracted_data'),
                         'user_phone': self.data.phone,
-                        'bot_phone': "551130039303",
+                        'bot_phone': BOT_PHONE,
                         'conversation_id': conversation_id,
+                        'bot_session': self.memory['bot_session'],
                         'chat_history2': self.memory.get('chat_history2', []),
                         # SHARED conversation data so agent can see both sides
                         'shared_conversation': self.memory['shared_conversation']
                     }
                     
-                    # Save bot memory to bot's context
-                    bot_cache = RedisManager(self.redis_client, self.memory['bot_phone'])
+                    # Save bot memory to the conversation's bot session
+                    bot_cache = RedisManager(self.redis_client, self.memory['bot_session'])
                     bot_cache.set_memory_dict(bot_memory)
 
-                    self.wpp.send_message(
-                        message="Oi Porto!",
-                        number=self.memory['bot_phone'],
+        if self.memory.get('step') == 2:
+            if not self.is_bot_event:
+                _, channel = self.router.open(self.data.phone, self.data.instanceId, self.memory.get('bot_phone', BOT_PHONE))
+
+                # The bot channel is busy with another negotiation: keep the user's
+                # message in the shared history and wait for the channel
+                if channel == WAITING:
+                    if self.cache:
+                        self.cache.set_memory_dict(self.memory)
+
+                    return {
+                        "type": "message",
+                        "message": "Sua solicitação está na fila de atendimento da Porto Seguro. Assim que for a sua vez, seguimos com o atendimento."
+                    }
+
+                if channel == CLAIMED:
+                    self.outbound.enqueue(
+                        self.memory.get('bot_phone', BOT_PHONE),
+                        "send_message",
+                        {"message": "Oi Porto!"},
+                        key=f"{self.data.messageId}:handoff",
                     )
 
-        if self.memory.get('step') == 2:
             _ = self.__process_step2(self.memory.get('data'))
 
     def send_message(self, message: str, to: str):
@@ -1048,64 +1422,150 @@ class UserWppWebhook:
         
         # Determine the correct phone number based on context
         if to == "bot":
-            target_phone = self.memory.get('bot_phone', "551130039303")
-            recipient_role = "customer_service"
+            target_phone = self.memory.get('bot_phone', BOT_PHONE)
         else:
             target_phone = self.memory.get('user_phone', self.data.phone)
-            recipient_role = "user"
-            
-        # Track the outgoing message in shared conversation
-        self.__add_to_shared_conversation(
-            message=message,
-            speaker_role="agent",
-            message_type="agent_response"
-        )
-        
-        # Update shared conversation context for both user and bot
-        self.__sync_shared_conversation()
-            
+
+        with self.effects_lock:
+            if self.turn_cancelled:
+                logger.warning("Dropping late message from a timed-out step 2 turn for %s", self.data.phone)
+                return
+
+            # This pass is redone with the attachments in view
+            if self.requested_media and not self.media_shown:
+                return "Mensagem não enviada: veja o anexo antes de responder."
+
+            # Track the outgoing message in shared conversation; memory and
+            # sends are flushed together when the turn ends
+            self.__add_to_shared_conversation(
+                message=message,
+                speaker_role="agent",
+                message_type="agent_response"
+            )
+
+            # The key is stable across retries of the same inbound message
+            self.effects.append({
+                "number": target_phone,
+                "message": message,
+                "key": f"{self.data.messageId}:{self.sent_in_turn}",
+            })
+
+            self.sent_in_turn += 1
+
         # Log the message routing for debugging
-        logger.info(f"Agent routing message to {to} ({target_phone}): {message[:50]}...")
+        logger.info("Agent routing message to %s (%s): %s...", to, target_phone, message[:50])
 
-        self.wpp.send_message(
-            message=message,
-            number=target_phone,
-        )
+    def view_attachment(self, numero: int):
+        """
+        Opens an attachment (image or PDF) to see its content. Use it only when the
+        content is needed to continue, before sending any message.
+
+        Args:
+            numero (int): Number of the attachment, as in "[Anexo N: ...]".
+        """
+        numbers = [stored.get('number') for stored in self.memory.get('media', [])]
+        if numero not in numbers:
+            return f"O anexo {numero} não existe."
+
+        with self.effects_lock:
+            if self.media_shown:
+                return "Os anexos pedidos já estão na conversa."
+            if numero not in self.requested_media:
+                self.requested_media.append(numero)
+
+        return f"O anexo {numero} será mostrado a seguir."
+
+    def end_conversation(self, summary: str):
+        """
+        Ends the negotiation with the bot once the user's request is resolved or cannot proceed.
+
+        Args:
+            summary (str): Short summary of how the request ended.
+        """
+        with self.effects_lock:
+            if self.turn_cancelled:
+                return
+
+            if self.requested_media and not self.media_shown:
+                return "Conversa não encerrada: veja o anexo antes."
+
+            self.conversation_finished = True
+            self.memory['shared_conversation'].update_context(status='finished', summary=summary)
+
+        logger.info("Agent ended conversation of %s: %s...", self.memory.get('user_phone', self.data.phone), summary[:50])
+
+    def __flush_effects(self):
+        """Write the turn's memory in one pipeline, then queue the recorded sends."""
+        with self.effects_lock:
+            effects, self.effects = self.effects, []
+
+        self.__sync_shared_conversation()
+
+        # Sends to the user and to the bot are queued per number, so the
+        # sender workers deliver them concurrently while keeping each order
+        for effect in effects:
+            self.outbound.enqueue(
+                effect["number"],
+                "send_message",
+                {"message": effect["message"]},
+                key=effect["key"],
+            )
+
+        # Loop detection pairs the agent's last message to the bot with the bot's reply
+        bot_sends = [effect for effect in effects if effect["number"] == self.memory.get('bot_phone', BOT_PHONE)]
+        if bot_sends and self.memory.get('conversation_id'):
+            AdmissionController(self.redis_client).record_agent_message(
+                self.memory['conversation_id'], bot_sends[-1]["message"]
+            )
+
+        # The closing messages are queued first, so the next conversation's
+        # handoff reaches the bot after them
+        if self.conversation_finished and self.memory.get('conversation_id'):
+            try:
+                self.router.hand_over(self.memory['conversation_id'], self.outbound, key=self.data.messageId)
+            except Exception as e:
+                logger.error("Error releasing the bot channel of %s: %s", self.memory['conversation_id'], e)
     
     def __sync_shared_conversation(self):
-        """Sync shared conversation data between user and bot memory contexts."""
+        """Sync shared conversation data between user and bot memory contexts in one round trip."""
         try:
-            # Update user memory
+            pipe = self.redis_client.pipeline()
+
+            # Update the memory of the side that sent this event
             if self.cache:
-                self.cache.set_memory_dict(self.memory)
+                self.cache.set_memory_dict(self.memory, pipeline=pipe)
             
-            # Update bot memory if it exists
-            if self.memory.get('bot_phone'):
-                bot_cache = RedisManager(self.redis_client, self.memory['bot_phone'])
-                bot_memory = bot_cache.get_memory_dict()
-                if bot_memory:
-                    bot_memory['shared_conversation'] = self.memory['shared_conversation']
-                    bot_memory['chat_history2'] = self.memory.get('chat_history2', [])
-                    bot_cache.set_memory_dict(bot_memory)
+            # Update the other side of the conversation: the user's memory on
+            # bot events, the conversation's bot session on user events.
+            # Only the shared fields are written, so no read is needed, and
+            # only into a memory that exists.
+            if self.is_bot_event:
+                counterpart_id = self.memory.get('user_phone')
+            else:
+                counterpart_id = self.memory.get('bot_session')
+
+            if counterpart_id:
+                counterpart_cache = RedisManager(self.redis_client, counterpart_id, load=False)
+                counterpart_cache.set_memory_dict(
+                    {
+                        'shared_conversation': self.memory['shared_conversation'],
+                        'chat_history2': self.memory.get('chat_history2', []),
+                    },
+                    pipeline=pipe,
+                    only_if_exists=True,
+                )
+
+            pipe.execute()
                     
         except Exception as e:
-            logger.error(f"Error syncing shared conversation: {e}")
+            logger.error("Error syncing shared conversation: %s", e)
 
     def process_event(self):
-
-        message_type = {
-            "message": self.wpp.send_message,
-            "image": self.wpp.send_image,
-            "button_list": self.wpp.send_buttons_list,
-            "button_action": self.wpp.send_buttons_action,
-        }
-
         response = self._process_wpp_message()
 
         if response:
-            response['number'] = self.data.phone
-            response_type = response.pop('type')
-
-            send_function = message_type.get(response_type)
-            if send_function:
-                send_function(**response)
\ No newline at end of file
+            self.outbound.enqueue_response(
+                self.data.phone,
+                response,
+                key=f"{self.data.messageId}:reply",
+            )
@@ -1,18 +1,29 @@
+import os
+import time
+import uuid
 import asyncio
 import json
 import logging
 
-from typing import Dict, List, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
 from datetime import datetime
 
 import redis
 
 from wpp.api.wpp_message import WppMessage
 from wpp.api.wpp_webhook import UserWppWebhook
+from wpp.schemas.wpp_webhook import PAYLOAD_ADAPTER, WppPayload
+from wpp.admission import AdmissionController
 from wpp.memory import RedisManager
+from wpp.media.audio import AudioTranscriber
+from wpp.outbound import OutboundQueue
 
 logger = logging.getLogger(__name__)
 
+# Longest a conversation's turn may hold its lock (a crashed worker's lock expires after this)
+TURN_LOCK_TTL = int(os.getenv("TURN_LOCK_TTL", "300"))
+
 
 class MessageBuffer:
     """
@@ -41,24 +52,54 @@ class MessageBuffer:
     def _get_processing_key(self, phone: str) -> str:
         """Get the Redis key to check if a user is currently being processed."""
         return f"msg_processing:{phone}"
+
+    @asynccontextmanager
+    async def turn_lock(self, buffer_id: str) -> AsyncIterator[None]:
+        """
+        Run one turn of a conversation at a time, across tasks and workers.
+
+        Buffered turns and the immediate fallback both read and write the same
+        memory hash, so a second turn waits for the first one to finish.
+
+        Args:
+            buffer_id: Id the conversation's messages are grouped under
+        """
+        key = f"turn_lock:{buffer_id}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + TURN_LOCK_TTL
+
+        while not self.redis_client.set(key, token, nx=True, ex=TURN_LOCK_TTL):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Turn lock of {buffer_id} not released after {TURN_LOCK_TTL}s")
+            await asyncio.sleep(0.2)
+
+        try:
+            yield
+        finally:
+            current = self.redis_client.get(key)
+            if (current.decode("utf-8") if isinstance(current, bytes) else current) == token:
+                self.redis_client.delete(key)
     
-    async def add_message(self, phone: str, message_data: dict) -> bool:
+    async def add_message(self, phone: str, message_data: dict, buffer_id: Optional[str] = None) -> bool:
         """
         Add a message to the buffer and start or extend the processing timer.
         
         Args:
             phone: User's phone number
             message_data: Complete message data from webhook
+            buffer_id: Id to group the message under. Defaults to the phone;
+                bot messages are grouped by conversation (see wpp.routing)
             
         Returns:
             bool: True if message was added to buffer, False if already processing
         """
-        buffer_key = self._get_buffer_key(phone)
-        processing_key = self._get_processing_key(phone)
+        buffer_id = buffer_id or phone
+        buffer_key = self._get_buffer_key(buffer_id)
+        processing_key = self._get_processing_key(buffer_id)
         
         # Check if user is already being processed
         if self.redis_client.exists(processing_key):
-            logger.info(f"User {phone} is already being processed, skipping buffer")
+            logger.info("User %s is already being processed, skipping buffer", phone)
             return False
         
         # Add message to buffer with timestamp
@@ -78,7 +119,7 @@ class MessageBuffer:
                 buffer_str = current_buffer.decode('utf-8') if isinstance(current_buffer, bytes) else str(current_buffer)
                 buffer_messages = json.loads(buffer_str)
             except (json.JSONDecodeError, TypeError, AttributeError):
-                logger.warning(f"Invalid buffer data for {phone}, starting fresh")
+                logger.warning("Invalid buffer data for %s, starting fresh", phone)
                 buffer_messages = []
         
         # Add new message
@@ -92,38 +133,84 @@ class MessageBuffer:
         )
         
         # Cancel existing processing task if any
-        if phone in self.processing_tasks:
-            self.processing_tasks[phone].cancel()
+        if buffer_id in self.processing_tasks:
+            self.processing_tasks[buffer_id].cancel()
         
         # Start new processing task
-        self.processing_tasks[phone] = asyncio.create_task(
-            self._process_buffer_after_delay(phone)
+        self.processing_tasks[buffer_id] = asyncio.create_task(
+            self._process_buffer_after_delay(phone, buffer_id)
         )
         
-        logger.info(f"Added message to buffer for {phone}, total messages: {len(buffer_messages)}")
+        logger.info("Added message to buffer for %s, total messages: %s", phone, len(buffer_messages))
         return True
     
-    async def _process_buffer_after_delay(self, phone: str):
+    def coalesce(self, phone: str, message_data: dict, buffer_id: Optional[str] = None) -> bool:
+        """
+        Add a message to a buffer that is already open, without extending its timer.
+
+        Used for messages that are not admitted on their own: they are still
+        answered, as part of the turn the buffer is about to run.
+
+        Args:
+            phone: User's phone number
+            message_data: Complete message data from webhook
+            buffer_id: Id the message is grouped under. Defaults to the phone
+
+        Returns:
+            bool: True if the message joined an open buffer
+        """
+        buffer_id = buffer_id or phone
+        buffer_key = self._get_buffer_key(buffer_id)
+
+        if self.redis_client.exists(self._get_processing_key(buffer_id)):
+            return False
+
+        current_buffer = self.redis_client.get(buffer_key)
+        if not current_buffer:
+            return False
+
+        try:
+            buffer_str = current_buffer.decode('utf-8') if isinstance(current_buffer, bytes) else str(current_buffer)
+            buffer_messages = json.loads(buffer_str)
+        except (json.JSONDecodeError, TypeError, AttributeError):
+            return False
+
+        buffer_messages.append({
+            "data": message_data,
+            "timestamp": datetime.now().isoformat(),
+            "message_id": message_data.get("messageId")
+        })
+
+        # XX: only while the buffer has not been taken for processing
+        added = self.redis_client.set(buffer_key, json.dumps(buffer_messages), xx=True, keepttl=True)
+        if added:
+            logger.info("Coalesced message into open buffer for %s, total messages: %s", phone, len(buffer_messages))
+        return bool(added)
+
+    async def _process_buffer_after_delay(self, phone: str, buffer_id: Optional[str] = None):
         """
         Wait for the buffer delay and then process all buffered messages.
         
         Args:
             phone: User's phone number
+            buffer_id: Id the messages were grouped under. Defaults to the phone
         """
+        buffer_id = buffer_id or phone
+
         try:
             # Wait for buffer delay
             await asyncio.sleep(self.buffer_delay)
             
             # Mark user as being processed
-            processing_key = self._get_processing_key(phone)
+            processing_key = self._get_processing_key(buffer_id)
             self.redis_client.setex(processing_key, 30, "1")  # Processing lock for 30 seconds
             
-            # Get buffered messages
-            buffer_key = self._get_buffer_key(phone)
-            buffer_data = self.redis_client.get(buffer_key)
+            # Take the buffered messages: late messages can no longer join them (see coalesce)
+            buffer_key = self._get_buffer_key(buffer_id)
+            buffer_data = self.redis_client.getdel(buffer_key)
             
             if not buffer_data:
-                logger.warning(f"No buffer data found for {phone}")
+                logger.warning("No buffer data found for %s", phone)
                 return
             
             try:
@@ -131,33 +218,32 @@ class MessageBuffer:
                 buffer_str = buffer_data.decode('utf-8') if isinstance(buffer_data, bytes) else str(buffer_data)
                 buffer_messages = json.loads(buffer_str)
             except (json.JSONDecodeError, TypeError, AttributeError):
-                logger.error(f"Invalid buffer data for {phone}")
+                logger.error("Invalid buffer data for %s", phone)
                 return
             
             if not buffer_messages:
-                logger.warning(f"Empty buffer for {phone}")
+                logger.warning("Empty buffer for %s", phone)
                 return
             
-            logger.info(f"Processing {len(buffer_messages)} buffered messages for {phone}")
+            logger.info("Processing %s buffered messages for %s", len(buffer_messages), phone)
             
-            # Process all messages together
-            await self._process_buffered_messages(phone, buffer_messages)
-            
-            # Clean up buffer
-            self.redis_client.delete(buffer_key)
+            # Process all messages together, counted against the global in-flight limit
+            async with self.turn_lock(buffer_id):
+                with AdmissionController(self.redis_client).track():
+                    await self._process_buffered_messages(phone, buffer_messages)
             
         except asyncio.CancelledError:
-            logger.info(f"Buffer processing cancelled for {phone}")
+            logger.info("Buffer processing cancelled for %s", phone)
         except Exception as e:
-            logger.error(f"Error processing buffer for {phone}: {e}")
+            logger.error("Error processing buffer for %s: %s", phone, e)
         finally:
             # Remove processing lock
-            processing_key = self._get_processing_key(phone)
+            processing_key = self._get_processing_key(buffer_id)
             self.redis_client.delete(processing_key)
             
             # Remove from processing tasks
-            if phone in self.processing_tasks:
-                del self.processing_tasks[phone]
+            if buffer_id in self.processing_tasks:
+                del self.processing_tasks[buffer_id]
     
     async def _process_buffered_messages(self, phone: str, buffer_messages: List[dict]):
         """
@@ -180,11 +266,12 @@ class MessageBuffer:
             await combined_processor.process_combined_messages()
             
         except Exception as e:
-            logger.error(f"Error processing combined messages for {phone}: {e}")
+            logger.error("Error processing combined messages for %s: %s", phone, e)
             # Send error message to user
-            self.wpp.send_message(
-                message="Ocorreu um erro ao processar suas mensagens. Por favor, tente novamente.",
-                number=phone
+            OutboundQueue(self.redis_client).enqueue(
+                phone,
+                "send_message",
+                {"message": "Ocorreu um erro ao processar suas mensagens. Por favor, tente novamente."},
             )
     
     def is_processing(self, phone: str) -> bool:
@@ -209,12 +296,12 @@ class MessageBuffer:
             return 0
 
 
-def extract_user_input(message_data: dict, redis_client: redis.Redis, wpp: WppMessage) -> Optional[dict]:
+def extract_user_input(message_data: dict | WppPayload, redis_client: redis.Redis, wpp: WppMessage) -> Optional[dict]:
     """
     Helper function to extract user input from a message without accessing private methods.
     
     Args:
-        message_data: Raw message data from webhook
+        message_data: Raw message data from webhook, or its validated payload
         redis_client: Redis client instance
         wpp: WppMessage instance
         
@@ -236,7 +323,18 @@ def extract_user_input(message_data: dict, redis_client: redis.Redis, wpp: WppMe
                 "text": webhook.data.image.caption,
             }
         elif message_type == "audio" and webhook.data.audio:
-            return {"text": "[Audio message]"}  # Simplified for now
+            # Transcripts are cached by content hash and URL, so the webhook
+            # reuses this transcription instead of calling Whisper again
+            try:
+                transcript = AudioTranscriber(redis_client).transcribe(
+                    webhook.data.audio.audioUrl,
+                    seconds=webhook.data.audio.seconds or 0,
+                )
+            except Exception as e:
+                logger.warning("Could not transcribe audio: %s", e)
+                transcript = ""
+
+            return {"text": transcript or "[Audio message]"}
         elif message_type == "video" and webhook.data.video:
             return {
                 "video": webhook.data.video.videoUrl,
@@ -370,7 +468,7 @@ def extract_user_input(message_data: dict, redis_client: redis.Redis, wpp: WppMe
             return {"text": ""}
             
     except Exception as e:
-        logger.error(f"Error extracting user input: {e}")
+        logger.error("Error extracting user input: %s", e)
         return None
 
 
@@ -384,6 +482,8 @@ class CombinedMessageProcessor:
         self.wpp = wpp
         self.phone = phone
         self.buffer_messages = buffer_messages
+        # Validated once here and reused by every step below
+        self.payloads = [PAYLOAD_ADAPTER.validate_python(entry["data"]) for entry in buffer_messages]
         self.cache = RedisManager(redis_client, phone)
         self.memory = self.cache.get_memory_dict()
         
@@ -392,19 +492,19 @@ class CombinedMessageProcessor:
         try:
             # Sort messages by timestamp
             sorted_messages = sorted(
-                self.buffer_messages, 
-                key=lambda x: x.get("timestamp", "")
+                zip(self.buffer_messages, self.payloads),
+                key=lambda x: x[0].get("timestamp", "")
             )
             
             # Combine text messages and handle special message types
             combined_text = []
             special_messages = []
             
-            for msg_entry in sorted_messages:
-                msg_data = msg_entry["data"]
+            for msg_entry, payload in sorted_messages:
                 
                 # Extract user input using helper function
-                user_input = extract_user_input(msg_data, self.redis_client, self.wpp)
+                # Runs in a thread: audio transcription and downloads must not block the event loop
+                user_input = await asyncio.to_thread(extract_user_input, payload, self.redis_client, self.wpp)
                 
                 if user_input:
                     # Handle text messages
@@ -412,12 +512,13 @@ class CombinedMessageProcessor:
                         combined_text.append(user_input["text"])
                     
                     # Handle special messages (images, documents, etc.)
-                    webhook = UserWppWebhook(msg_data, self.redis_client, self.wpp)
-                    if webhook.message_type in ["image", "document", "audio", "video", "buttonsResponseMessage", "buttonReply", "interactive", "listMessage"]:
+                    message_type = payload.get_payload_type()
+                    if message_type in ["image", "document", "audio", "video", "buttonsResponseMessage", "buttonReply", "interactive", "listMessage"]:
                         special_messages.append({
-                            "type": webhook.message_type,
+                            "type": message_type,
                             "input": user_input,
-                            "timestamp": msg_entry["timestamp"]
+                            "timestamp": msg_entry["timestamp"],
+                            "payload": payload,
                         })
             
             # Create combined text message
@@ -432,36 +533,42 @@ class CombinedMessageProcessor:
                 await self._process_special_messages(special_messages)
             
             else:
-                logger.warning(f"No processable messages found for {self.phone}")
+                logger.warning("No processable messages found for %s", self.phone)
                 
         except Exception as e:
-            logger.error(f"Error in combined message processing: {e}")
+            logger.error("Error in combined message processing: %s", e)
             raise
     
     async def _process_combined_text(self, combined_text: str, special_messages: List[dict]):
         """Process combined text messages with context from special messages."""
         try:
-            # Create a single webhook processor with combined text
-            first_msg = self.buffer_messages[0]["data"].copy()
-            
             # Add context about multiple messages
             if len(self.buffer_messages) > 1:
                 context_msg = f"[Processando {len(self.buffer_messages)} mensagens recebidas] "
                 combined_text = context_msg + combined_text
             
-            # Modify the first message to contain combined text
-            first_msg["text"] = {"message": combined_text}
-            first_msg["type"] = "text"
-            
-            # Ensure phone number is preserved in the message
-            if "phone" not in first_msg:
-                first_msg["phone"] = self.phone
+            # The first message, carrying the combined text
+            first_msg = self.payloads[0].with_text(combined_text)
             
+            # Attachments buffered with the text are recorded first, so the
+            # combined turn shows them to the model
+            for special_msg in special_messages:
+                if special_msg["type"] in ("image", "document"):
+                    media_webhook = UserWppWebhook(special_msg["payload"], self.redis_client, self.wpp)
+                    refusal = await asyncio.to_thread(media_webhook.record_media)
+
+                    if refusal:
+                        self._send_response(
+                            {"type": "message", "message": refusal},
+                            key=f"{special_msg['payload'].messageId}:reply",
+                        )
+
             # Create webhook processor
             webhook = UserWppWebhook(first_msg, self.redis_client, self.wpp)
             
-            # Process the combined message
-            response = webhook._process_wpp_message()
+            # Process the combined message off the event loop thread; media
+            # transforms inside it go to the process pool
+            response = await asyncio.to_thread(webhook._process_wpp_message)
             
             # Sync shared conversation data after processing
             if hasattr(webhook, 'cache') and webhook.cache:
@@ -469,10 +576,10 @@ class CombinedMessageProcessor:
             
             # Send response if available
             if response:
-                self._send_response(response)
+                self._send_response(response, key=f"{first_msg.messageId}:reply")
                 
         except Exception as e:
-            logger.error(f"Error processing combined text: {e}")
+            logger.error("Error processing combined text: %s", e)
             raise
     
     async def _process_special_messages(self, special_messages: List[dict]):
@@ -482,43 +589,22 @@ class CombinedMessageProcessor:
             # In the future, this could be enhanced to handle multiple images, etc.
             
             for special_msg in special_messages:
-                # Create a webhook processor for each special message
-                msg_data = None
-                
-                # Find the original message data
-                for msg_entry in self.buffer_messages:
-                    webhook = UserWppWebhook(msg_entry["data"], self.redis_client, self.wpp)
-                    if webhook.message_type == special_msg["type"]:
-                        msg_data = msg_entry["data"]
-                        break
+                # Each special message carries the payload it was parsed from
+                payload = special_msg["payload"]
+
+                webhook = UserWppWebhook(payload, self.redis_client, self.wpp)
+                response = await asyncio.to_thread(webhook._process_wpp_message)
                 
-                if msg_data:
-                    webhook = UserWppWebhook(msg_data, self.redis_client, self.wpp)
-                    response = webhook._process_wpp_message()
-                    
-                    if response:
-                        self._send_response(response)
+                if response:
+                    self._send_response(response, key=f"{payload.messageId}:reply")
                         
         except Exception as e:
-            logger.error(f"Error processing special messages: {e}")
+            logger.error("Error processing special messages: %s", e)
             raise
     
-    def _send_response(self, response: dict):
-        """Send response to user."""
+    def _send_response(self, response: dict, key: Optional[str] = None):
+        """Queue the response to the user for the outbound sender."""
         try:
-            message_type = {
-                "message": self.wpp.send_message,
-                "image": self.wpp.send_image,
-                "button_list": self.wpp.send_buttons_list,
-                "button_action": self.wpp.send_buttons_action,
-            }
-            
-            response['number'] = self.phone
-            response_type = response.pop('type')
-            
-            send_function = message_type.get(response_type)
-            if send_function:
-                send_function(**response)
-                
+            OutboundQueue(self.redis_client).enqueue_response(self.phone, response, key=key)
         except Exception as e:
-            logger.error(f"Error sending response: {e}") 
\ No newline at end of file
+            logger.error("Error sending response: %s", e)
@@ -0,0 +1,203 @@
+"""
+Shared conversation state.
+
+Ring buffer of the messages exchanged between the user, the Porto Seguro
+bot and the intermediary agent. Per-role counters and the rendered agent
+context are maintained incrementally, instead of being recomputed from
+the whole history on every step 2 initialization.
+"""
+
+from collections import deque
+from datetime import datetime
+from typing import Any, Iterator, Optional
+
+# Messages kept per conversation
+MAX_ENTRIES = 50
+
+# Messages shown to the agent in the rendered context
+CONTEXT_ENTRIES = 10
+
+ROLES = ("user", "customer_service", "agent")
+
+# Entries are stored as compact lists instead of dicts with repeated keys
+TIMESTAMP, ROLE, PHONE, MESSAGE, MESSAGE_TYPE = range(5)
+
+
+class SharedConversation:
+    """
+    Conversation between the user, the customer-service bot and the agent.
+
+    Serialized with to_dict() into the ``shared_conversation`` memory field;
+    from_dict() also reads the legacy format (a ``conversation_history``
+    list of dicts), so existing conversations are converted on first load.
+    """
+
+    def __init__(
+        self,
+        participants: dict,
+        current_context: Optional[dict] = None,
+        entries: Any = (),
+        counts: Optional[dict] = None,
+        rendered: Optional[str] = None,
+    ) -> None:
+        """
+        Initialize the conversation.
+
+        Args:
+            participants: Phones/ids of the user, customer_service and agent
+            current_context: Status, last speaker and user request
+            entries: Compact entries, oldest first
+            counts: Messages per role among the kept entries
+            rendered: Cached agent context, if still valid
+        """
+        self.participants = participants
+        self.current_context = current_context or {"status": "active", "last_speaker": None}
+        self.entries = deque(entries, maxlen=MAX_ENTRIES)
+
+        if counts is None:
+            counts = {role: 0 for role in ROLES}
+            for entry in self.entries:
+                counts[entry[ROLE]] = counts.get(entry[ROLE], 0) + 1
+        self.counts = counts
+
+        self.rendered = rendered
+
+    @classmethod
+    def from_dict(cls, data: Optional[dict], participants: Optional[dict] = None) -> "SharedConversation":
+        """
+        Load a conversation from memory.
+
+        Args:
+            data: The stored ``shared_conversation`` value, compact or legacy
+            participants: Participants of a new conversation, used when data is empty
+
+        Returns:
+            SharedConversation: The conversation
+        """
+        if isinstance(data, cls):
+            return data
+
+        if not data:
+            return cls(participants or {})
+
+        if "entries" in data:
+            return cls(
+                data.get("participants", {}),
+                data.get("current_context"),
+                data["entries"],
+                data.get("counts"),
+                data.get("rendered"),
+            )
+
+        entries = [
+            [
+                entry.get("timestamp", ""),
+                entry.get("speaker_role", "unknown"),
+                entry.get("speaker_phone", ""),
+                entry.get("message", ""),
+                entry.get("message_type", "text"),
+            ]
+            for entry in data.get("conversation_history", [])[-MAX_ENTRIES:]
+        ]
+        return cls(data.get("participants", {}), data.get("current_context"), entries)
+
+    def to_dict(self) -> dict:
+        """Compact, JSON-serializable form stored in memory."""
+        return {
+            "participants": self.participants,
+            "current_context": self.current_context,
+            "entries": list(self.entries),
+            "counts": self.counts,
+            "rendered": self.rendered,
+        }
+
+    @property
+    def history(self) -> Iterator[dict]:
+        """Entries in the legacy dict format, oldest first."""
+        for entry in self.entries:
+            yield {
+                "timestamp": entry[TIMESTAMP],
+                "speaker_role": entry[ROLE],
+                "speaker_phone": entry[PHONE],
+                "message": entry[MESSAGE],
+                "message_type": entry[MESSAGE_TYPE],
+            }
+
+    def add(self, message: str, speaker_role: str, speaker_phone: str, message_type: str = "text") -> None:
+        """
+        Append a message, evicting the oldest one when the buffer is full.
+
+        Args:
+            message: Message text
+            speaker_role: 'user', 'customer_service' or 'agent'
+            speaker_phone: Phone of the event that produced the message
+            message_type: Z-API message type, or 'agent_response'
+        """
+        if len(self.entries) == self.entries.maxlen:
+            evicted = self.entries[0][ROLE]
+            self.counts[evicted] = self.counts.get(evicted, 1) - 1
+
+        self.entries.append([datetime.now().isoformat(), speaker_role, speaker_phone, message, message_type])
+        self.counts[speaker_role] = self.counts.get(speaker_role, 0) + 1
+
+        self.current_context["last_speaker"] = speaker_role
+        self.rendered = None
+
+    def update_context(self, **values: Any) -> None:
+        """Update the current context (status, user_request, ...)."""
+        self.current_context.update(values)
+        self.rendered = None
+
+    def render(self) -> str:
+        """
+        Agent-facing summary of the conversation.
+
+        Returns:
+            str: The cached text, rebuilt only after the conversation changed
+        """
+        if self.rendered is None:
+            self.rendered = self._render()
+        return self.rendered
+
+    def _render(self) -> str:
+        participants = self.participants
+        context_parts = [
+            "PARTICIPANTES DA CONVERSA:",
+            f"- Usuário: {participants.get('user', 'unknown')}",
+            f"- Atendimento Porto Seguro: {participants.get('customer_service', 'unknown')}",
+            f"- Agente Intermediário (você): {participants.get('agent', 'intermediary_agent')}",
+        ]
+
+        current_context = self.current_context
+        context_parts.append(f"\nSTATUS DA CONVERSA: {current_context.get('status', 'active')}")
+        context_parts.append(f"ÚLTIMO A FALAR: {current_context.get('last_speaker', 'unknown')}")
+
+        if current_context.get("user_request"):
+            context_parts.append("\nSOLICITAÇÃO ORIGINAL DO USUÁRIO:")
+            user_request = current_context["user_request"]
+            if isinstance(user_request, dict):
+                for key, value in user_request.items():
+                    context_parts.append(f"- {key}: {value}")
+            else:
+                context_parts.append(f"- {user_request}")
+
+        if self.entries:
+            context_parts.append(f"\nRESUMO DA CONVERSA ({len(self.entries)} mensagens trocadas):")
+            context_parts.append(f"- Mensagens do usuário: {self.counts.get('user', 0)}")
+            context_parts.append(f"- Mensagens do atendimento: {self.counts.get('customer_service', 0)}")
+            context_parts.append(f"- Suas mensagens como agente: {self.counts.get('agent', 0)}")
+
+            context_parts.append(f"\nÚLTIMAS {CONTEXT_ENTRIES} MENSAGENS:")
+            for entry in list(self.entries)[-CONTEXT_ENTRIES:]:
+                timestamp = entry[TIMESTAMP]
+                context_parts.append(
+                    f"[{timestamp[-8:-3] if timestamp else ''}] {entry[ROLE].upper()}: {entry[MESSAGE]}"
+                )
+
+        context_parts.append("\nSUA FUNÇÃO COMO AGENTE INTERMEDIÁRIO:")
+        context_parts.append("- Facilitar a comunicação entre o usuário e o atendimento Porto Seguro")
+        context_parts.append("- Traduzir/clarificar mensagens quando necessário")
+        context_parts.append("- Manter o contexto da conversa para ambas as partes")
+        context_parts.append("- Usar as ferramentas send_message(message, to='user') ou send_message(message, to='bot')")
+
+        return "\n".join(context_parts)
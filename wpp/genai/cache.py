@@ -0,0 +1,163 @@
+"""
+Response cache for model turns.
+
+Caches model responses in Redis, keyed by a hash of the normalized
+(prompt version, history window, user text), with TTL and LRU eviction.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from typing import Any, Optional
+
+from wpp.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_version(*prompts: str) -> str:
+    """
+    Build a short version identifier for a system prompt.
+
+    Args:
+        prompts: The prompt parts, in the order they are sent to the model
+
+    Returns:
+        str: The first 12 hex chars of the SHA-256 of the prompts
+    """
+    digest = hashlib.sha256("\n".join(prompts).encode("utf-8")).hexdigest()
+    return digest[:12]
+
+
+class ResponseCache:
+    """
+    Exact-match cache for model responses on normalized inputs.
+
+    Entries expire after ``ttl`` seconds and, when more than ``max_entries``
+    are stored, the least recently used ones are evicted. Hits and misses are
+    counted so the hit rate can be monitored.
+    """
+
+    def __init__(
+        self,
+        redis: Any,
+        namespace: str,
+        ttl: int = 86400,
+        max_entries: int = 5000,
+    ) -> None:
+        """
+        Initialize the response cache.
+
+        Args:
+            redis: Redis client instance
+            namespace: Prefix for the cache keys
+            ttl: Expiration time in seconds for each entry
+            max_entries: Maximum number of entries kept before LRU eviction
+        """
+        self.redis = redis
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.metrics = Metrics(redis)
+
+        self.index_key = f"{namespace}:lru"
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        Normalize user text so trivial variations share the same key.
+
+        Lowercases, strips accents and punctuation and collapses whitespace,
+        so "Olá!", "ola" and " OLA " are the same entry.
+        """
+        text = unicodedata.normalize("NFKD", text or "")
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        text = re.sub(r"[^\w\s]", " ", text.lower())
+        return " ".join(text.split())
+
+    def make_key(self, version: str, history_window: Any, user_text: str) -> str:
+        """
+        Build the cache key for a model turn.
+
+        Args:
+            version: Prompt version (see prompt_version)
+            history_window: The conversation state sent along with the text
+            user_text: The new user text
+
+        Returns:
+            str: The Redis key for this turn
+        """
+        material = json.dumps(
+            [version, history_window, self.normalize(user_text)],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        digest = hashlib.sha256(material.encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{digest}"
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Look up a cached response and mark it as recently used.
+
+        Args:
+            key: Key built by make_key
+
+        Returns:
+            dict: The cached response, or None on a miss
+        """
+        try:
+            cached = self.redis.get(key)
+        except Exception as e:
+            logger.warning("Erro ao ler o cache %s: %s", self.namespace, e)
+            return None
+
+        if not cached:
+            self.metrics.incr(f"{self.namespace}.misses")
+            return None
+
+        try:
+            value = cached.decode("utf-8") if isinstance(cached, bytes) else cached
+            response = json.loads(value)
+        except (json.JSONDecodeError, AttributeError):
+            self.metrics.incr(f"{self.namespace}.misses")
+            return None
+
+        self.redis.zadd(self.index_key, {key: time.time()})
+        self.metrics.incr(f"{self.namespace}.hits")
+        return response
+
+    def set(self, key: str, response: dict) -> None:
+        """
+        Store a response and evict the least recently used entries over the limit.
+
+        Args:
+            key: Key built by make_key
+            response: The model response to cache
+        """
+        try:
+            pipe = self.redis.pipeline()
+            pipe.setex(key, self.ttl, json.dumps(response, ensure_ascii=False))
+            pipe.zadd(self.index_key, {key: time.time()})
+            # Entries that already expired through TTL are dropped from the index too
+            pipe.zremrangebyscore(self.index_key, "-inf", time.time() - self.ttl)
+            pipe.zcard(self.index_key)
+            size = pipe.execute()[-1]
+
+            excess = size - self.max_entries
+            if excess > 0:
+                evicted = self.redis.zrange(self.index_key, 0, excess - 1)
+                if evicted:
+                    self.redis.delete(*evicted)
+                    self.redis.zrem(self.index_key, *evicted)
+        except Exception as e:
+            logger.warning("Erro ao gravar o cache %s: %s", self.namespace, e)
+
+    def hit_rate(self) -> float:
+        """Return the fraction of lookups served from the cache."""
+        hits = self.metrics.get(f"{self.namespace}.hits").get("count", 0.0)
+        misses = self.metrics.get(f"{self.namespace}.misses").get("count", 0.0)
+        total = hits + misses
+        return hits / total if total else 0.0
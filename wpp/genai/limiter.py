@@ -0,0 +1,179 @@
+"""
+Global LLM concurrency governor.
+
+Bounds how many model calls run at the same time (local semaphore per
+worker) and how many tokens per minute the whole deployment spends
+(Redis-backed token bucket), with priority classes so live step 2
+conversations go ahead of new step 1 intake.
+"""
+
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from wpp.metrics import Metrics
+from wpp.ratelimit import RedisTokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+# Priority classes (lower value goes first)
+HIGH = 0    # step 2 turns answering the Porto Seguro bot, keep its session alive
+NORMAL = 1  # step 2 turns answering the user
+LOW = 2     # step 1 intake
+
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+
+# Input tokens of one attached image (a 1024 px JPEG at high detail)
+IMAGE_TOKENS = 765
+
+
+def estimate_tokens(*texts: Any, images: int = 0) -> int:
+    """Rough token estimate (~4 chars per token, plus the attached images) for the token bucket."""
+    return max(1, sum(len(str(text)) for text in texts) // 4 + images * IMAGE_TOKENS)
+
+
+class PrioritySemaphore:
+    """
+    Counting semaphore that wakes waiters by priority, then arrival order.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
+        self.waiters: list = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        """Number of callers waiting for a slot."""
+        with self.lock:
+            return sum(1 for entry in self.waiters if not entry[3])
+
+    def acquire(self, priority: int, timeout: float | None = None) -> bool:
+        """
+        Wait for a slot.
+
+        Args:
+            priority: Priority class, lower values are served first
+            timeout: Maximum seconds to wait. If None, waits indefinitely
+
+        Returns:
+            bool: True if a slot was acquired
+        """
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1
+                return True
+
+            event = threading.Event()
+            entry = [priority, next(self.counter), event, False]
+            heapq.heappush(self.waiters, entry)
+
+        if event.wait(timeout):
+            return True
+
+        with self.lock:
+            # The slot may have been handed over right after the wait timed out
+            if event.is_set():
+                return True
+            entry[3] = True
+            return False
+
+    def release(self) -> None:
+        """Release a slot, handing it directly to the highest priority waiter."""
+        with self.lock:
+            while self.waiters:
+                entry = heapq.heappop(self.waiters)
+                if not entry[3]:
+                    entry[2].set()
+                    return
+            self.active -= 1
+
+
+# One semaphore per worker process, shared by every webhook instance
+_semaphore = PrioritySemaphore(int(os.getenv("LLM_MAX_CONCURRENCY", "8")))
+
+
+class LLMGovernor:
+    """
+    Admission control in front of the step agents.
+
+    Example:
+        governor = LLMGovernor(redis_client)
+        with governor.slot(HIGH, estimate_tokens(prompt)):
+            response = task.run()
+    """
+
+    def __init__(self, redis: Any) -> None:
+        """
+        Initialize the governor.
+
+        Args:
+            redis: Redis client instance
+        """
+        tokens_per_minute = float(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+
+        self.bucket = RedisTokenBucket(
+            redis,
+            "llm_governor:tokens",
+            capacity=tokens_per_minute,
+            rate=tokens_per_minute / 60,
+        )
+        # Share of the bucket that only HIGH priority calls may use
+        self.reserve = {
+            HIGH: 0,
+            NORMAL: 0,
+            LOW: tokens_per_minute * float(os.getenv("LLM_LOW_PRIORITY_RESERVE", "0.2")),
+        }
+        self.timeout = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+        self.metrics = Metrics(redis)
+
+    @contextmanager
+    def slot(self, priority: int, tokens: int) -> Iterator[None]:
+        """
+        Hold a concurrency slot and pay ``tokens`` from the shared bucket.
+
+        The slot is released when the block exits. A call abandoned at its
+        deadline by ResilientCaller keeps running in its thread after that,
+        bounded by LLM_CALL_THREADS instead.
+
+        Args:
+            priority: HIGH, NORMAL or LOW
+            tokens: Estimated tokens of the call
+
+        Raises:
+            TimeoutError: If no slot or tokens were available within LLM_QUEUE_TIMEOUT
+        """
+        name = PRIORITY_NAMES.get(priority, "normal")
+        start = time.monotonic()
+
+        self.metrics.gauge("llm.queue_depth", _semaphore.waiting + 1)
+
+        if not _semaphore.acquire(priority, self.timeout):
+            self.metrics.incr(f"llm.queue_timeouts.{name}")
+            raise TimeoutError(f"No LLM slot available for {name} priority call")
+
+        try:
+            remaining = max(0.0, self.timeout - (time.monotonic() - start))
+            if not self.bucket.acquire(tokens, self.reserve.get(priority, 0), remaining):
+                self.metrics.incr(f"llm.queue_timeouts.{name}")
+                raise TimeoutError(f"LLM token budget exhausted for {name} priority call")
+
+            waited = time.monotonic() - start
+            self.metrics.observe(f"llm.queue_wait.{name}", waited)
+            self.metrics.gauge("llm.queue_depth", _semaphore.waiting)
+
+            if waited > 1:
+                logger.info("LLM %s priority call waited %.2fs for capacity", name, waited)
+
+            yield
+        finally:
+            _semaphore.release()
@@ -0,0 +1,284 @@
+"""
+Menu fingerprint cache for the Porto Seguro bot.
+
+Most bot turns in step 2 are list or button menus, and the same menus come
+back in every conversation. Each menu is fingerprinted from its normalized
+text and options; the option the agent picked is learned together with the
+user's problem description, and known menu states are answered without a
+model call. TF-IDF similarity (NumPy) matches menus whose text changed
+slightly and problems described in other words. Menus that show numbers or
+ask to confirm personal data (CPF, placa, nome...) are specific to one user
+and are never learned or answered from the cache.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import unicodedata
+from typing import Any, Optional
+
+import numpy as np
+
+from wpp.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text: str) -> str:
+    """Lowercase, strip accents, mask numbers and collapse whitespace."""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"\d+", "#", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+# Frequent Portuguese words that carry no meaning for similarity
+STOPWORDS = {
+    "com", "como", "das", "dos", "ele", "ela", "essa", "esse", "esta", "este", "estou",
+    "isso", "mais", "meu", "minha", "mas", "nao", "nos", "num", "numa", "para", "pela",
+    "pelo", "por", "pra", "que", "sua", "seu", "sim", "sobre", "tem", "uma", "voce",
+}
+
+
+# Words of menus that confirm or collect the user's own data
+PERSONAL_PATTERN = re.compile(
+    r"\b(?:cpf|cnpj|placa|chassi|renavam|nome|nascimento|endereco|cep|e-?mail|telefone|celular"
+    r"|confirm\w*|correto|corretos|seus dados)\b"
+)
+
+# Numbers that look like someone's data (CPF, protocolo, datas, placas), not "24h" or "2 dias"
+PERSONAL_NUMBER = re.compile(r"\d{3,}|\d[./-]\d|\b[a-z]{3}\d[a-z0-9]\d{2}\b", re.IGNORECASE)
+
+
+def menu_body(user_input: dict) -> str:
+    """The menu's message, without the ``[title](id)`` option markup the webhook adds to ``text``."""
+    if "body" in user_input:
+        return user_input["body"] or ""
+    return re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", user_input.get("text", "") or "")
+
+
+def is_personal(user_input: dict) -> bool:
+    """
+    Whether a menu is about one user's data rather than a generic step.
+
+    Menus whose message or option titles show data-like numbers (masked by
+    ``normalize``) or that confirm personal data would otherwise share a
+    fingerprint across users. Option ids are not looked at: they are
+    usually numeric.
+    """
+    # Option numbering ("1 - Sinistro", "1️⃣ Sinistro") is not data
+    titles = [re.sub(r"^\s*\d+\s*(?:\ufe0f?\u20e3|[-.)]|\s)\s*", "", option) for option in menu_options(user_input)]
+    texts = [menu_body(user_input)] + titles
+    if any(PERSONAL_NUMBER.search(text) for text in texts):
+        return True
+
+    return any(PERSONAL_PATTERN.search(normalize(text)) for text in texts)
+
+
+def _tokens(text: str) -> list[str]:
+    return [token for token in re.findall(r"[a-z]{3,}", normalize(text)) if token not in STOPWORDS]
+
+
+def tfidf(texts: list[str]) -> np.ndarray:
+    """
+    L2-normalized TF-IDF matrix of a small corpus.
+
+    Args:
+        texts: Documents
+
+    Returns:
+        np.ndarray: One row per document; the dot product of two rows is their cosine similarity
+    """
+    documents = [_tokens(text) for text in texts]
+    vocabulary = {token: index for index, token in enumerate(sorted({t for doc in documents for t in doc}))}
+
+    matrix = np.zeros((len(documents), max(1, len(vocabulary))))
+    for row, doc in enumerate(documents):
+        for token in doc:
+            matrix[row, vocabulary[token]] += 1
+
+    df = np.count_nonzero(matrix, axis=0)
+    idf = np.log((1 + len(documents)) / (1 + df)) + 1
+    matrix *= idf
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def menu_options(user_input: dict) -> list[str]:
+    """Option titles of a list or interactive menu, as extracted by the webhook."""
+    options = []
+
+    for section in user_input.get("sections") or []:
+        for option in (section.get("options") or []) + (section.get("rows") or []):
+            title = option.get("title") if isinstance(option, dict) else getattr(option, "title", "")
+            if title:
+                options.append(title)
+
+    for button in user_input.get("buttons") or []:
+        if button.get("title"):
+            options.append(button["title"])
+
+    return options
+
+
+class MenuCache:
+    """
+    Learned choices for bot menus.
+
+    Keys:
+        <ns>:menus        hash fingerprint -> normalized menu text
+        <ns>:obs:<fp>     list of observations {"problema", "choice"}, newest last
+    """
+
+    def __init__(self, redis: Any, namespace: str = "menu_cache") -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            redis: Redis client instance
+            namespace: Prefix for the Redis keys
+        """
+        self.redis = redis
+        self.namespace = namespace
+        self.metrics = Metrics(redis)
+
+        self.menu_threshold = float(os.getenv("MENU_MATCH_THRESHOLD", "0.8"))
+        self.problem_threshold = float(os.getenv("MENU_PROBLEM_THRESHOLD", "0.2"))
+        self.min_observations = int(os.getenv("MENU_MIN_OBSERVATIONS", "2"))
+        self.min_agreement = float(os.getenv("MENU_MIN_AGREEMENT", "0.8"))
+        self.max_observations = 50
+
+        self.menus_key = f"{namespace}:menus"
+
+    @staticmethod
+    def fingerprint(user_input: dict) -> str:
+        """Hash of the normalized menu text and options."""
+        payload = json.dumps(
+            {
+                "text": normalize(user_input.get("text", "")),
+                "options": sorted(normalize(option) for option in menu_options(user_input)),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _decode(self, value: Any) -> Any:
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def _match_menu(self, fingerprint: str, text: str) -> Optional[str]:
+        """Return the known menu with this fingerprint, or the most similar one above the threshold."""
+        menus = {self._decode(k): self._decode(v) for k, v in self.redis.hgetall(self.menus_key).items()}
+
+        if fingerprint in menus:
+            return fingerprint
+        if not menus:
+            return None
+
+        fingerprints = list(menus)
+        matrix = tfidf([normalize(text)] + [menus[fp] for fp in fingerprints])
+        similarities = matrix[1:] @ matrix[0]
+
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.menu_threshold:
+            return fingerprints[best]
+        return None
+
+    def _observations(self, fingerprint: str) -> list[dict]:
+        raw = self.redis.lrange(f"{self.namespace}:obs:{fingerprint}", 0, -1)
+        return [json.loads(self._decode(item)) for item in raw]
+
+    def lookup(self, user_input: dict, problema: str) -> Optional[str]:
+        """
+        Answer a menu from what was chosen before in similar conversations.
+
+        Args:
+            user_input: The menu as extracted by the webhook
+            problema: The user's problem description (step 1)
+
+        Returns:
+            str: The option to send, or None if the menu state is novel or ambiguous
+        """
+        options = menu_options(user_input)
+        if not options:
+            return None
+
+        if is_personal(user_input):
+            self.metrics.incr("menu_cache.personal")
+            return None
+
+        try:
+            match = self._match_menu(self.fingerprint(user_input), user_input.get("text", ""))
+            observations = self._observations(match) if match else []
+        except Exception as e:
+            logger.warning("Erro ao consultar o cache de menus: %s", e)
+            return None
+
+        # The learned choice must still be one of the options on screen
+        current = {normalize(option): option for option in options}
+        observations = [obs for obs in observations if normalize(obs["choice"]) in current]
+
+        if len(observations) < self.min_observations:
+            self.metrics.incr("menu_cache.miss")
+            return None
+
+        # Observations from conversations about similar problems vote, weighted by similarity
+        matrix = tfidf([problema or ""] + [obs.get("problema", "") for obs in observations])
+        similarities = matrix[1:] @ matrix[0]
+
+        neighbours = [
+            (obs, max(float(similarity), 1e-6))
+            for obs, similarity in zip(observations, similarities)
+            if similarity >= self.problem_threshold
+        ]
+
+        if len(neighbours) < self.min_observations:
+            self.metrics.incr("menu_cache.miss")
+            return None
+
+        votes = {}
+        for obs, weight in neighbours:
+            choice = normalize(obs["choice"])
+            votes[choice] = votes.get(choice, 0) + weight
+
+        choice, weight = max(votes.items(), key=lambda item: item[1])
+        if weight / sum(votes.values()) < self.min_agreement:
+            self.metrics.incr("menu_cache.ambiguous")
+            return None
+
+        self.metrics.incr("menu_cache.hit")
+        return current[choice]
+
+    def learn(self, user_input: dict, problema: str, choice: str) -> bool:
+        """
+        Record the option the agent sent for a menu.
+
+        Args:
+            user_input: The menu as extracted by the webhook
+            problema: The user's problem description (step 1)
+            choice: The message sent to the bot
+
+        Returns:
+            bool: True if the choice was one of the options and was recorded
+        """
+        options = {normalize(option): option for option in menu_options(user_input)}
+        if normalize(choice) not in options or is_personal(user_input):
+            return False
+
+        fingerprint = self.fingerprint(user_input)
+        key = f"{self.namespace}:obs:{fingerprint}"
+
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hset(self.menus_key, fingerprint, normalize(user_input.get("text", "")))
+            pipe.rpush(key, json.dumps({"problema": problema or "", "choice": options[normalize(choice)]}, ensure_ascii=False))
+            pipe.ltrim(key, -self.max_observations, -1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Erro ao gravar o cache de menus: %s", e)
+            return False
+
+        return True
@@ -135,4 +135,27 @@ A resposta deve ser estritamente um objeto JSON único, sem blocos de código, c
 - "extracted_data": objeto JSON, com todos os campos extraídos ou marcados como vazio/nulo conforme aplicável. 
 
 Lembre-se: sempre inicie pelo raciocínio de extração, depois validação, e só então reporte resultado e mensagem.
-"""
\ No newline at end of file
+"""
+
+PROMPT_DELTA = """
+# Modo incremental
+
+Você não recebe o histórico completo da conversa. Em vez disso, cada turno traz:
+- "DADOS JÁ EXTRAÍDOS": o estado atual dos campos, acumulado nos turnos anteriores;
+- "ÚLTIMA MENSAGEM ENVIADA AO USUÁRIO": o que você respondeu no turno anterior (pode estar vazio);
+- "NOVA MENSAGEM DO USUÁRIO": apenas o texto novo.
+
+Regras:
+- Considere os dados já extraídos como válidos, a menos que a nova mensagem os corrija explicitamente.
+- Em "extracted_data", devolva SEMPRE todos os campos: os já extraídos mais o que for novo ou corrigido.
+- Valide o conjunto completo (dados já extraídos + novos) para definir "validation_status".
+"""
+
+DELTA_INPUT = """DADOS JÁ EXTRAÍDOS:
+{slots}
+
+ÚLTIMA MENSAGEM ENVIADA AO USUÁRIO:
+{last_message}
+
+NOVA MENSAGEM DO USUÁRIO:
+{text}"""
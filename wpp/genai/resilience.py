@@ -0,0 +1,303 @@
+"""
+Resilient model call layer.
+
+Wraps blocking model calls (``Task.run``) with per-call deadlines, bounded
+retries with exponential jitter, optional hedged requests and a circuit
+breaker, so tail latency is bounded by configuration instead of by the
+upstream provider.
+"""
+
+import os
+import math
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because its circuit breaker is open."""
+
+
+# Deadline for all the model calls of one turn, escalation included. Kept
+# below the 30 s processing lock of the message buffer.
+TURN_BUDGET = float(os.getenv("LLM_TURN_BUDGET", "25"))
+
+
+class CallPolicy:
+    """
+    Timeouts, retries, hedging and breaker thresholds for one kind of call.
+
+    Every value can be overridden from the environment with the upper-cased
+    name as prefix, e.g. ``STEP1_TIMEOUT`` or ``WHISPER_RETRIES``.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float = 20.0,
+        budget: float = 25.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 4.0,
+        hedge: bool = False,
+        retry_on_empty: bool = True,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ) -> None:
+        """
+        Initialize the policy.
+
+        Args:
+            name: Identifier of the call, also the circuit breaker name
+            timeout: Deadline in seconds for a single attempt
+            budget: Deadline in seconds for all attempts together
+            retries: Number of retries after the first attempt
+            backoff: Base delay in seconds for the exponential backoff
+            max_backoff: Upper bound for a single backoff delay
+            hedge: Whether to fire a second request once the observed p95 is exceeded
+            retry_on_empty: Whether an empty result counts as a failed attempt
+            failure_threshold: Consecutive failures that open the circuit
+            reset_timeout: Seconds the circuit stays open before a trial call
+        """
+        prefix = name.upper().replace(".", "_")
+
+        self.name = name
+        self.timeout = float(os.getenv(f"{prefix}_TIMEOUT", timeout))
+        self.budget = float(os.getenv(f"{prefix}_BUDGET", budget))
+        self.retries = int(os.getenv(f"{prefix}_RETRIES", retries))
+        self.backoff = float(os.getenv(f"{prefix}_BACKOFF", backoff))
+        self.max_backoff = max_backoff
+        self.hedge = os.getenv(f"{prefix}_HEDGE", str(hedge)).lower() in ("1", "true", "yes")
+        self.retry_on_empty = retry_on_empty
+        self.failure_threshold = int(os.getenv(f"{prefix}_FAILURE_THRESHOLD", failure_threshold))
+        self.reset_timeout = float(os.getenv(f"{prefix}_RESET_TIMEOUT", reset_timeout))
+
+    def within(self, deadline: float) -> "CallPolicy":
+        """Cap the budget so the call ends by ``deadline`` (a time.monotonic value)."""
+        self.budget = min(self.budget, max(0.0, deadline - time.monotonic()))
+        return self
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls fail fast. Once ``reset_timeout`` has elapsed a single trial call is
+    allowed (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Return whether a call may go through now."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_running:
+                return False
+
+            self.trial_running = True
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies, used to decide when to hedge."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20) -> None:
+        self.samples: deque = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        """Return the 95th percentile latency, or None while there are too few samples."""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[math.ceil(len(ordered) * 0.95) - 1]
+
+
+# Breakers and latency windows are per process and shared by every webhook
+# instance, so they must be looked up by name instead of created per request.
+_registry_lock = threading.Lock()
+_breakers: dict[str, CircuitBreaker] = {}
+_trackers: dict[str, LatencyTracker] = {}
+
+# Attempts run in worker threads so the caller can stop waiting at the
+# deadline; a timed-out attempt keeps its thread until the provider returns.
+# The caller's LLMGovernor slot is released when it stops waiting, so
+# LLM_CALL_THREADS, not LLM_MAX_CONCURRENCY, bounds the calls a worker
+# process has in flight with the provider.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LLM_CALL_THREADS", "32")),
+    thread_name_prefix="llm-call",
+)
+
+
+def _get_breaker(policy: CallPolicy) -> CircuitBreaker:
+    with _registry_lock:
+        if policy.name not in _breakers:
+            _breakers[policy.name] = CircuitBreaker(policy.failure_threshold, policy.reset_timeout)
+        return _breakers[policy.name]
+
+
+def _get_tracker(name: str) -> LatencyTracker:
+    with _registry_lock:
+        if name not in _trackers:
+            _trackers[name] = LatencyTracker()
+        return _trackers[name]
+
+
+class ResilientCaller:
+    """
+    Run a blocking call under a CallPolicy.
+
+    Example:
+        caller = ResilientCaller(CallPolicy("step1", hedge=True))
+        response = caller.call_task(lambda: Task(user=text, history=history, agent=agent))
+    """
+
+    def __init__(self, policy: CallPolicy) -> None:
+        self.policy = policy
+        self.breaker = _get_breaker(policy)
+        self.tracker = _get_tracker(policy.name)
+
+    def call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Call ``fn`` with deadlines, retries, hedging and the circuit breaker.
+
+        ``fn`` runs once per attempt and per hedged request, possibly at the
+        same time, so it must not share mutable state between runs; use
+        call_task for repenseai tasks.
+
+        Args:
+            fn: The blocking function to call
+            args: Positional arguments for fn
+            kwargs: Keyword arguments for fn
+
+        Returns:
+            Any: The first successful result
+
+        Raises:
+            CircuitOpenError: If the circuit is open
+            TimeoutError: If the last attempt exceeded its deadline
+            Exception: The last error raised by fn once retries are exhausted
+        """
+        policy = self.policy
+        deadline = time.monotonic() + policy.budget
+        last_error: Optional[BaseException] = None
+
+        for attempt in range(policy.retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Circuit open for {policy.name}")
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                result = self._attempt(fn, args, kwargs, min(policy.timeout, remaining))
+
+                if policy.retry_on_empty and not result:
+                    raise ValueError(f"Empty response from {policy.name}")
+
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                last_error = e
+                self.breaker.record_failure()
+                logger.warning("%s attempt %s/%s failed: %r", policy.name, attempt + 1, policy.retries + 1, e)
+
+            if attempt < policy.retries:
+                # Full jitter: spreads retries of concurrent conversations apart
+                delay = random.uniform(0, min(policy.max_backoff, policy.backoff * 2 ** attempt))
+                time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+
+        raise last_error or TimeoutError(f"{policy.name} exceeded its {policy.budget}s budget")
+
+    def call_task(self, make_task: Callable[[], Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a task built fresh for every attempt, see ``call``.
+
+        A Task accumulates its prompt while it runs, so retries and hedged
+        requests must never share one.
+
+        Args:
+            make_task: Builds the Task to run
+            args: Positional arguments for the task's run
+            kwargs: Keyword arguments for the task's run
+
+        Returns:
+            Any: The first successful result
+        """
+        return self.call(lambda *a, **k: make_task().run(*a, **k), *args, **kwargs)
+
+    def _attempt(self, fn: Callable[..., Any], args: tuple, kwargs: dict, timeout: float) -> Any:
+        start = time.monotonic()
+        futures = [_executor.submit(fn, *args, **kwargs)]
+
+        hedge_after = self.tracker.p95() if self.policy.hedge else None
+
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                logger.info("%s exceeded p95 (%.2fs), sending hedged request", self.policy.name, hedge_after)
+                futures.append(_executor.submit(fn, *args, **kwargs))
+
+        pending = set(futures)
+        error: Optional[BaseException] = None
+
+        while pending:
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+
+                self.tracker.add(time.monotonic() - start)
+                return result
+
+        if error is not None and not pending:
+            raise error
+
+        raise TimeoutError(f"{self.policy.name} did not answer within {timeout:.1f}s")
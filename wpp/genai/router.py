@@ -0,0 +1,162 @@
+"""
+Tiered model routing.
+
+Classifies each turn by cheap features and picks a fast or a strong model,
+escalating to the strong model when the fast one fails.
+"""
+
+import os
+import re
+import logging
+from typing import Any, Optional, Type
+
+from pydantic import BaseModel, ValidationError
+
+from wpp.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+FAST = "fast"
+STRONG = "strong"
+
+# Message types the bot uses for menus and acknowledgements; picking an
+# option from them rarely needs the strong model.
+MENU_MESSAGE_TYPES = {"listMessage", "interactive", "buttonsResponseMessage", "buttonReply"}
+
+GREETINGS = {
+    "oi", "ola", "olá", "bom dia", "boa tarde", "boa noite", "opa", "e ai", "e aí",
+    "tudo bem", "obrigado", "obrigada", "ok", "blz", "beleza",
+}
+
+
+class ModelRouter:
+    """
+    Route model calls to a fast or a strong tier.
+
+    Models and thresholds come from the environment so they can be tuned
+    from the per-tier latency metrics without a deploy.
+    """
+
+    def __init__(self, redis: Any = None) -> None:
+        """
+        Initialize the router.
+
+        Args:
+            redis: Redis client used to record per-tier latency (optional)
+        """
+        self.models = {
+            FAST: os.getenv("LLM_FAST_MODEL", "gpt-4.1-mini"),
+            STRONG: os.getenv("LLM_STRONG_MODEL", "gpt-4.1"),
+        }
+        self.short_text = int(os.getenv("LLM_ROUTER_SHORT_TEXT", "60"))
+        self.metrics = Metrics(redis) if redis is not None else None
+
+    def model_for(self, tier: str) -> str:
+        """Return the model name configured for a tier."""
+        return self.models.get(tier, self.models[STRONG])
+
+    def classify_step1(self, message_type: str, text: str, slots: dict) -> str:
+        """
+        Choose the tier for a step 1 turn.
+
+        Short messages without digits (greetings, "quero ajuda") go to the fast
+        tier. Turns that may carry a CPF, long descriptions, or that could
+        complete the extracted data go to the strong tier.
+
+        Args:
+            message_type: The WppPayload type of the incoming message
+            text: The new user text
+            slots: The current partially filled ExtractedData
+
+        Returns:
+            str: FAST or STRONG
+        """
+        text = (text or "").strip()
+        required = [k for k in ("nome", "CPF", "problema") if k in slots]
+        missing = [k for k in required if not slots.get(k)]
+
+        if text.lower().strip("!.?, ") in GREETINGS:
+            return FAST
+
+        if re.search(r"\d", text) or len(text) > self.short_text:
+            return STRONG
+
+        # One field away from "ok": the final validation deserves the strong model
+        if required and len(missing) <= 1:
+            return STRONG
+
+        if message_type in MENU_MESSAGE_TYPES:
+            return FAST
+
+        return FAST if len(text) <= self.short_text else STRONG
+
+    def classify_step2(self, event_source: str, message_type: str, text: str) -> str:
+        """
+        Choose the tier for a step 2 turn.
+
+        Bot menus and short bot acknowledgements go to the fast tier; anything
+        coming from the user, or long bot messages, go to the strong tier.
+
+        Args:
+            event_source: "bot" or "user"
+            message_type: The WppPayload type of the incoming message
+            text: The flattened message text
+
+        Returns:
+            str: FAST or STRONG
+        """
+        if event_source != "bot":
+            return STRONG
+
+        if message_type in MENU_MESSAGE_TYPES:
+            return FAST
+
+        return FAST if len((text or "").strip()) <= self.short_text else STRONG
+
+    @staticmethod
+    def needs_escalation(response: Any, schema: Optional[Type[BaseModel]] = None) -> bool:
+        """
+        Decide whether a fast-tier response must be redone on the strong tier.
+
+        Escalates on empty responses, on schema-validation failures and on low
+        confidence answers. For step 1, an "ok" status is treated as low
+        confidence because it moves the conversation to step 2 irreversibly.
+
+        Args:
+            response: The response returned by the fast model
+            schema: Pydantic model the response must validate against
+
+        Returns:
+            bool: True if the strong tier should be called
+        """
+        if not response:
+            return True
+
+        if schema is None:
+            return False
+
+        try:
+            parsed = schema.model_validate(response)
+        except ValidationError:
+            return True
+
+        status = getattr(parsed, "validation_status", None)
+        if status is not None and status not in ("follow-up", "error"):
+            return True
+
+        return False
+
+    def record_latency(self, step: str, tier: str, seconds: float) -> None:
+        """
+        Log and record the latency of a model call.
+
+        Args:
+            step: "step1" or "step2"
+            tier: FAST or STRONG
+            seconds: Duration of the call
+        """
+        logger.info("LLM %s tier=%s model=%s latency=%.2fs", step, tier, self.model_for(tier), seconds)
+
+        if self.metrics:
+            self.metrics.observe(f"llm.{step}.{tier}.latency", seconds)
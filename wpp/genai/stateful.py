@@ -0,0 +1,443 @@
+"""
+Server-side conversation state for step 2.
+
+With a stateful backend (the OpenAI Responses API) the provider keeps the
+conversation, so each turn only uploads the new input and the tool results,
+chained with previous_response_id. The local chat history stays the source
+of truth: when the remote state is gone (expired, or the local history
+diverged from it) the turn falls back to resending the whole history.
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import inspect
+import logging
+from typing import Any, Callable, Optional
+
+from wpp.media.handle import strip_media
+from wpp.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+# "local": full history resent through repenseai on every turn (default)
+# "openai": provider-side state through the Responses API
+# "mock": in-process stand-in of the Responses API, for offline runs
+STATE_BACKEND = os.getenv("LLM_STATE_BACKEND", "local")
+
+if STATE_BACKEND not in ("local", "openai", "mock"):
+    # A typo must not silently run production turns on the mock
+    raise ValueError(f"Unknown LLM_STATE_BACKEND: {STATE_BACKEND!r} (expected local, openai or mock)")
+
+# Remote state older than this is not worth chaining to (OpenAI keeps it 30 days)
+STATE_TTL = int(os.getenv("LLM_STATE_TTL", str(7 * 86400)))
+
+JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+
+class RemoteStateExpired(Exception):
+    """The previous response id is unknown to the provider."""
+
+
+class ToolRoundsExceeded(Exception):
+    """The model kept calling tools and never wrote anything in the turn."""
+
+
+def function_tool(fn: Callable) -> dict:
+    """
+    Describe a Python function as a Responses API function tool.
+
+    Args:
+        fn: Tool function with annotated parameters and a docstring
+
+    Returns:
+        dict: The tool definition
+    """
+    properties = {}
+    required = []
+
+    for name, param in inspect.signature(fn).parameters.items():
+        properties[name] = {"type": JSON_TYPES.get(param.annotation, "string")}
+        if param.default is inspect.Parameter.empty:
+            required.append(name)
+
+    doc = inspect.getdoc(fn) or ""
+
+    return {
+        "type": "function",
+        "name": fn.__name__,
+        "description": doc.split("\n\n")[0],
+        "parameters": {
+            "type": "object",
+            "properties": properties,
+            "required": required,
+            "additionalProperties": False,
+        },
+    }
+
+
+def _text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            part.get("text", "") for part in content
+            if isinstance(part, dict) and part.get("type") == "text"
+        )
+    return "" if content is None else str(content)
+
+
+def to_input_items(history: list) -> list:
+    """
+    Convert a chat-completions style history into Responses API input items.
+
+    Args:
+        history: Messages with role/content, assistant tool_calls and tool results
+
+    Returns:
+        list: The equivalent input items
+    """
+    items = []
+
+    for message in history:
+        if not isinstance(message, dict):
+            continue
+
+        role = message.get("role")
+        content = message.get("content")
+
+        if role == "tool":
+            items.append({
+                "type": "function_call_output",
+                "call_id": message.get("tool_call_id", ""),
+                "output": _text(content),
+            })
+            continue
+
+        if isinstance(content, list) and any(
+            isinstance(part, dict) and part.get("type") == "image_url" for part in content
+        ):
+            parts = []
+            for part in content:
+                if part.get("type") == "text":
+                    parts.append({"type": "input_text", "text": part.get("text", "")})
+                elif part.get("type") == "image_url":
+                    url = part["image_url"]["url"] if isinstance(part["image_url"], dict) else part["image_url"]
+                    parts.append({"type": "input_image", "image_url": url})
+            items.append({"role": role, "content": parts})
+        elif _text(content):
+            items.append({"role": role, "content": _text(content)})
+
+        for call in message.get("tool_calls") or []:
+            items.append({
+                "type": "function_call",
+                "call_id": call.get("id", ""),
+                "name": call["function"]["name"],
+                "arguments": call["function"].get("arguments", "{}"),
+            })
+
+    return items
+
+
+def history_digest(history: list) -> str:
+    """
+    Fingerprint of a history, insensitive to how the content parts are laid out.
+
+    Attached images are left out: they are only sent on the turn they arrive
+    and the stored history keeps their text notes (wpp.media.handle.strip_media).
+    """
+    payload = json.dumps(to_input_items(strip_media(history)), ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class OpenAIResponsesBackend:
+    """Responses API client with stored, chainable responses."""
+
+    def __init__(self) -> None:
+        # Imported here: only deployments that enable this backend need the client
+        import openai
+
+        self.openai = openai
+        self.client = openai.OpenAI()
+
+    def create(
+        self,
+        model: str,
+        input: list,
+        tools: list,
+        previous_response_id: Optional[str] = None,
+    ) -> dict:
+        """
+        Create a response.
+
+        Raises:
+            RemoteStateExpired: If previous_response_id is no longer available
+        """
+        try:
+            response = self.client.responses.create(
+                model=model,
+                input=input,
+                tools=tools,
+                previous_response_id=previous_response_id,
+                store=True,
+            )
+        except self.openai.NotFoundError as e:
+            raise RemoteStateExpired(str(e)) from e
+        except self.openai.BadRequestError as e:
+            if previous_response_id and "previous_response" in str(e):
+                raise RemoteStateExpired(str(e)) from e
+            raise
+
+        return response.model_dump()
+
+
+class MockResponsesBackend:
+    """
+    In-process stand-in for the Responses API.
+
+    Keeps every response chain in memory and answers through ``responder``,
+    so the incremental and fallback paths can be exercised offline. Every
+    request is recorded in ``requests``.
+    """
+
+    def __init__(self, responder: Optional[Callable[[list, list], list]] = None) -> None:
+        """
+        Initialize the mock.
+
+        Args:
+            responder: Receives the full input chain and the tools, returns the
+                output items. Defaults to a message echoing the last user input
+        """
+        self.responder = responder or self._echo
+        self.chains: dict[str, list] = {}
+        self.requests: list[dict] = []
+
+    @staticmethod
+    def _echo(chain: list, tools: list) -> list:
+        last = next((item for item in reversed(chain) if item.get("role") == "user"), {})
+        return [{
+            "type": "message",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": f"mock: {_text(last.get('content'))}"}],
+        }]
+
+    def expire(self, response_id: Optional[str] = None) -> None:
+        """Forget one stored response, or all of them."""
+        if response_id:
+            self.chains.pop(response_id, None)
+        else:
+            self.chains.clear()
+
+    def create(
+        self,
+        model: str,
+        input: list,
+        tools: list,
+        previous_response_id: Optional[str] = None,
+    ) -> dict:
+        self.requests.append({"model": model, "input": input, "previous_response_id": previous_response_id})
+
+        if previous_response_id:
+            if previous_response_id not in self.chains:
+                raise RemoteStateExpired(previous_response_id)
+            chain = self.chains[previous_response_id] + list(input)
+        else:
+            chain = list(input)
+
+        output = self.responder(chain, tools)
+        response_id = f"resp_{uuid.uuid4().hex}"
+        self.chains[response_id] = chain + output
+
+        return {"id": response_id, "output": output}
+
+
+_backend = None
+
+
+def get_backend() -> Any:
+    """Return the process-wide backend selected by LLM_STATE_BACKEND."""
+    global _backend
+    if _backend is None:
+        if STATE_BACKEND == "openai":
+            _backend = OpenAIResponsesBackend()
+        elif STATE_BACKEND == "mock":
+            _backend = MockResponsesBackend()
+        else:
+            raise ValueError(f"LLM_STATE_BACKEND={STATE_BACKEND!r} has no stateful backend")
+    return _backend
+
+
+class StatefulTask:
+    """
+    Step 2 turn on a stateful backend, a drop-in for repenseai's Task.
+
+    ``run()`` returns the assistant text and ``prompt`` holds the updated
+    local history (user input, tool calls, tool results, answer) in the
+    same chat format the rest of step 2 stores.
+    """
+
+    def __init__(
+        self,
+        redis: Any,
+        backend: Any,
+        conversation_key: str,
+        model: str,
+        tools: list[Callable],
+        history: list,
+        user: str,
+        max_tool_rounds: int = 8,
+    ) -> None:
+        """
+        Initialize the turn.
+
+        Args:
+            redis: Redis client instance, where the remote response id is kept
+            backend: OpenAIResponsesBackend or MockResponsesBackend
+            conversation_key: Conversation the remote state belongs to
+            model: Model name
+            tools: Tool functions the model may call
+            history: Local history before this turn
+            user: New user input
+            max_tool_rounds: Maximum model calls in the turn
+        """
+        self.redis = redis
+        self.backend = backend
+        self.state_key = f"llm_state:{conversation_key}"
+        self.model = model
+        self.tools = {fn.__name__: fn for fn in tools}
+        self.tool_schemas = [function_tool(fn) for fn in tools]
+        self.prompt = list(history)
+        self.user = user
+        self.max_tool_rounds = max_tool_rounds
+        self.metrics = Metrics(redis)
+
+    def _load_state(self) -> Optional[str]:
+        """Return the remote response id if it still matches the local history."""
+        try:
+            state = self.redis.hgetall(self.state_key)
+        except Exception as e:
+            logger.warning("Erro ao ler o estado remoto da conversa: %s", e)
+            return None
+
+        state = {
+            (k.decode("utf-8") if isinstance(k, bytes) else k): (v.decode("utf-8") if isinstance(v, bytes) else v)
+            for k, v in state.items()
+        }
+
+        if not state.get("response_id") or state.get("digest") != history_digest(self.prompt):
+            return None
+        return state["response_id"]
+
+    def _save_state(self, response_id: str) -> None:
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hset(self.state_key, mapping={"response_id": response_id, "digest": history_digest(self.prompt)})
+            pipe.expire(self.state_key, STATE_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Erro ao gravar o estado remoto da conversa: %s", e)
+
+    def _format(self, context: Optional[dict]) -> str:
+        # Only known placeholders are filled: user text may contain braces
+        user = self.user
+        for key, value in (context or {}).items():
+            user = user.replace(f"{{{key}}}", str(value))
+        return user
+
+    def run(self, context: Optional[dict] = None) -> str:
+        """
+        Run the turn, executing tool calls until the model answers.
+
+        Args:
+            context: Values for placeholders in the user input
+
+        Returns:
+            str: The assistant's answer. If the model is still calling tools
+            after max_tool_rounds, the last text it wrote in the turn
+
+        Raises:
+            ToolRoundsExceeded: The rounds ran out and the model wrote no text
+        """
+        user = self._format(context)
+        partial = ""
+
+        previous_id = self._load_state()
+        self.prompt.append({"role": "user", "content": [{"type": "text", "text": user}]})
+
+        if previous_id:
+            pending = [{"role": "user", "content": user}]
+        else:
+            pending = to_input_items(self.prompt)
+
+        self.metrics.incr("llm_state.incremental" if previous_id else "llm_state.full")
+
+        for _ in range(self.max_tool_rounds):
+            try:
+                response = self.backend.create(self.model, pending, self.tool_schemas, previous_id)
+            except RemoteStateExpired:
+                if not previous_id:
+                    raise
+                logger.info("Remote state %s expired, resending the full history", previous_id)
+                self.metrics.incr("llm_state.expired")
+                previous_id = None
+                pending = to_input_items(self.prompt)
+                continue
+
+            self.metrics.observe("llm_state.input_items", len(pending))
+            previous_id = response["id"]
+
+            calls = [item for item in response["output"] if item.get("type") == "function_call"]
+            answer = "".join(
+                part.get("text", "")
+                for item in response["output"]
+                if item.get("type") == "message"
+                for part in item.get("content", [])
+            )
+
+            if not calls:
+                self.prompt.append({"role": "assistant", "content": [{"type": "text", "text": answer}]})
+                self._save_state(previous_id)
+                return answer
+
+            partial = answer or partial
+            self.prompt.append({
+                "role": "assistant",
+                # Text written alongside the calls is kept
+                "content": [{"type": "text", "text": answer}] if answer else None,
+                "tool_calls": [
+                    {
+                        "id": call["call_id"],
+                        "type": "function",
+                        "function": {"name": call["name"], "arguments": call.get("arguments", "{}")},
+                    }
+                    for call in calls
+                ],
+            })
+
+            pending = []
+            for call in calls:
+                output = self._call_tool(call)
+                self.prompt.append({"role": "tool", "tool_call_id": call["call_id"], "content": output})
+                pending.append({"type": "function_call_output", "call_id": call["call_id"], "output": output})
+
+        logger.warning("Stateful turn stopped after %s model calls", self.max_tool_rounds)
+        if not partial:
+            raise ToolRoundsExceeded(f"No answer after {self.max_tool_rounds} model calls")
+
+        self._save_state(previous_id)
+        return partial
+
+    def _call_tool(self, call: dict) -> str:
+        fn = self.tools.get(call["name"])
+        if fn is None:
+            return f"Unknown tool: {call['name']}"
+
+        try:
+            result = fn(**json.loads(call.get("arguments") or "{}"))
+        except Exception as e:
+            logger.error("Tool %s failed: %s", call['name'], e)
+            return f"Error: {e}"
+
+        return "ok" if result is None else str(result)
@@ -0,0 +1,231 @@
+"""
+Structured, non-blocking logging.
+
+Request threads only put log records on an in-memory queue; a background
+listener formats them as JSON lines and writes them out. Formatting is
+lazy (records keep their arguments until the listener formats them),
+chatty events are sampled before being queued, CPFs and phone numbers
+are masked and long messages are then truncated before anything is
+written. Forked media worker processes log synchronously instead (see
+configure_worker_logging).
+"""
+
+import os
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# Punctuated CPF (000.000.000-00); bare 11-digit CPFs are caught by the digit runs below
+CPF_PATTERN = re.compile(r"(?<!\d)\d{3}\.\d{3}\.\d{3}-\d{2}(?!\d)")
+
+# Phone numbers: Brazilian numbers with optional country and area code, or any long digit run
+PHONE_PATTERN = re.compile(
+    r"(?<!\d)(?:\+?55\s?)?\(?\d{2}\)?\s?9?\d{4}[-\s]?\d{4}(?!\d)|(?<!\d)\d{10,13}(?!\d)"
+)
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def redact(text: str) -> str:
+    """Mask CPFs and phone numbers, keeping the last digits of phones for correlation."""
+    text = CPF_PATTERN.sub("***.***.***-**", text)
+
+    def mask_phone(match: re.Match) -> str:
+        digits = re.sub(r"\D", "", match.group(0))
+        return "*" * (len(digits) - 4) + digits[-4:]
+
+    return PHONE_PATTERN.sub(mask_phone, text)
+
+
+def parse_sample_rates(value: str) -> dict[str, float]:
+    """Parse ``event=rate,event=rate`` into a dict."""
+    rates = {}
+    for item in value.split(","):
+        if "=" in item:
+            event, rate = item.split("=", 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records of each sampled event.
+
+    Records name their event with ``extra={"event": ...}``. Warnings and
+    errors are never dropped, nor are records of events without a rate.
+    """
+
+    def __init__(self, rates: dict[str, float]) -> None:
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks or formats in the calling thread.
+
+    The stock handler formats every record before queueing it; the queue
+    here is in-process, so records are queued as they are and formatted by
+    the listener. When the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, truncated and redacted."""
+
+    def __init__(self, max_chars: int = 2000) -> None:
+        super().__init__()
+        self.max_chars = max_chars
+
+    def _clip(self, text: str) -> str:
+        # Redacted first: a cut could split a CPF or phone and leave its digits unmatched
+        text = redact(text)
+        if len(text) > self.max_chars:
+            text = f"{text[:self.max_chars]}... [{len(text) - self.max_chars} chars truncated]"
+        return text
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": self._clip(record.getMessage()),
+        }
+
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and not name.startswith("_"):
+                entry[name] = self._clip(value) if isinstance(value, str) else value
+
+        if record.exc_info:
+            entry["exception"] = redact(self.formatException(record.exc_info))
+
+        return json.dumps(entry, ensure_ascii=False, default=lambda value: self._clip(str(value)))
+
+
+class TextFormatter(logging.Formatter):
+    """Plain text lines for local development, truncated and redacted."""
+
+    def __init__(self, max_chars: int = 2000) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.max_chars = max_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = redact(super().format(record))
+        if len(text) > self.max_chars:
+            text = f"{text[:self.max_chars]}... [{len(text) - self.max_chars} chars truncated]"
+        return text
+
+
+_listener: Optional[QueueListener] = None
+_lock = threading.Lock()
+
+
+def _build_output() -> logging.Handler:
+    """Handler that writes formatted records to stdout."""
+    max_chars = int(os.getenv("LOG_MAX_CHARS", "2000"))
+    formatter = TextFormatter(max_chars) if os.getenv("LOG_FORMAT", "json") == "text" else JsonFormatter(max_chars)
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+    return output
+
+
+def _sampling_filter() -> SamplingFilter:
+    return SamplingFilter(parse_sample_rates(
+        os.getenv("LOG_SAMPLE_RATES", "webhook.received=0.1,zapi.raw_event=0.1")
+    ))
+
+
+def configure_logging(level: Optional[str] = None) -> None:
+    """
+    Route the root logger through the background queue.
+
+    Safe to call more than once; only the first call installs the pipeline.
+
+    Args:
+        level: Root log level. Defaults to LOG_LEVEL
+    """
+    global _listener
+
+    with _lock:
+        if _listener is not None:
+            return
+
+        output = _build_output()
+
+        log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+        handler = NonBlockingQueueHandler(log_queue)
+        handler.addFilter(_sampling_filter())
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+
+def configure_worker_logging() -> None:
+    """
+    Log synchronously from a media worker process (ProcessPoolExecutor initializer).
+
+    Workers are started by forkserver or spawn (wpp.workers), so they do not
+    inherit the parent's handlers and there is no listener thread to feed a
+    queue. They write directly, with the same format and sampling.
+    """
+    global _listener
+
+    # No listener runs in this process
+    _listener = None
+
+    output = _build_output()
+    output.addFilter(_sampling_filter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(output)
+    # Nothing is inherited from the parent, the level included
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+
+def stop_logging() -> None:
+    """Flush the queued records and stop the background writer."""
+    global _listener
+
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
@@ -0,0 +1,224 @@
+"""
+Audio transcription pipeline.
+
+Streams voice notes with a size cap, transcribes long notes in parallel
+chunks and caches transcripts by content hash.
+"""
+
+import os
+import glob
+import shutil
+import hashlib
+import logging
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import requests
+
+from repenseai.genai.agent import Agent
+from repenseai.genai.tasks.api import Task
+
+from wpp.genai.resilience import CallPolicy, ResilientCaller
+
+logger = logging.getLogger(__name__)
+
+
+class AudioTooLargeError(Exception):
+    """Raised when a voice note exceeds the configured size or duration cap."""
+
+
+# Stands for a chunk Whisper could not transcribe, so the model knows part is missing
+GAP_MARKER = "[trecho não transcrito]"
+
+
+class AudioTranscriber:
+    """
+    Download and transcribe voice notes with Whisper.
+
+    The strategy is chosen up front from ``Audio.seconds``: notes longer than
+    ``max_seconds`` are rejected without downloading, notes longer than
+    ``chunk_seconds`` are split with ffmpeg (when available) and the chunks
+    are transcribed in parallel, everything else is transcribed in one call.
+    Transcripts are cached by the SHA-256 of the audio bytes, with the URL as
+    a secondary index so a repeated URL skips the download as well. Empty
+    transcripts and transcripts with gaps are not cached: the next attempt
+    may do better.
+    """
+
+    def __init__(self, redis: Any) -> None:
+        """
+        Initialize the transcriber.
+
+        Args:
+            redis: Redis client instance used for the transcript cache
+        """
+        self.redis = redis
+        self.max_bytes = int(os.getenv("AUDIO_MAX_BYTES", str(16 * 1024 * 1024)))
+        self.max_seconds = int(os.getenv("AUDIO_MAX_SECONDS", "900"))
+        self.chunk_seconds = int(os.getenv("AUDIO_CHUNK_SECONDS", "60"))
+        self.parallelism = int(os.getenv("AUDIO_PARALLELISM", "4"))
+        self.cache_ttl = int(os.getenv("AUDIO_CACHE_TTL", str(7 * 86400)))
+
+    @staticmethod
+    def _url_key(url: str) -> str:
+        return f"audio_transcript_url:{hashlib.sha256(url.encode('utf-8')).hexdigest()}"
+
+    @staticmethod
+    def _content_key(digest: str) -> str:
+        return f"audio_transcript:{digest}"
+
+    def _get_cached(self, key: str) -> str | None:
+        try:
+            value = self.redis.get(key)
+        except Exception as e:
+            logger.warning("Erro ao ler o cache de transcrição: %s", e)
+            return None
+
+        if value is None:
+            return None
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def transcribe(self, url: str, seconds: int = 0) -> str:
+        """
+        Transcribe the voice note at ``url``.
+
+        Args:
+            url: Z-API audio URL
+            seconds: Duration reported by the payload (Audio.seconds)
+
+        Returns:
+            str: The transcript
+
+        Raises:
+            AudioTooLargeError: If the note exceeds the duration or size cap
+        """
+        if seconds and seconds > self.max_seconds:
+            raise AudioTooLargeError(f"Audio with {seconds}s exceeds the {self.max_seconds}s limit")
+
+        url_key = self._url_key(url)
+        cached = self._get_cached(url_key)
+        if cached is not None:
+            logger.info("Audio transcript served from cache (url)")
+            return cached
+
+        audio = self._download(url)
+        digest = hashlib.sha256(audio).hexdigest()
+        content_key = self._content_key(digest)
+
+        transcript = self._get_cached(content_key)
+        complete = True
+        if transcript is not None:
+            logger.info("Audio transcript served from cache (content)")
+        else:
+            if seconds > self.chunk_seconds and shutil.which("ffmpeg"):
+                transcript, complete = self._transcribe_chunked(audio)
+            else:
+                transcript = self._transcribe_bytes(audio)
+
+        if not transcript.strip() or not complete:
+            logger.info("Audio transcript %s, not cached", "incomplete" if transcript.strip() else "empty")
+            return transcript
+
+        try:
+            pipe = self.redis.pipeline()
+            pipe.setex(content_key, self.cache_ttl, transcript)
+            pipe.setex(url_key, self.cache_ttl, transcript)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Erro ao gravar o cache de transcrição: %s", e)
+
+        return transcript
+
+    def _download(self, url: str) -> bytes:
+        """Stream the audio, aborting as soon as it exceeds max_bytes."""
+        chunks = []
+        size = 0
+
+        with requests.get(url, stream=True, timeout=(5, 30)) as response:
+            response.raise_for_status()
+
+            declared = int(response.headers.get("Content-Length") or 0)
+            if declared > self.max_bytes:
+                raise AudioTooLargeError(f"Audio with {declared} bytes exceeds the {self.max_bytes} limit")
+
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise AudioTooLargeError(f"Audio exceeds the {self.max_bytes} bytes limit")
+                chunks.append(chunk)
+
+        return b"".join(chunks)
+
+    @staticmethod
+    def _transcribe_bytes(audio: bytes) -> str:
+        transcription = ResilientCaller(
+            CallPolicy("whisper", retries=1)
+        ).call_task(
+            lambda: Task(agent=Agent(model="whisper-1", model_type="audio")),
+            {"audio": audio},
+        )
+
+        if isinstance(transcription, dict):
+            return transcription.get("response", "")
+        return str(transcription)
+
+    def _transcribe_chunked(self, audio: bytes) -> tuple[str, bool]:
+        """
+        Split the note into chunk_seconds segments and transcribe them in parallel.
+
+        Returns:
+            tuple[str, bool]: The transcript and whether every chunk was transcribed
+        """
+        with tempfile.TemporaryDirectory(prefix="wpp-audio-") as tmp:
+            source = os.path.join(tmp, "source")
+            with open(source, "wb") as f:
+                f.write(audio)
+
+            # Stream copy: no re-encoding, the split only cuts at packet boundaries
+            result = subprocess.run(
+                [
+                    "ffmpeg", "-loglevel", "error", "-i", source,
+                    "-f", "segment", "-segment_time", str(self.chunk_seconds),
+                    "-c", "copy", os.path.join(tmp, "chunk%03d.ogg"),
+                ],
+                capture_output=True,
+                timeout=60,
+            )
+
+            paths = sorted(glob.glob(os.path.join(tmp, "chunk*.ogg")))
+            if result.returncode != 0 or not paths:
+                logger.warning("Falha ao dividir o áudio, transcrevendo inteiro: %r", result.stderr[:200])
+                return self._transcribe_bytes(audio), True
+
+            chunks = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    chunks.append(f.read())
+
+        return self._transcribe_parts(chunks)
+
+    def _transcribe_parts(self, chunks: list[bytes]) -> tuple[str, bool]:
+        """
+        Transcribe chunks in parallel, marking the ones that failed with GAP_MARKER.
+
+        Raises:
+            Exception: The last error, if no chunk could be transcribed
+        """
+        def transcribe_chunk(chunk: bytes) -> tuple[str | None, Exception | None]:
+            try:
+                return self._transcribe_bytes(chunk), None
+            except Exception as e:
+                logger.warning("Falha ao transcrever um trecho do áudio: %r", e)
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            results = list(executor.map(transcribe_chunk, chunks))
+
+        errors = [error for _, error in results if error is not None]
+        if errors and len(errors) == len(results):
+            raise errors[-1]
+
+        parts = [GAP_MARKER if error is not None else (text or "").strip() for text, error in results]
+        return " ".join(part for part in parts if part), not errors
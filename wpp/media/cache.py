@@ -0,0 +1,211 @@
+"""
+Content-addressed media cache.
+
+Stores processed attachments (rasterized pages, encoded images) keyed by
+the SHA-256 of the original bytes, with the URL as a secondary index and
+size-based LRU eviction. Also provides the perceptual hash used by the
+media triage to spot near-duplicate attachments.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import Any, Optional
+
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """
+    Cache of processed media artifacts.
+
+    Artifacts live either in Redis or on local disk (MEDIA_CACHE_BACKEND),
+    while the bookkeeping (URL index, LRU order and sizes) is always kept in
+    Redis so every worker shares it.
+    """
+
+    def __init__(self, redis: Any, namespace: str = "media_cache") -> None:
+        """
+        Initialize the media cache.
+
+        Args:
+            redis: Redis client instance
+            namespace: Prefix for the Redis keys
+        """
+        self.redis = redis
+        self.namespace = namespace
+
+        self.backend = os.getenv("MEDIA_CACHE_BACKEND", "redis")
+        self.directory = os.getenv("MEDIA_CACHE_DIR", "/tmp/wpp-media-cache")
+        self.max_bytes = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+        self.url_ttl = int(os.getenv("MEDIA_CACHE_URL_TTL", str(7 * 86400)))
+
+        self.lru_key = f"{namespace}:lru"
+        self.sizes_key = f"{namespace}:sizes"
+
+    @staticmethod
+    def content_hash(data: bytes) -> str:
+        """Return the SHA-256 hex digest of the media bytes."""
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def perceptual_hash(image: Image.Image) -> str:
+        """
+        Compute a 64-bit difference hash (dHash) of an image.
+
+        Resizing and re-encoding barely change it, so near-duplicate
+        screenshots end up a few bits apart.
+        """
+        small = image.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+        pixels = list(small.getdata())
+
+        bits = 0
+        for row in range(8):
+            for col in range(8):
+                left = pixels[row * 9 + col]
+                right = pixels[row * 9 + col + 1]
+                bits = (bits << 1) | (left > right)
+
+        return f"{bits:016x}"
+
+    @staticmethod
+    def hamming(a: str, b: str) -> int:
+        """Number of differing bits between two perceptual hashes."""
+        return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+    def _url_key(self, url: str) -> str:
+        return f"{self.namespace}:url:{hashlib.sha256(url.encode('utf-8')).hexdigest()}"
+
+    def _entry(self, digest: str, kind: str) -> str:
+        return f"{digest}:{kind}"
+
+    def _path(self, digest: str, kind: str) -> str:
+        return os.path.join(self.directory, digest[:2], f"{digest}.{kind}.json")
+
+    @staticmethod
+    def _decode(value: Any) -> Any:
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def lookup_url(self, url: str) -> Optional[str]:
+        """
+        Return the content hash previously seen for a URL.
+
+        Args:
+            url: Media URL
+
+        Returns:
+            str: The content hash, or None if the URL is unknown
+        """
+        try:
+            return self._decode(self.redis.get(self._url_key(url)))
+        except Exception as e:
+            logger.warning("Erro ao ler o índice de mídia: %s", e)
+            return None
+
+    def index_url(self, url: str, digest: str) -> None:
+        """Record the content hash of a URL."""
+        try:
+            self.redis.setex(self._url_key(url), self.url_ttl, digest)
+        except Exception as e:
+            logger.warning("Erro ao gravar o índice de mídia: %s", e)
+
+    def get(self, digest: str, kind: str) -> Any:
+        """
+        Read a processed artifact and mark it as recently used.
+
+        Args:
+            digest: Content hash of the original media
+            kind: Artifact type, e.g. "pdf_pages"
+
+        Returns:
+            Any: The artifact, or None on a miss
+        """
+        entry = self._entry(digest, kind)
+
+        try:
+            if self.backend == "disk":
+                path = self._path(digest, kind)
+                if not os.path.exists(path):
+                    return None
+                with open(path, "r", encoding="utf-8") as f:
+                    value = json.load(f)
+            else:
+                raw = self.redis.get(f"{self.namespace}:{entry}")
+                if raw is None:
+                    return None
+                value = json.loads(self._decode(raw))
+
+            self.redis.zadd(self.lru_key, {entry: time.time()})
+            return value
+        except Exception as e:
+            logger.warning("Erro ao ler o cache de mídia %s: %s", entry, e)
+            return None
+
+    def put(self, digest: str, kind: str, value: Any) -> None:
+        """
+        Store a processed artifact, evicting least recently used ones over the size limit.
+
+        Args:
+            digest: Content hash of the original media
+            kind: Artifact type, e.g. "pdf_pages"
+            value: JSON-serializable artifact
+        """
+        entry = self._entry(digest, kind)
+
+        try:
+            payload = json.dumps(value)
+            size = len(payload)
+
+            if size > self.max_bytes:
+                return
+
+            if self.backend == "disk":
+                path = self._path(digest, kind)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(payload)
+            else:
+                self.redis.set(f"{self.namespace}:{entry}", payload)
+
+            pipe = self.redis.pipeline()
+            pipe.zadd(self.lru_key, {entry: time.time()})
+            pipe.hset(self.sizes_key, entry, size)
+            pipe.execute()
+
+            self._evict()
+        except Exception as e:
+            logger.warning("Erro ao gravar o cache de mídia %s: %s", entry, e)
+
+    def _evict(self) -> None:
+        sizes = {self._decode(k): int(v) for k, v in self.redis.hgetall(self.sizes_key).items()}
+        total = sum(sizes.values())
+
+        if total <= self.max_bytes:
+            return
+
+        for raw_entry in self.redis.zrange(self.lru_key, 0, -1):
+            if total <= self.max_bytes:
+                break
+
+            entry = self._decode(raw_entry)
+            digest, kind = entry.split(":", 1)
+
+            if self.backend == "disk":
+                try:
+                    os.remove(self._path(digest, kind))
+                except FileNotFoundError:
+                    pass
+            else:
+                self.redis.delete(f"{self.namespace}:{entry}")
+
+            pipe = self.redis.pipeline()
+            pipe.zrem(self.lru_key, entry)
+            pipe.hdel(self.sizes_key, entry)
+            pipe.execute()
+
+            total -= sizes.get(entry, 0)
@@ -0,0 +1,241 @@
+"""
+Lazy media handles.
+
+Media messages are kept in memory as small handles (URL, hash, mime, page
+count); the download, rasterization and base64 encoding only happen when a
+model turn consumes the attachment. The rendered pages are sent with that
+turn only and stripped from the stored histories (see strip_media).
+"""
+
+import logging
+from typing import Any, Optional
+
+import requests
+from pydantic import BaseModel
+
+from wpp.media.cache import MediaCache
+from wpp.media.image import encode_jpeg, open_image, to_data_url
+from wpp.media.pdf import extract_page_texts, iter_pdf_pages, select_relevant_pages
+from wpp.media.triage import BLANK, MediaTriage
+from wpp.workers import get_media_pool
+
+logger = logging.getLogger(__name__)
+
+
+def strip_media(messages: list) -> list:
+    """
+    Drop the image parts of a chat history, keeping every text part.
+
+    Attachments are rendered for the turn they are shown on; histories kept
+    in memory only hold their text notes.
+
+    Args:
+        messages: Chat history, possibly with image_url content parts
+
+    Returns:
+        list: A new history without image parts
+    """
+    result = []
+    for message in messages:
+        if isinstance(message, dict) and isinstance(message.get("content"), list):
+            message = {
+                **message,
+                "content": [
+                    part for part in message["content"]
+                    if not (isinstance(part, dict) and part.get("type") == "image_url")
+                ],
+            }
+        result.append(message)
+    return result
+
+
+def count_media_pages(messages: list) -> int:
+    """Number of image parts in a chat history."""
+    return sum(
+        1
+        for message in messages
+        if isinstance(message, dict) and isinstance(message.get("content"), list)
+        for part in message["content"]
+        if isinstance(part, dict) and part.get("type") == "image_url"
+    )
+
+
+def encode_image_bytes(data: Any) -> str:
+    """Encode image bytes as a bounded-size JPEG data URL (runs in the media worker pool)."""
+    return to_data_url(encode_jpeg(open_image(bytes(data))))
+
+
+class MediaHandle(BaseModel):
+    """Reference to a media attachment, stored in memory instead of its rendered content."""
+
+    url: str
+    mime_type: str
+    kind: str  # "image" or "pdf"
+    page_count: int = 0
+    file_name: str = ""
+    sha256: Optional[str] = None
+    thumbnail_url: str = ""
+    triage: Optional[str] = None
+    phash: Optional[str] = None  # Perceptual hash of the thumbnail
+    pages: Optional[list[int]] = None  # PDF pages selected by the last render
+    number: int = 0  # "Anexo N" as the model refers to it (view_attachment)
+    announced: bool = False  # A model turn was told it exists
+
+    @classmethod
+    def from_input(cls, user_input: dict) -> Optional["MediaHandle"]:
+        """
+        Build a handle from the user input of an image or document message.
+
+        Returns:
+            MediaHandle: The handle, or None if the message carries no supported media
+        """
+        mime_type = user_input.get("mime_type", "")
+        url = user_input.get("document") or user_input.get("image") or ""
+
+        if not url:
+            return None
+
+        if "pdf" in mime_type:
+            kind = "pdf"
+        elif "image" in mime_type or (user_input.get("image") and not user_input.get("document")):
+            kind = "image"
+        else:
+            return None
+
+        page_count = user_input.get("page_count", 0)
+        if isinstance(page_count, str):
+            page_count = int(page_count) if page_count.isdigit() else 0
+
+        return cls(
+            url=url,
+            mime_type=mime_type or "image/jpeg",
+            kind=kind,
+            page_count=page_count or (1 if kind == "image" else 0),
+            file_name=user_input.get("file_name", ""),
+            thumbnail_url=user_input.get("thumbnail", ""),
+        )
+
+    def run_triage(self, redis: Any, known_phashes: list[str] = ()) -> str:
+        """
+        Classify the media from its thumbnail, before any full-size download.
+
+        The handle keeps its own identity: only a URL already downloaded (an
+        exact content match) gives it a content hash, so its render is a
+        cache lookup.
+
+        Args:
+            redis: Redis client instance
+            known_phashes: Perceptual hashes of the conversation's earlier attachments
+
+        Returns:
+            str: The triage verdict (see wpp.media.triage)
+        """
+        verdict, digest, phash = MediaTriage(redis).triage(
+            self.url,
+            self.thumbnail_url,
+            expect_document=self.kind == "pdf",
+            known_phashes=known_phashes,
+        )
+
+        self.triage = verdict
+        self.phash = phash
+        if digest:
+            self.sha256 = digest
+
+        return verdict
+
+    def render(self, redis: Any, query: str = "", known_phashes: list[str] = ()) -> list[str]:
+        """
+        Materialize the media as JPEG data URLs (one per page).
+
+        The thumbnail triage runs first, so blank media is never downloaded.
+        Results are cached by content hash, so rendering the same handle
+        again, or a resent copy of the same file, is a cache lookup. For PDFs
+        only the pages relevant to ``query`` are rendered (see
+        select_relevant_pages), and each page is cached on its own.
+
+        Args:
+            redis: Redis client instance
+            query: What the model is looking for, used to pick PDF pages
+            known_phashes: Perceptual hashes of the conversation's earlier attachments
+
+        Returns:
+            list[str]: The pages (or the single image) as base64 JPEG data URLs
+        """
+        if self.triage is None:
+            try:
+                self.run_triage(redis, known_phashes)
+            except Exception as e:
+                logger.warning("Media triage failed for %s: %s", self.url, e)
+
+        if self.triage == BLANK:
+            return []
+
+        media_cache = MediaCache(redis)
+
+        if self.kind == "pdf":
+            return self._render_pdf(media_cache, query)
+
+        artifact = "image_pages"
+
+        digest = self.sha256 or media_cache.lookup_url(self.url)
+        pages = media_cache.get(digest, artifact) if digest else None
+        if pages is not None:
+            return pages
+
+        content = self._download(media_cache)
+
+        pages = media_cache.get(self.sha256, artifact)
+        if pages is not None:
+            return pages
+
+        pages = [get_media_pool().submit_bytes(encode_image_bytes, content).result()]
+        media_cache.put(self.sha256, artifact, pages)
+
+        return pages
+
+    def _download(self, media_cache: MediaCache) -> bytes:
+        content = requests.get(self.url, timeout=(5, 60)).content
+        self.sha256 = media_cache.content_hash(content)
+        media_cache.index_url(self.url, self.sha256)
+        return content
+
+    def _render_pdf(self, media_cache: MediaCache, query: str) -> list[str]:
+        """Render only the relevant pages of a PDF, downloading it only if something is missing."""
+        content = None
+        digest = self.sha256 or media_cache.lookup_url(self.url)
+
+        texts = media_cache.get(digest, "pdf_text") if digest else None
+        if texts is None:
+            content = self._download(media_cache)
+            digest = self.sha256
+
+            texts = media_cache.get(digest, "pdf_text")
+            if texts is None:
+                texts = extract_page_texts(content)
+                media_cache.put(digest, "pdf_text", texts)
+
+        self.sha256 = digest
+        self.page_count = len(texts)
+        self.pages = select_relevant_pages(texts, query)
+
+        rendered = {}
+        for page in self.pages:
+            cached = media_cache.get(digest, f"pdf_page_{page}")
+            if cached is not None:
+                rendered[page] = cached
+
+        missing = [page for page in self.pages if page not in rendered]
+        if missing:
+            if content is None:
+                content = self._download(media_cache)
+
+            pool = get_media_pool()
+
+            # Pages are rendered one at a time in worker processes and
+            # arrive as soon as each one is encoded
+            for page, image_string in iter_pdf_pages(content, pages=missing, pool=pool):
+                rendered[page] = image_string
+                media_cache.put(digest, f"pdf_page_{page}", image_string)
+
+        return [rendered[page] for page in self.pages]
@@ -0,0 +1,152 @@
+"""
+Bounded-size JPEG encoding.
+
+Encodes images as JPEG under a byte budget with as few full encodes as
+possible: decode-time downscaling for JPEG sources, one probe encode to
+estimate the size curve and a binary search over the remaining quality
+range.
+"""
+
+import io
+import math
+import base64
+import logging
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+MAX_BYTES = 1048576
+MAX_SIZE = 1024
+
+MIN_QUALITY = 30
+MAX_QUALITY = 90
+
+# Binary search stops once the quality window is this narrow
+QUALITY_STEP = 5
+
+
+def open_image(data: bytes, max_size: int = MAX_SIZE) -> Image.Image:
+    """
+    Open image bytes, downscaling JPEGs while decoding.
+
+    ``draft`` makes libjpeg decode at 1/2, 1/4 or 1/8 scale directly, so a
+    12 MP photo is never fully materialized in memory.
+
+    Args:
+        data: Encoded image bytes
+        max_size: Largest side needed after encoding
+
+    Returns:
+        Image.Image: The (possibly already downscaled) image
+    """
+    image = Image.open(io.BytesIO(data))
+
+    if image.format == "JPEG":
+        image.draft("RGB", (max_size, max_size))
+
+    return image
+
+
+def _encode(image: Image.Image, quality: int, optimize: bool = False) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=optimize)
+    return buffer.getvalue()
+
+
+def _search_quality(image: Image.Image, max_bytes: int, lo: int, hi: int) -> bytes | None:
+    """
+    Binary-search the highest quality in [lo, hi] whose encode fits max_bytes.
+
+    Returns None when not even ``lo`` fits.
+    """
+    encoded = _encode(image, lo)
+    if len(encoded) > max_bytes:
+        return None
+    best = encoded
+
+    while hi - lo > QUALITY_STEP:
+        mid = (lo + hi) // 2
+        encoded = _encode(image, mid)
+
+        if len(encoded) <= max_bytes:
+            best = encoded
+            lo = mid
+        else:
+            hi = mid
+
+    return best
+
+
+def _estimate_quality(size: int, max_bytes: int) -> int:
+    """
+    Estimate the quality that brings a quality-90 encode of ``size`` bytes under max_bytes.
+
+    JPEG output roughly halves from quality 90 to 75 and again to about 50,
+    so every halving of the required ratio costs ~20 quality points.
+    """
+    overshoot = math.log2(size / max_bytes)
+    return int(MAX_QUALITY - 20 * overshoot)
+
+
+def encode_jpeg(image: Image.Image, max_bytes: int = MAX_BYTES, max_size: int = MAX_SIZE) -> bytes:
+    """
+    Encode an image as JPEG no larger than ``max_bytes``.
+
+    The first encode (quality 90, optimized) is returned directly when it
+    fits, which is the common case after resizing to ``max_size``. Otherwise
+    the quality is binary-searched, and if even the lowest quality is too
+    large the dimensions are scaled once by the estimated ratio instead of
+    shrinking 25% per pass.
+
+    Args:
+        image: The image to encode
+        max_bytes: Maximum size of the encoded JPEG
+        max_size: Maximum width and height
+
+    Returns:
+        bytes: The encoded JPEG
+    """
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    # reducing_gap lets Pillow shrink by an integer factor first, which is
+    # much cheaper than a full LANCZOS pass on the original resolution
+    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    encoded = _encode(image, MAX_QUALITY, optimize=True)
+    if len(encoded) <= max_bytes:
+        return encoded
+
+    # Search a narrow window around the estimate first, then the whole range
+    estimate = _estimate_quality(len(encoded), max_bytes)
+    lo = max(MIN_QUALITY, estimate - 10)
+    hi = min(MAX_QUALITY, estimate + 10)
+
+    best = _search_quality(image, max_bytes, lo, hi)
+    if best is None and lo > MIN_QUALITY:
+        best = _search_quality(image, max_bytes, MIN_QUALITY, lo)
+    if best is not None:
+        return best
+
+    # Even the lowest quality does not fit: bytes scale roughly with the pixel
+    # count, so one resize by the square root of the overshoot gets close
+    encoded = _encode(image, MIN_QUALITY)
+    size = len(encoded)
+
+    while size > max_bytes and min(image.size) > 64:
+        scale = math.sqrt(max_bytes / size) * 0.9
+        new_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+
+        encoded = _encode(image, MIN_QUALITY)
+        size = len(encoded)
+
+    logger.info("Image downscaled to %s to fit %s bytes", image.size, max_bytes)
+    return encoded
+
+
+def to_data_url(jpeg: bytes) -> str:
+    """Return a JPEG as a base64 data URL."""
+    return f"data:image/jpeg;base64,{base64.b64encode(jpeg).decode('utf-8')}"
@@ -0,0 +1,225 @@
+"""
+Page-streaming PDF rasterization.
+
+Renders one page at a time to temporary files at a tuned DPI, instead of
+materializing every page as an in-memory PIL image, and spreads the pages
+over a process pool with results yielded as they complete.
+"""
+
+import os
+import re
+import logging
+import tempfile
+import subprocess
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Iterator, Optional
+
+import pdf2image
+
+from wpp.media.image import encode_jpeg, open_image, to_data_url
+from wpp.workers import MediaWorkerPool, get_media_pool
+
+logger = logging.getLogger(__name__)
+
+
+# ~100 DPI renders an A4 page at about 830x1170 px, already close to the
+# 1024 px the encoder keeps, so no pixels are rendered just to be discarded
+PDF_DPI = int(os.getenv("PDF_DPI", "100"))
+PDF_GRAYSCALE = os.getenv("PDF_GRAYSCALE", "true").lower() in ("1", "true", "yes")
+
+# Pages handled per pdftotext call, and pages fed to the model per document
+PDF_TEXT_WINDOW = int(os.getenv("PDF_TEXT_WINDOW", "10"))
+PDF_MAX_RELEVANT_PAGES = int(os.getenv("PDF_MAX_RELEVANT_PAGES", "8"))
+
+# Pages with less extracted text than this are scans or nearly empty
+MIN_TEXT_CHARS = 30
+
+
+def get_page_count(pdf_path: str) -> int:
+    """Return the number of pages of a PDF file."""
+    return int(pdf2image.pdfinfo_from_path(pdf_path).get("Pages", 0))
+
+
+def render_page(pdf_path: str, page: int, dpi: int = PDF_DPI, grayscale: bool = PDF_GRAYSCALE) -> str:
+    """
+    Render a single PDF page and encode it as a JPEG data URL.
+
+    Runs in a worker process: the page is written by pdftoppm to a temporary
+    JPEG and decoded back with draft(), so only one page is ever in memory.
+
+    Args:
+        pdf_path: Path of the PDF file
+        page: 1-based page number
+        dpi: Rendering resolution
+        grayscale: Whether to render in grayscale
+
+    Returns:
+        str: The page as a base64 JPEG data URL
+    """
+    with tempfile.TemporaryDirectory(prefix="wpp-page-") as tmp:
+        paths = pdf2image.convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            first_page=page,
+            last_page=page,
+            grayscale=grayscale,
+            fmt="jpeg",
+            output_folder=tmp,
+            paths_only=True,
+        )
+
+        with open(paths[0], "rb") as f:
+            image = open_image(f.read())
+
+        return to_data_url(encode_jpeg(image))
+
+
+def iter_pdf_pages(
+    pdf_bytes: bytes,
+    pages: Optional[list[int]] = None,
+    dpi: int = PDF_DPI,
+    grayscale: bool = PDF_GRAYSCALE,
+    pool: Optional[MediaWorkerPool] = None,
+) -> Iterator[tuple[int, str]]:
+    """
+    Render PDF pages in a process pool, yielding them as they complete.
+
+    At most two pages per worker are in flight at any time, so memory stays
+    bounded regardless of the page count.
+
+    Args:
+        pdf_bytes: The PDF content
+        pages: 1-based page numbers to render. If None, renders every page
+        dpi: Rendering resolution
+        grayscale: Whether to render in grayscale
+        pool: Pool to run the pages on. Defaults to the app's media worker pool
+
+    Yields:
+        tuple[int, str]: The page number and the page as a JPEG data URL
+    """
+    pool = pool or get_media_pool()
+
+    with tempfile.NamedTemporaryFile(prefix="wpp-pdf-", suffix=".pdf") as pdf_file:
+        pdf_file.write(pdf_bytes)
+        pdf_file.flush()
+
+        if pages is None:
+            pages = list(range(1, get_page_count(pdf_file.name) + 1))
+
+        window = 2 * pool.max_workers
+        queue = list(reversed(pages))
+        in_flight = {}
+
+        while queue or in_flight:
+            while queue and len(in_flight) < window:
+                page = queue.pop()
+                future = pool.submit(render_page, pdf_file.name, page, dpi, grayscale)
+                in_flight[future] = page
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                page = in_flight.pop(future)
+                yield page, future.result()
+
+
+def iter_page_texts(pdf_path: str, window: int = PDF_TEXT_WINDOW) -> Iterator[tuple[int, str]]:
+    """
+    Extract the text layer of a PDF in windows of ``window`` pages.
+
+    Uses pdftotext (poppler-utils, already required by pdf2image), so only
+    one window of text is held at a time.
+
+    Args:
+        pdf_path: Path of the PDF file
+        window: Number of pages per pdftotext call
+
+    Yields:
+        tuple[int, str]: The page number and its text (empty for scanned pages)
+    """
+    total = get_page_count(pdf_path)
+
+    for first in range(1, total + 1, window):
+        last = min(total, first + window - 1)
+
+        result = subprocess.run(
+            ["pdftotext", "-layout", "-f", str(first), "-l", str(last), pdf_path, "-"],
+            capture_output=True,
+            timeout=60,
+        )
+        if result.returncode != 0:
+            logger.warning("pdftotext failed for pages %s-%s: %r", first, last, result.stderr[:200])
+            texts = [""] * (last - first + 1)
+        else:
+            # pdftotext ends every page with a form feed
+            texts = result.stdout.decode("utf-8", errors="ignore").split("\f")
+
+        for offset in range(last - first + 1):
+            yield first + offset, texts[offset] if offset < len(texts) else ""
+
+
+def extract_page_texts(pdf_bytes: bytes, window: int = PDF_TEXT_WINDOW) -> list[str]:
+    """Return the text of every page of a PDF (index 0 is page 1)."""
+    with tempfile.NamedTemporaryFile(prefix="wpp-pdf-", suffix=".pdf") as pdf_file:
+        pdf_file.write(pdf_bytes)
+        pdf_file.flush()
+
+        return [text for _, text in iter_page_texts(pdf_file.name, window)]
+
+
+def _tokens(text: str) -> set[str]:
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return {token for token in re.findall(r"\w{4,}", text)}
+
+
+def select_relevant_pages(
+    page_texts: list[str],
+    query: str = "",
+    max_pages: int = PDF_MAX_RELEVANT_PAGES,
+) -> list[int]:
+    """
+    Choose the pages worth sending to the model.
+
+    Pages are scored by text density and by how many words of ``query``
+    (usually the user's problem description) they contain. Documents without
+    a text layer (scans) cannot be scored, so their first pages are kept.
+
+    Args:
+        page_texts: Text of every page (index 0 is page 1)
+        query: Text describing what the model is looking for
+        max_pages: Maximum number of pages to return
+
+    Returns:
+        list[int]: Selected 1-based page numbers, in document order
+    """
+    total = len(page_texts)
+    if total <= max_pages:
+        return list(range(1, total + 1))
+
+    densities = [len(text.strip()) for text in page_texts]
+    if all(density < MIN_TEXT_CHARS for density in densities):
+        return list(range(1, max_pages + 1))
+
+    query_tokens = _tokens(query)
+    scores = []
+
+    for index, text in enumerate(page_texts):
+        if densities[index] < MIN_TEXT_CHARS:
+            # Scanned page inside a text document (signed form, photo): unknown relevance
+            score = 0.4
+        else:
+            score = min(densities[index] / 1500, 1.0)
+            if query_tokens:
+                score += 2 * len(query_tokens & _tokens(text)) / len(query_tokens)
+
+        # The first page usually identifies the policy (number, holder)
+        if index == 0:
+            score += 1
+
+        scores.append((score, index + 1))
+
+    # Highest score first, earlier pages first on ties
+    ranked = sorted(scores, key=lambda item: (-item[0], item[1]))
+    return sorted(page for _, page in ranked[:max_pages])
@@ -0,0 +1,124 @@
+"""
+Thumbnail-first media triage.
+
+Fetches the small thumbnail Z-API sends with every image and document to
+classify the attachment before the full-size asset is downloaded. Runs when
+a model turn first renders the attachment, never at ingestion.
+"""
+
+import io
+import os
+import logging
+from typing import Any, Iterable, Optional
+
+import requests
+from PIL import Image, ImageStat
+
+from wpp.media.cache import MediaCache
+
+logger = logging.getLogger(__name__)
+
+
+RELEVANT = "relevant"
+BLANK = "blank"
+DUPLICATE = "duplicate"
+CACHED = "cached"
+NOT_DOCUMENT = "not_document"
+
+
+class MediaTriage:
+    """
+    Classify an attachment from its thumbnail.
+
+    Verdicts:
+        CACHED: the full asset was already processed (known URL)
+        BLANK: the thumbnail is a flat image (black screen, empty page)
+        DUPLICATE: near-identical to an earlier attachment of the same conversation
+        NOT_DOCUMENT: a document upload that looks like a photo, not a page
+        RELEVANT: anything else; the full asset is processed when requested
+
+    Only CACHED identifies the content: a near-duplicate is still its own
+    file (two screenshots may differ only in their text) and is processed
+    as such.
+    """
+
+    def __init__(self, redis: Any) -> None:
+        """
+        Initialize the triage.
+
+        Args:
+            redis: Redis client instance
+        """
+        self.media_cache = MediaCache(redis)
+        self.max_thumbnail_bytes = int(os.getenv("THUMBNAIL_MAX_BYTES", str(512 * 1024)))
+        self.blank_stddev = float(os.getenv("TRIAGE_BLANK_STDDEV", "4"))
+        self.duplicate_distance = int(os.getenv("TRIAGE_DUPLICATE_DISTANCE", "4"))
+
+    def _fetch_thumbnail(self, url: str) -> Optional[Image.Image]:
+        try:
+            with requests.get(url, stream=True, timeout=(3, 5)) as response:
+                response.raise_for_status()
+                data = response.raw.read(self.max_thumbnail_bytes + 1, decode_content=True)
+
+            if len(data) > self.max_thumbnail_bytes:
+                return None
+
+            image = Image.open(io.BytesIO(data))
+            image.load()
+            return image
+        except Exception as e:
+            logger.warning("Could not fetch thumbnail: %s", e)
+            return None
+
+    @staticmethod
+    def _looks_like_page(image: Image.Image) -> bool:
+        """Pages and screenshots are mostly light background; photos are not."""
+        gray = image.convert("L")
+        histogram = gray.histogram()
+        light = sum(histogram[200:])
+        return light / max(1, sum(histogram)) >= 0.3
+
+    def triage(
+        self,
+        url: str,
+        thumbnail_url: str,
+        expect_document: bool = False,
+        known_phashes: Iterable[str] = (),
+    ) -> tuple[str, Optional[str], Optional[str]]:
+        """
+        Classify an attachment.
+
+        Args:
+            url: URL of the full-size asset
+            thumbnail_url: URL of its thumbnail
+            expect_document: Whether the upload should be a document page (PDF, scanned policy)
+            known_phashes: Perceptual hashes of the conversation's earlier attachments
+
+        Returns:
+            tuple[str, Optional[str], Optional[str]]: The verdict, the content
+            hash of the same URL already processed (CACHED only), and the
+            perceptual hash of the thumbnail
+        """
+        digest = self.media_cache.lookup_url(url)
+        if digest:
+            return CACHED, digest, None
+
+        if not thumbnail_url:
+            return RELEVANT, None, None
+
+        thumbnail = self._fetch_thumbnail(thumbnail_url)
+        if thumbnail is None:
+            return RELEVANT, None, None
+
+        stddev = ImageStat.Stat(thumbnail.convert("L")).stddev[0]
+        if stddev < self.blank_stddev:
+            return BLANK, None, None
+
+        phash = self.media_cache.perceptual_hash(thumbnail)
+        if any(self.media_cache.hamming(phash, known) <= self.duplicate_distance for known in known_phashes):
+            return DUPLICATE, None, phash
+
+        if expect_document and not self._looks_like_page(thumbnail):
+            return NOT_DOCUMENT, None, phash
+
+        return RELEVANT, None, phash
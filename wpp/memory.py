@@ -14,6 +14,19 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+# KEYS[1]: memory hash
+# ARGV: field, value, field, value, ...
+# Writes the fields only if the hash already exists, so a partial write
+# never creates a memory that lacks its other fields.
+HSET_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+
 class RedisManager:
     """
     Manager for Redis-based memory storage and retrieval.
@@ -21,17 +34,18 @@ class RedisManager:
     This class provides methods to store, retrieve, and manage data in Redis.
     """
 
-    def __init__(self, redis: Any, memory_id: str) -> None:
+    def __init__(self, redis: Any, memory_id: str, load: bool = True) -> None:
         """
         Initialize the Redis manager.
 
         Args:
             redis: Redis client instance
             memory_id: Unique identifier for this memory in Redis
+            load: Whether to read the memory now. Write-only managers skip the read
         """
         self.redis = redis
         self.id = memory_id
-        self.memory_dict = self.redis.hgetall(name=self.id)
+        self.memory_dict = self.redis.hgetall(name=self.id) if load else {}
 
     def get_memory_dict(self) -> dict:
         """
@@ -55,12 +69,17 @@ class RedisManager:
                     new_memory_dict[key] = value
             except Exception as e:
                 logger.warning(
-                    f"Erro para coletar a memória: {e}\n\n Não conseguimos acessar a chave {key}: {value}"
+                    "Erro para coletar a memória: %s\n\n Não conseguimos acessar a chave %s: %s",
+                    e, key, value,
                 )
         return new_memory_dict
 
     def set_memory_dict(
-        self, memory_dict: dict, expire_time: int | None = None
+        self,
+        memory_dict: dict,
+        expire_time: int | None = None,
+        pipeline: Any = None,
+        only_if_exists: bool = False,
     ) -> None:
         """
         Set memory dictionary with optional expiration.
@@ -68,11 +87,21 @@ class RedisManager:
         Args:
             memory_dict: Dictionary to store
             expire_time: Optional expiration time in seconds. If None, data persists indefinitely
+            pipeline: Optional Redis pipeline. The write is queued on it and
+                only happens when the caller executes the pipeline
+            only_if_exists: Only update a memory that already exists. Used
+                for writes of a subset of the fields
         """
+        client = pipeline if pipeline is not None else self.redis
+
         try:
             new_memory_dict = {}
 
             for k, v in memory_dict.items():
+                # Models kept in memory (e.g. SharedConversation) serialize themselves
+                if hasattr(v, "to_dict"):
+                    v = v.to_dict()
+
                 if isinstance(v, (list, dict)):
                     new_memory_dict[k] = json.dumps(v, default=self.convert_types)
                 else:
@@ -81,16 +110,21 @@ class RedisManager:
             # Add timestamp for tracking
             new_memory_dict["_last_updated"] = datetime.now().isoformat()
 
-            self.redis.hset(name=self.id, mapping=new_memory_dict)
+            if only_if_exists:
+                script = self.redis.register_script(HSET_IF_EXISTS_SCRIPT)
+                fields = [item for pair in new_memory_dict.items() for item in pair]
+                script(keys=[self.id], args=fields, client=client)
+            else:
+                client.hset(name=self.id, mapping=new_memory_dict)
 
             # Only set expiration if specified
             if expire_time is not None:
-                self.redis.expire(name=self.id, time=expire_time)
+                client.expire(name=self.id, time=expire_time)
 
             self.memory_dict = new_memory_dict
 
         except Exception as e:
-            logger.warning(f"Erro para atualizar a memória: {e}")
+            logger.warning("Erro para atualizar a memória: %s", e)
 
 
     def reset_memory_dict(self) -> None:
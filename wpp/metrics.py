@@ -0,0 +1,107 @@
+"""
+Lightweight Redis-backed metrics.
+
+Counters and latency summaries shared by every worker, so rates and
+timings can be read from Redis without an external metrics stack.
+"""
+
+import logging
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """
+    Counters, gauges and value summaries stored as Redis hashes.
+
+    Each metric lives in its own hash (``<namespace>:<name>``). Failures are
+    logged and swallowed: metrics must never break the request path.
+    """
+
+    def __init__(self, redis: Any, namespace: str = "metrics") -> None:
+        """
+        Initialize the metrics recorder.
+
+        Args:
+            redis: Redis client instance
+            namespace: Prefix for every metric key
+        """
+        self.redis = redis
+        self.namespace = namespace
+
+    def _key(self, name: str) -> str:
+        return f"{self.namespace}:{name}"
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        """
+        Increment a counter.
+
+        Args:
+            name: Metric name
+            amount: Value to add to the counter
+        """
+        try:
+            self.redis.hincrby(self._key(name), "count", amount)
+        except Exception as e:
+            logger.warning("Erro ao registrar métrica %s: %s", name, e)
+
+    def gauge(self, name: str, value: float) -> None:
+        """
+        Set the current value of a gauge.
+
+        Args:
+            name: Metric name
+            value: Current value
+        """
+        try:
+            self.redis.hset(self._key(name), "value", value)
+        except Exception as e:
+            logger.warning("Erro ao registrar métrica %s: %s", name, e)
+
+    def observe(self, name: str, value: float) -> None:
+        """
+        Record one observation (e.g. a latency in seconds) into a count/sum/max summary.
+
+        Args:
+            name: Metric name
+            value: Observed value
+        """
+        try:
+            key = self._key(name)
+            pipe = self.redis.pipeline()
+            pipe.hincrby(key, "count", 1)
+            pipe.hincrbyfloat(key, "sum", value)
+            pipe.hget(key, "max")
+            results = pipe.execute()
+
+            current_max = results[-1]
+            if current_max is None or float(current_max) < value:
+                self.redis.hset(key, "max", value)
+        except Exception as e:
+            logger.warning("Erro ao registrar métrica %s: %s", name, e)
+
+    def get(self, name: str) -> dict:
+        """
+        Read a metric.
+
+        Args:
+            name: Metric name
+
+        Returns:
+            dict: The stored fields converted to floats
+        """
+        try:
+            raw = self.redis.hgetall(self._key(name))
+        except Exception as e:
+            logger.warning("Erro ao ler métrica %s: %s", name, e)
+            return {}
+
+        values = {}
+        for k, v in raw.items():
+            key = k.decode("utf-8") if isinstance(k, bytes) else k
+            try:
+                values[key] = float(v)
+            except (TypeError, ValueError):
+                continue
+        return values
@@ -0,0 +1,517 @@
+"""
+Outbound delivery queue.
+
+Messages to WhatsApp are queued in Redis and delivered by a pool of sender
+workers, keeping FIFO order per destination number while different numbers
+are sent in parallel. Each logical message carries an idempotency key, so a
+retried turn never queues the same message twice.
+
+Delivery is at-least-once: a send that times out or gets a 5xx may still
+have reached WhatsApp, and it is retried, so the recipient can see that
+message twice. Z-API offers no idempotency key to dedupe such retries.
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from typing import Any, Optional
+
+import requests
+
+from wpp.api.wpp_message import WppMessage
+from wpp.metrics import Metrics
+from wpp.routing import ConversationRouter
+
+logger = logging.getLogger(__name__)
+
+
+# WppMessage methods that may be queued
+SEND_METHODS = {
+    "send_message",
+    "send_image",
+    "send_video",
+    "send_options_list",
+    "send_buttons_list",
+    "send_buttons_action",
+    "send_pix_button",
+}
+
+# Response types returned by the step handlers, mapped to WppMessage methods
+RESPONSE_METHODS = {
+    "message": "send_message",
+    "image": "send_image",
+    "button_list": "send_buttons_list",
+    "button_action": "send_buttons_action",
+}
+
+
+# KEYS[1]: idempotency marker, KEYS[2]: number queue, KEYS[3]: ready list, KEYS[4]: ready set
+# ARGV: entry, number, marker TTL
+# Returns 0 if the key was already queued, 1 otherwise. The marker, the entry
+# and the ready bookkeeping are written together, so a crash cannot leave a
+# marked key without its message or a queued number nobody will drain.
+ENQUEUE_SCRIPT = """
+if not redis.call('SET', KEYS[1], '1', 'NX', 'EX', ARGV[3]) then
+    return 0
+end
+
+redis.call('RPUSH', KEYS[2], ARGV[1])
+if redis.call('SADD', KEYS[4], ARGV[2]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[2])
+end
+return 1
+"""
+
+# KEYS[1]: ready list, KEYS[2]: ready set
+# ARGV: namespace
+# Puts back on the ready list the numbers of the ready set that no worker is
+# draining (its lock expired, e.g. the worker died mid-drain) and that are not
+# already waiting; numbers with an empty queue leave the set. Returns the
+# number of numbers requeued.
+REAP_SCRIPT = """
+local requeued = 0
+
+for _, number in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    if redis.call('EXISTS', ARGV[1] .. ':lock:' .. number) == 0 then
+        if redis.call('LLEN', ARGV[1] .. ':q:' .. number) == 0 then
+            redis.call('SREM', KEYS[2], number)
+        elseif not redis.call('LPOS', KEYS[1], number) then
+            redis.call('RPUSH', KEYS[1], number)
+            requeued = requeued + 1
+        end
+    end
+end
+return requeued
+"""
+
+
+# KEYS[1]: drain lock of a number
+# ARGV: worker token, TTL
+# Extends the lock only while the worker still holds it. Returns 1 if it does.
+REFRESH_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+def _decode(value: Any) -> Any:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class OutboundQueue:
+    """
+    Producer side of the outbound queue.
+
+    Keys:
+        <ns>:q:<number>      list of pending messages for one number (FIFO)
+        <ns>:ready           list of numbers with pending messages
+        <ns>:ready_set       set mirroring <ns>:ready, to avoid duplicates
+        <ns>:idem:<key>      marks an idempotency key as already queued
+        <ns>:result:<key>    delivery result of a message
+        <ns>:msg:<id>        Z-API message id of a sent message -> its key
+        <ns>:receipt:<key>   hash of receipt status -> timestamp
+    """
+
+    def __init__(self, redis: Any, namespace: str = "outbound") -> None:
+        """
+        Initialize the queue.
+
+        Args:
+            redis: Redis client instance
+            namespace: Prefix for the Redis keys
+        """
+        self.redis = redis
+        self.namespace = namespace
+        self.result_ttl = int(os.getenv("OUTBOUND_RESULT_TTL", "86400"))
+
+        self.enqueue_script = redis.register_script(ENQUEUE_SCRIPT)
+
+    def queue_key(self, number: str) -> str:
+        return f"{self.namespace}:q:{number}"
+
+    @property
+    def ready_key(self) -> str:
+        return f"{self.namespace}:ready"
+
+    @property
+    def ready_set_key(self) -> str:
+        return f"{self.namespace}:ready_set"
+
+    def result_key(self, key: str) -> str:
+        return f"{self.namespace}:result:{key}"
+
+    def enqueue(self, number: str, method: str, payload: dict, key: Optional[str] = None) -> str:
+        """
+        Queue a message for delivery.
+
+        Args:
+            number: Destination phone number
+            method: WppMessage method, e.g. "send_message"
+            payload: Keyword arguments for the method, without the number
+            key: Idempotency key of the logical message. Messages whose key was
+                already queued are skipped. Defaults to a random key
+
+        Returns:
+            str: The idempotency key
+        """
+        if method not in SEND_METHODS:
+            raise ValueError(f"Unsupported outbound method: {method}")
+
+        key = key or uuid.uuid4().hex
+
+        # A list of texts is several messages: queue them one by one to keep their order
+        if method == "send_message" and isinstance(payload.get("message"), list):
+            for index, text in enumerate(payload["message"]):
+                self.enqueue(number, method, {**payload, "message": text}, f"{key}:{index}")
+            return key
+
+        entry = {
+            "key": key,
+            "method": method,
+            "payload": payload,
+            "enqueued_at": time.time(),
+            "attempts": 0,
+        }
+
+        queued = self.enqueue_script(
+            keys=[f"{self.namespace}:idem:{key}", self.queue_key(number), self.ready_key, self.ready_set_key],
+            args=[json.dumps(entry, ensure_ascii=False), number, self.result_ttl],
+        )
+        if not int(queued):
+            logger.info("Outbound message %s already queued, skipping", key)
+
+        return key
+
+    def enqueue_response(self, number: str, response: dict, key: Optional[str] = None) -> Optional[str]:
+        """
+        Queue a step handler response ({"type": "message", "message": ...}).
+
+        Returns:
+            str: The idempotency key, or None if the response type is unknown
+        """
+        response = dict(response)
+        method = RESPONSE_METHODS.get(response.pop("type", ""))
+        response.pop("number", None)
+
+        if not method:
+            return None
+        return self.enqueue(number, method, response, key)
+
+    def message_key(self, message_id: str) -> str:
+        return f"{self.namespace}:msg:{message_id}"
+
+    def receipt_key(self, key: str) -> str:
+        return f"{self.namespace}:receipt:{key}"
+
+    def get_receipts(self, key: str) -> dict:
+        """Return the receipts of a message, status -> epoch seconds."""
+        return {
+            _decode(status): float(_decode(timestamp))
+            for status, timestamp in self.redis.hgetall(self.receipt_key(key)).items()
+        }
+
+    def get_result(self, key: str) -> Optional[dict]:
+        """Return the stored delivery result of a message, if it was processed."""
+        raw = self.redis.get(self.result_key(key))
+        return json.loads(_decode(raw)) if raw else None
+
+
+class OutboundSender:
+    """
+    Pool of sender threads draining the outbound queue.
+
+    A worker claims a number with a short-lived lock and sends its messages
+    in order; failures are retried with exponential backoff while holding
+    the number, so later messages never overtake an earlier one. A heartbeat
+    keeps the lock while the worker is alive, however long a send blocks, and
+    the worker checks it still holds the lock before removing a message. A
+    reaper thread requeues numbers left behind by a worker that died mid-drain,
+    and gives bot channels whose negotiation went silent to the next waiting
+    conversation.
+    """
+
+    def __init__(self, redis: Any, wpp: WppMessage, workers: Optional[int] = None) -> None:
+        """
+        Initialize the sender.
+
+        Args:
+            redis: Redis client instance
+            wpp: WppMessage used to call Z-API
+            workers: Number of sender threads. Defaults to OUTBOUND_WORKERS
+        """
+        self.queue = OutboundQueue(redis)
+        self.router = ConversationRouter(redis)
+        self.redis = redis
+        self.wpp = wpp
+        self.metrics = Metrics(redis)
+
+        self.workers = workers or int(os.getenv("OUTBOUND_WORKERS", "4"))
+        self.max_attempts = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+        self.backoff = float(os.getenv("OUTBOUND_BACKOFF", "1"))
+        # Refreshed every lock_ttl / 4 while draining, so it only runs out when
+        # the worker is gone. Kept above one send's worst case without waits
+        # on the buckets: ZAPI_MAX_COOLDOWN + connect + read timeout (30 + 5 + 20 s)
+        self.lock_ttl = int(os.getenv("OUTBOUND_LOCK_TTL", "120"))
+        self.reap_interval = float(os.getenv("OUTBOUND_REAP_INTERVAL", "30"))
+
+        self.reap_script = redis.register_script(REAP_SCRIPT)
+        self.refresh_script = redis.register_script(REFRESH_LOCK_SCRIPT)
+
+        self.threads: list[threading.Thread] = []
+        self.stopping = threading.Event()
+
+    def start(self) -> None:
+        """Start the sender threads."""
+        self.stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"outbound-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        reaper = threading.Thread(target=self._reap_loop, name="outbound-reaper", daemon=True)
+        reaper.start()
+        self.threads.append(reaper)
+
+        logger.info("Outbound sender started with %s workers", self.workers)
+
+    def stop(self) -> None:
+        """Ask the sender threads to stop and wait briefly for them."""
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.threads = []
+
+    def _run(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                item = self.redis.blpop(self.queue.ready_key, timeout=1)
+                if not item:
+                    continue
+
+                self._drain(_decode(item[1]))
+            except Exception as e:
+                logger.error("Outbound worker error: %s", e)
+                time.sleep(1)
+
+    def reap(self) -> int:
+        """
+        Requeue numbers with pending messages that no worker will drain.
+
+        Returns:
+            int: Number of numbers put back on the ready list
+        """
+        requeued = int(self.reap_script(
+            keys=[self.queue.ready_key, self.queue.ready_set_key],
+            args=[self.queue.namespace],
+        ))
+        if requeued:
+            logger.warning("Requeued %s outbound numbers left by a stopped worker", requeued)
+            self.metrics.incr("outbound.reaped", requeued)
+        return requeued
+
+    def _reap_loop(self) -> None:
+        while not self.stopping.wait(self.reap_interval):
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error("Outbound reaper error: %s", e)
+
+            try:
+                self.router.promote_expired(self.queue)
+            except Exception as e:
+                logger.error("Channel promotion error: %s", e)
+
+    def _holds_lock(self, lock_key: str, token: str) -> bool:
+        """Extend the drain lock if this worker still holds it."""
+        return bool(int(self.refresh_script(keys=[lock_key], args=[token, self.lock_ttl])))
+
+    def _keep_lock(self, lock_key: str, token: str, done: threading.Event) -> None:
+        while not done.wait(self.lock_ttl / 4):
+            try:
+                if not self._holds_lock(lock_key, token):
+                    return
+            except Exception as e:
+                logger.warning("Erro ao renovar o lock de envio %s: %s", lock_key, e)
+
+    def _drain(self, number: str) -> None:
+        lock_key = f"{self.queue.namespace}:lock:{number}"
+        token = uuid.uuid4().hex
+
+        if not self.redis.set(lock_key, token, nx=True, ex=self.lock_ttl):
+            # Another worker is draining this number and re-checks the queue when done
+            return
+
+        queue_key = self.queue.queue_key(number)
+
+        # Sends can block on the throttle and on Z-API for longer than the lock TTL
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._keep_lock, args=(lock_key, token, done), name=f"outbound-lock-{number}", daemon=True
+        )
+        heartbeat.start()
+
+        try:
+            while not self.stopping.is_set():
+                raw = self.redis.lindex(queue_key, 0)
+                if raw is None:
+                    break
+
+                entry = json.loads(_decode(raw))
+                delivered = self._deliver(number, entry)
+
+                # Never pop or rewrite the head of a queue another worker has taken over
+                if not self._holds_lock(lock_key, token):
+                    logger.error("Lost the drain lock of %s, leaving its queue to the new holder", number)
+                    self.metrics.incr("outbound.lock_lost")
+                    break
+
+                if delivered:
+                    self.redis.lpop(queue_key)
+                    continue
+
+                entry["attempts"] += 1
+                if entry["attempts"] >= self.max_attempts:
+                    logger.error("Giving up outbound message %s to %s", entry['key'], number)
+                    self.redis.lpop(queue_key)
+                    self._store_result(entry, "failed")
+                    continue
+
+                self.redis.lset(queue_key, 0, json.dumps(entry, ensure_ascii=False))
+                delay = self.backoff * 2 ** (entry["attempts"] - 1)
+                time.sleep(random.uniform(delay / 2, delay))
+        finally:
+            done.set()
+            heartbeat.join()
+
+            if _decode(self.redis.get(lock_key)) == token:
+                self.redis.delete(lock_key)
+
+            # Messages queued while draining would otherwise be stranded
+            self.redis.srem(self.queue.ready_set_key, number)
+            if self.redis.llen(queue_key) and self.redis.sadd(self.queue.ready_set_key, number):
+                self.redis.rpush(self.queue.ready_key, number)
+
+    def _deliver(self, number: str, entry: dict) -> bool:
+        """Send one message. Returns True when it is done (sent or permanently rejected)."""
+        send_function = getattr(self.wpp, entry["method"])
+
+        if not entry["attempts"]:
+            # Time spent queued before the first attempt, rate limiting included
+            self.metrics.observe("outbound.queue_lag", time.time() - entry["enqueued_at"])
+
+        try:
+            response = send_function(number=number, **entry["payload"])
+        except requests.RequestException as e:
+            logger.warning("Outbound message %s to %s failed: %s", entry['key'], number, e)
+            return False
+
+        status_code = getattr(response, "status_code", 0)
+
+        if status_code == 429 or status_code >= 500 or not status_code:
+            logger.warning("Outbound message %s to %s got HTTP %s, retrying", entry['key'], number, status_code)
+            return False
+
+        if status_code >= 400:
+            logger.error("Outbound message %s to %s rejected with HTTP %s", entry['key'], number, status_code)
+            self._store_result(entry, "rejected", response)
+            return True
+
+        self._store_result(entry, "sent", response)
+        self.metrics.observe("outbound.delivery_latency", time.time() - entry["enqueued_at"])
+        return True
+
+    def _store_result(self, entry: dict, status: str, response: Any = None) -> None:
+        result = {
+            "status": status,
+            "attempts": entry["attempts"] + (1 if status != "failed" else 0),
+            "status_code": getattr(response, "status_code", None),
+            "enqueued_at": entry["enqueued_at"],
+            "finished_at": time.time(),
+        }
+
+        try:
+            body = response.json() if response is not None else {}
+            result["message_id"] = body.get("messageId") or body.get("id")
+            result["zaap_id"] = body.get("zaapId")
+        except Exception:
+            pass
+
+        self.metrics.incr(f"outbound.{status}")
+
+        pipe = self.redis.pipeline()
+        pipe.setex(self.queue.result_key(entry["key"]), self.queue.result_ttl, json.dumps(result))
+
+        # Receipts only carry the WhatsApp message id: index it back to the logical message
+        index = json.dumps({"key": entry["key"], "enqueued_at": entry["enqueued_at"]})
+        for message_id in {result.get("message_id"), result.get("zaap_id")} - {None}:
+            pipe.setex(self.queue.message_key(message_id), self.queue.result_ttl, index)
+
+        pipe.execute()
+
+
+class DeliveryReceipts:
+    """
+    Records Z-API message status callbacks for outbound messages.
+
+    Each receipt (SENT, RECEIVED, READ, PLAYED) is kept once per message,
+    and its time since the message was queued is observed as the end-to-end
+    ``outbound.receipt.<status>`` latency.
+    """
+
+    def __init__(self, redis: Any, queue: Optional[OutboundQueue] = None) -> None:
+        """
+        Initialize the recorder.
+
+        Args:
+            redis: Redis client instance
+            queue: Queue whose messages are tracked. Defaults to the outbound queue
+        """
+        self.redis = redis
+        self.queue = queue or OutboundQueue(redis)
+        self.metrics = Metrics(redis)
+
+    def record(self, status: str, message_ids: list[str], momment: Optional[int] = None) -> int:
+        """
+        Record a receipt.
+
+        Args:
+            status: Receipt status, e.g. "READ"
+            message_ids: WhatsApp ids of the messages it refers to
+            momment: Time of the event in milliseconds. Defaults to now
+
+        Returns:
+            int: Number of outbound messages the receipt was recorded for
+        """
+        if not message_ids:
+            return 0
+
+        status = status.lower()
+        timestamp = momment / 1000 if momment else time.time()
+
+        indexes = self.redis.mget([self.queue.message_key(message_id) for message_id in message_ids])
+        messages = [json.loads(_decode(index)) for index in indexes if index]
+        if not messages:
+            # Messages not sent through the queue (or whose index expired)
+            self.metrics.incr("outbound.receipt.unknown")
+            return 0
+
+        pipe = self.redis.pipeline()
+        for message in messages:
+            receipt_key = self.queue.receipt_key(message["key"])
+            pipe.hsetnx(receipt_key, status, timestamp)
+            pipe.expire(receipt_key, self.queue.result_ttl)
+        created = pipe.execute()[::2]
+
+        # Z-API repeats receipts; only the first one of each status is measured
+        for message, first in zip(messages, created):
+            if first:
+                self.metrics.observe(f"outbound.receipt.{status}", max(0.0, timestamp - message["enqueued_at"]))
+
+        return len(messages)
@@ -0,0 +1,216 @@
+"""
+Content-addressed prompt store.
+
+Large, repeated blocks of model history (the step 2 system prompt, the
+conversation context) are stored once in Redis under their SHA-256 and
+replaced in memory by small references, which are resolved again when the
+history is read back.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+# Content part that stands for a stored text block
+REF_TYPE = "text_ref"
+
+
+class PromptNotFound(Exception):
+    """Referenced blocks could not be read back from the store."""
+
+    def __init__(self, digests: list[str], message: str = "") -> None:
+        super().__init__(message or f"Prompt blocks not found: {', '.join(digests)}")
+        self.digests = digests
+
+
+class PromptStore:
+    """
+    Store of text blocks keyed by their content hash.
+
+    Blocks never change once written, so every process keeps a small local
+    LRU of the blocks it has seen and only asks Redis for the others.
+
+    Histories keep referencing their blocks for as long as the conversation
+    memory lives, and memory does not expire, so neither do blocks unless
+    ``PROMPT_STORE_TTL`` is set. With a TTL, every read refreshes it.
+    """
+
+    _local: "OrderedDict[str, str]" = OrderedDict()
+    _local_lock = threading.Lock()
+
+    def __init__(self, redis: Any, namespace: str = "prompt_store") -> None:
+        """
+        Initialize the store.
+
+        Args:
+            redis: Redis client instance
+            namespace: Prefix for the Redis keys
+        """
+        self.redis = redis
+        self.namespace = namespace
+
+        # Blocks shorter than this stay inline
+        self.min_chars = int(os.getenv("PROMPT_STORE_MIN_CHARS", "1024"))
+        # 0 keeps blocks for as long as the memories that reference them
+        self.ttl = int(os.getenv("PROMPT_STORE_TTL", "0"))
+        self.local_entries = int(os.getenv("PROMPT_STORE_LOCAL_ENTRIES", "256"))
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _key(self, digest: str) -> str:
+        return f"{self.namespace}:{digest}"
+
+    def _remember(self, digest: str, text: str) -> None:
+        with self._local_lock:
+            self._local[digest] = text
+            self._local.move_to_end(digest)
+            while len(self._local) > self.local_entries:
+                self._local.popitem(last=False)
+
+    def _recall(self, digest: str) -> str | None:
+        with self._local_lock:
+            text = self._local.get(digest)
+            if text is not None:
+                self._local.move_to_end(digest)
+            return text
+
+    def dehydrate(self, messages: list) -> list:
+        """
+        Replace large text blocks of a chat history by references.
+
+        Handles both content layouts: a plain string and a list of
+        ``{"type": "text", "text": ...}`` parts. Other messages (tool calls,
+        images) are kept as they are.
+
+        Args:
+            messages: Chat history as sent to the model
+
+        Returns:
+            list: A new history with references to stored blocks
+        """
+        blocks = {}
+
+        def ref(text: str) -> dict:
+            digest = self.digest(text)
+            blocks[digest] = text
+            return {"type": REF_TYPE, "ref": digest}
+
+        result = []
+        for message in messages:
+            if not isinstance(message, dict):
+                result.append(message)
+                continue
+
+            content = message.get("content")
+
+            if isinstance(content, str) and len(content) >= self.min_chars:
+                message = {**message, "content": [ref(content)]}
+            elif isinstance(content, list):
+                parts = []
+                for part in content:
+                    if (
+                        isinstance(part, dict)
+                        and part.get("type") == "text"
+                        and len(part.get("text") or "") >= self.min_chars
+                    ):
+                        parts.append(ref(part["text"]))
+                    else:
+                        parts.append(part)
+                message = {**message, "content": parts}
+
+            result.append(message)
+
+        if blocks:
+            try:
+                # Written once, refreshed while the conversations using them stay active
+                pipe = self.redis.pipeline()
+                for digest, text in blocks.items():
+                    pipe.set(self._key(digest), text, nx=True)
+                    if self.ttl:
+                        pipe.expire(self._key(digest), self.ttl)
+                pipe.execute()
+            except Exception as e:
+                logger.warning("Erro ao gravar prompts no armazenamento: %s", e)
+                return messages
+
+            for digest, text in blocks.items():
+                self._remember(digest, text)
+
+        return result
+
+    def hydrate(self, messages: list) -> list:
+        """
+        Resolve the references of a dehydrated chat history.
+
+        Args:
+            messages: History as stored in memory
+
+        Returns:
+            list: The history with every reference replaced by its text
+
+        Raises:
+            PromptNotFound: A referenced block is gone or the store is unreachable
+        """
+        digests = {
+            part["ref"]
+            for message in messages
+            if isinstance(message, dict) and isinstance(message.get("content"), list)
+            for part in message["content"]
+            if isinstance(part, dict) and part.get("type") == REF_TYPE
+        }
+
+        if not digests:
+            return messages
+
+        texts = {digest: self._recall(digest) for digest in digests}
+        missing = [digest for digest, text in texts.items() if text is None]
+
+        if missing:
+            try:
+                values = self.redis.mget([self._key(digest) for digest in missing])
+                if self.ttl:
+                    pipe = self.redis.pipeline()
+                    for digest in missing:
+                        pipe.expire(self._key(digest), self.ttl)
+                    pipe.execute()
+            except Exception as e:
+                logger.warning("Erro ao ler prompts do armazenamento: %s", e)
+                raise PromptNotFound(missing, f"Prompt store unavailable: {e}") from e
+
+            lost = []
+            for digest, value in zip(missing, values):
+                if value is None:
+                    lost.append(digest)
+                    continue
+
+                value = value.decode("utf-8") if isinstance(value, bytes) else value
+                texts[digest] = value
+                self._remember(digest, value)
+
+            if lost:
+                logger.error("Prompts %s not found in the store", ", ".join(lost))
+                raise PromptNotFound(lost)
+
+        result = []
+        for message in messages:
+            if isinstance(message, dict) and isinstance(message.get("content"), list):
+                message = {
+                    **message,
+                    "content": [
+                        {"type": "text", "text": texts[part["ref"]]}
+                        if isinstance(part, dict) and part.get("type") == REF_TYPE
+                        else part
+                        for part in message["content"]
+                    ],
+                }
+            result.append(message)
+
+        return result
@@ -0,0 +1,296 @@
+"""
+Redis-backed token buckets.
+
+A token bucket shared by every worker, refilled continuously and updated
+atomically through a Lua script that uses the Redis server clock, and the
+adaptive send throttle built on it for Z-API.
+"""
+
+import os
+import time
+import logging
+from email.utils import parsedate_to_datetime
+from typing import Any, Optional
+
+from wpp.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS[1]: bucket hash
+# ARGV: capacity, refill rate (tokens/s), cost, reserve
+# Returns the seconds to wait before the cost can be paid ("0" when granted).
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = math.min(tonumber(ARGV[3]), capacity)
+-- A full bucket must always grant the cost, so the reserve cannot exceed what is left after it
+local reserve = math.max(0, math.min(tonumber(ARGV[4]), capacity - cost))
+
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens - reserve >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost + reserve - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+
+return tostring(wait)
+"""
+
+
+class RedisTokenBucket:
+    """
+    Token bucket stored in a Redis hash.
+
+    ``capacity`` tokens can be spent in a burst and the bucket refills at
+    ``rate`` tokens per second. A ``reserve`` can be kept for callers with
+    higher priority: the request is only granted if at least ``reserve``
+    tokens remain afterwards. A cost above the capacity is capped to it,
+    and the reserve to ``capacity - cost``, so every request is eventually
+    granted.
+    """
+
+    def __init__(self, redis: Any, key: str, capacity: float, rate: float) -> None:
+        """
+        Initialize the bucket.
+
+        Args:
+            redis: Redis client instance
+            key: Redis key of the bucket
+            capacity: Maximum number of tokens (burst size)
+            rate: Refill rate in tokens per second
+        """
+        self.redis = redis
+        self.key = key
+        self.capacity = capacity
+        self.rate = rate
+        self.script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, cost: float = 1, reserve: float = 0) -> float:
+        """
+        Try to take ``cost`` tokens from the bucket.
+
+        Args:
+            cost: Number of tokens to take
+            reserve: Tokens that must remain available after taking the cost,
+                capped to capacity - cost
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the seconds to wait before retrying
+        """
+        try:
+            wait = self.script(
+                keys=[self.key],
+                args=[self.capacity, self.rate, cost, reserve],
+            )
+        except Exception as e:
+            # Fail open: rate limiting must not take the service down with Redis
+            logger.warning("Erro no token bucket %s: %s", self.key, e)
+            return 0.0
+
+        wait = wait.decode("utf-8") if isinstance(wait, bytes) else wait
+        return float(wait)
+
+    def acquire(self, cost: float = 1, reserve: float = 0, timeout: float | None = None) -> bool:
+        """
+        Block until ``cost`` tokens are taken or ``timeout`` expires.
+
+        Args:
+            cost: Number of tokens to take
+            reserve: Tokens that must remain available after taking the cost
+            timeout: Maximum seconds to wait. If None, waits indefinitely
+
+        Returns:
+            bool: True if the tokens were taken
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            wait = self.try_acquire(cost, reserve)
+            if wait <= 0:
+                return True
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+
+            time.sleep(wait)
+
+
+def parse_retry_after(value: Optional[str], default: float) -> float:
+    """
+    Parse a Retry-After header (seconds or HTTP date).
+
+    Args:
+        value: Header value, if any
+        default: Seconds to use when the header is missing or invalid
+
+    Returns:
+        float: Seconds to wait
+    """
+    if not value:
+        return default
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class SendThrottle:
+    """
+    Outbound throttle for a Z-API instance.
+
+    Every send takes a token from the bucket of its destination number and
+    from the bucket of the instance, so bursts (a list of messages, a chatty
+    agent) are smoothed to a steady rate. A 429 halves the rate of every
+    bucket and pauses the instance for the Retry-After period; each
+    successful send raises the rate again a little (AIMD), so the limiter
+    settles just below what Z-API accepts.
+    """
+
+    def __init__(self, redis: Any, instance_id: str, namespace: str = "ratelimit:zapi") -> None:
+        """
+        Initialize the throttle.
+
+        Args:
+            redis: Redis client instance
+            instance_id: Z-API instance, the scope of the shared limits
+            namespace: Prefix for the Redis keys
+        """
+        self.redis = redis
+        self.metrics = Metrics(redis)
+        self.prefix = f"{namespace}:{instance_id}"
+
+        self.instance_rate = float(os.getenv("ZAPI_INSTANCE_RATE", "5"))
+        self.instance_burst = float(os.getenv("ZAPI_INSTANCE_BURST", "10"))
+        self.number_rate = float(os.getenv("ZAPI_NUMBER_RATE", "1"))
+        self.number_burst = float(os.getenv("ZAPI_NUMBER_BURST", "3"))
+
+        self.min_factor = float(os.getenv("ZAPI_MIN_RATE_FACTOR", "0.1"))
+        self.recovery = float(os.getenv("ZAPI_RATE_RECOVERY", "0.05"))
+        self.default_retry_after = float(os.getenv("ZAPI_RETRY_AFTER", "5"))
+        self.max_cooldown = float(os.getenv("ZAPI_MAX_COOLDOWN", "30"))
+
+        self.factor_key = f"{self.prefix}:factor"
+        self.cooldown_key = f"{self.prefix}:cooldown"
+
+        self.instance_bucket = RedisTokenBucket(
+            redis, f"{self.prefix}:bucket", self.instance_burst, self.instance_rate
+        )
+
+    def _state(self) -> tuple[float, float]:
+        """Return the current rate factor and the remaining cooldown in seconds."""
+        try:
+            pipe = self.redis.pipeline()
+            pipe.get(self.factor_key)
+            pipe.pttl(self.cooldown_key)
+            factor, cooldown_ms = pipe.execute()
+        except Exception as e:
+            logger.warning("Erro ao ler o estado do limitador de envio: %s", e)
+            return 1.0, 0.0
+
+        factor = float(factor) if factor else 1.0
+        return factor, max(0, cooldown_ms or 0) / 1000
+
+    def acquire(self, number: str) -> float:
+        """
+        Block until a message to ``number`` may be sent.
+
+        Args:
+            number: Destination phone number
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        start = time.monotonic()
+
+        factor, cooldown = self._state()
+        if cooldown > 0:
+            time.sleep(min(cooldown, self.max_cooldown))
+
+        number_bucket = RedisTokenBucket(
+            self.redis,
+            f"{self.prefix}:bucket:{number}",
+            self.number_burst,
+            self.number_rate * factor,
+        )
+        self.instance_bucket.rate = self.instance_rate * factor
+
+        # Number first: a token taken from the shared instance bucket while
+        # waiting on a single busy number would be wasted
+        number_bucket.acquire()
+        self.instance_bucket.acquire()
+
+        waited = time.monotonic() - start
+        self.metrics.observe("zapi.throttle_wait", waited)
+        return waited
+
+    def record(self, response: Any) -> None:
+        """
+        Adapt the rate to the outcome of a send.
+
+        Args:
+            response: The requests.Response returned by Z-API, or None if the request timed out
+        """
+        status_code = getattr(response, "status_code", 0)
+
+        try:
+            if response is None:
+                # A timed-out send: back off without pausing the instance
+                factor, _ = self._state()
+                factor = max(self.min_factor, factor / 2)
+                self.redis.set(self.factor_key, factor)
+
+                self.metrics.incr("zapi.timeout")
+                self.metrics.gauge("zapi.rate_factor", factor)
+
+            elif status_code == 429:
+                retry_after = parse_retry_after(
+                    response.headers.get("Retry-After"), self.default_retry_after
+                )
+                retry_after = min(retry_after, self.max_cooldown)
+
+                factor, _ = self._state()
+                factor = max(self.min_factor, factor / 2)
+
+                pipe = self.redis.pipeline()
+                pipe.set(self.factor_key, factor)
+                if retry_after > 0:
+                    pipe.set(self.cooldown_key, "1", px=int(retry_after * 1000))
+                pipe.execute()
+
+                logger.warning(
+                    "Z-API throttled the instance, pausing %.1fs at %.2fx rate",
+                    retry_after, factor,
+                )
+                self.metrics.incr("zapi.throttled")
+                self.metrics.gauge("zapi.rate_factor", factor)
+
+            elif 200 <= status_code < 300:
+                factor, _ = self._state()
+                if factor < 1:
+                    factor = min(1.0, factor + self.recovery)
+                    self.redis.set(self.factor_key, factor)
+                    self.metrics.gauge("zapi.rate_factor", factor)
+        except Exception as e:
+            logger.warning("Erro ao atualizar o limitador de envio: %s", e)
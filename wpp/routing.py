@@ -0,0 +1,319 @@
+"""
+Conversation routing index.
+
+Maps each delegated user conversation to its own bot-side session, so the
+Porto Seguro memory of one negotiation never overwrites another's. The
+customer-service bot sees a single WhatsApp chat per Z-API instance, so
+each (instance, bot phone) channel carries one live negotiation at a time;
+the others wait in a FIFO waitlist and take the channel when it is freed,
+either by hand_over or, when the holder went silent and the channel
+expired, by promote_expired.
+"""
+
+import os
+import uuid
+import logging
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+BOT_PHONE = os.getenv("PORTO_SEGURO_BOT_PHONE", "551130039303")
+
+# Channel states returned by ConversationRouter.open
+ACTIVE = "active"    # the conversation already held the channel
+CLAIMED = "claimed"  # the conversation just took the channel: send the handoff
+WAITING = "waiting"  # another conversation holds the channel
+
+
+# KEYS[1]: channel, KEYS[2]: waitlist, KEYS[3]: set of channels with a waitlist
+# ARGV: conversation id, channel TTL, channel name
+# Returns 1 if the conversation already held the channel, 2 if it just took
+# it, 0 if it was added to (or kept in) the waitlist. A free channel goes to
+# the head of the waitlist only, never to whoever writes first.
+CLAIM_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+
+if holder == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+
+if not holder then
+    local head = redis.call('LINDEX', KEYS[2], 0)
+    if not head or head == ARGV[1] then
+        redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+        redis.call('LREM', KEYS[2], 0, ARGV[1])
+        return 2
+    end
+end
+
+if not redis.call('LPOS', KEYS[2], ARGV[1]) then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+end
+redis.call('SADD', KEYS[3], ARGV[3])
+return 0
+"""
+
+# KEYS[1]: channel, KEYS[2]: waitlist
+# ARGV: conversation id, channel TTL
+# Frees the channel held by the conversation and hands it to the next in line.
+RELEASE_SCRIPT = """
+redis.call('LREM', KEYS[2], 0, ARGV[1])
+
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return false
+end
+
+local next_id = redis.call('LPOP', KEYS[2])
+if next_id then
+    redis.call('SET', KEYS[1], next_id, 'EX', ARGV[2])
+else
+    redis.call('DEL', KEYS[1])
+end
+return next_id
+"""
+
+# KEYS[1]: channel, KEYS[2]: waitlist, KEYS[3]: set of channels with a waitlist
+# ARGV: channel TTL, channel name
+# Gives an expired channel to the head of its waitlist.
+PROMOTE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return false
+end
+
+local next_id = redis.call('LPOP', KEYS[2])
+if redis.call('LLEN', KEYS[2]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[2])
+end
+if not next_id then
+    return false
+end
+
+redis.call('SET', KEYS[1], next_id, 'EX', ARGV[1])
+return next_id
+"""
+
+
+def _decode(value: Any) -> Any:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class ConversationRouter:
+    """
+    Routing index between user conversations and bot-side sessions.
+
+    Keys:
+        <ns>:user:<instance>:<phone>      conversation id of a user
+        <ns>:conv:<id>                    hash with user_phone, bot_phone, instance_id
+        <ns>:channel:<instance>:<bot>     conversation currently holding the channel
+        <ns>:waitlist:<instance>:<bot>    conversations waiting for the channel
+        <ns>:waiting                      channels (<instance>:<bot>) with a waitlist
+        bot_session:<id>                  bot-side memory of a conversation
+    """
+
+    def __init__(self, redis: Any, namespace: str = "routing") -> None:
+        """
+        Initialize the router.
+
+        Args:
+            redis: Redis client instance
+            namespace: Prefix for the index keys
+        """
+        self.redis = redis
+        self.namespace = namespace
+
+        # A channel with no traffic for this long is considered abandoned
+        self.session_ttl = int(os.getenv("ROUTING_SESSION_TTL", "1800"))
+
+        self.claim_script = redis.register_script(CLAIM_SCRIPT)
+        self.release_script = redis.register_script(RELEASE_SCRIPT)
+        self.promote_script = redis.register_script(PROMOTE_SCRIPT)
+
+    @staticmethod
+    def is_bot(phone: str) -> bool:
+        """Whether a phone number is the customer-service bot."""
+        return phone == BOT_PHONE
+
+    @staticmethod
+    def conversation_id(user_phone: str, instance_id: str) -> str:
+        return f"{instance_id}:{user_phone}"
+
+    @staticmethod
+    def session_key(conversation_id: str) -> str:
+        """Memory id of the bot side of a conversation."""
+        return f"bot_session:{conversation_id}"
+
+    def _channel_keys(self, instance_id: str, bot_phone: str) -> list[str]:
+        return [
+            f"{self.namespace}:channel:{instance_id}:{bot_phone}",
+            f"{self.namespace}:waitlist:{instance_id}:{bot_phone}",
+        ]
+
+    @property
+    def waiting_key(self) -> str:
+        return f"{self.namespace}:waiting"
+
+    def open(self, user_phone: str, instance_id: str, bot_phone: str = BOT_PHONE) -> tuple[str, str]:
+        """
+        Register a delegated conversation and try to take its bot channel.
+
+        Safe to call on every event of the conversation: it refreshes the
+        channel while it is held and retries the claim while waiting.
+
+        Args:
+            user_phone: Phone of the user being represented
+            instance_id: Z-API instance that talks to the bot
+            bot_phone: Customer-service bot phone
+
+        Returns:
+            tuple[str, str]: The conversation id and the channel state (ACTIVE, CLAIMED or WAITING)
+        """
+        conversation_id = self.conversation_id(user_phone, instance_id)
+
+        pipe = self.redis.pipeline()
+        pipe.set(f"{self.namespace}:user:{instance_id}:{user_phone}", conversation_id)
+        pipe.hset(
+            f"{self.namespace}:conv:{conversation_id}",
+            mapping={"user_phone": user_phone, "bot_phone": bot_phone, "instance_id": instance_id},
+        )
+        pipe.execute()
+
+        result = int(self.claim_script(
+            keys=self._channel_keys(instance_id, bot_phone) + [self.waiting_key],
+            args=[conversation_id, self.session_ttl, f"{instance_id}:{bot_phone}"],
+        ))
+
+        return conversation_id, {1: ACTIVE, 2: CLAIMED}.get(result, WAITING)
+
+    def resolve(self, instance_id: str, bot_phone: str = BOT_PHONE) -> Optional[dict]:
+        """
+        Find the conversation a bot message belongs to.
+
+        Args:
+            instance_id: Z-API instance that received the message
+            bot_phone: Customer-service bot phone
+
+        Returns:
+            dict: The conversation (id, user_phone, bot_phone, instance_id),
+            or None if no conversation holds the channel
+        """
+        channel_key, _ = self._channel_keys(instance_id, bot_phone)
+
+        conversation_id = _decode(self.redis.get(channel_key))
+        if not conversation_id:
+            return None
+
+        self.redis.expire(channel_key, self.session_ttl)
+
+        raw = self.redis.hgetall(f"{self.namespace}:conv:{conversation_id}")
+        conversation = {_decode(k): _decode(v) for k, v in raw.items()}
+        conversation["id"] = conversation_id
+        return conversation
+
+    def buffer_id(self, phone: str, instance_id: str) -> str:
+        """Id the message buffer groups an incoming message under."""
+        if self.is_bot(phone):
+            conversation = self.resolve(instance_id, phone)
+            if conversation:
+                return self.session_key(conversation["id"])
+        return phone
+
+    def release(self, conversation_id: str) -> Optional[str]:
+        """
+        Free the channel of a finished conversation.
+
+        Args:
+            conversation_id: Conversation to release
+
+        Returns:
+            str: Id of the waiting conversation that took the channel, if any.
+            Its handoff has not been sent yet.
+        """
+        raw = self.redis.hgetall(f"{self.namespace}:conv:{conversation_id}")
+        conversation = {_decode(k): _decode(v) for k, v in raw.items()}
+        if not conversation:
+            return None
+
+        next_id = self.release_script(
+            keys=self._channel_keys(conversation["instance_id"], conversation["bot_phone"]),
+            args=[conversation_id, self.session_ttl],
+        )
+        return _decode(next_id)
+
+    def hand_over(self, conversation_id: str, outbound: Any, key: str) -> Optional[str]:
+        """
+        Release the channel of a finished conversation and start the next one.
+
+        The waiting conversation that takes the channel gets its handoff sent
+        to the bot, whose reply runs its first bot-side turn, and its user is
+        told the negotiation is starting.
+
+        Args:
+            conversation_id: Conversation to release
+            outbound: OutboundQueue the handoff is sent through
+            key: Idempotency key prefix, stable across retries of the turn
+
+        Returns:
+            str: Id of the conversation that took the channel, if any
+        """
+        next_id = self.release(conversation_id)
+        if not next_id:
+            return None
+
+        self._start(next_id, outbound, key)
+        logger.info("Channel of %s handed over to %s", conversation_id, next_id)
+        return next_id
+
+    def promote_expired(self, outbound: Any) -> list[str]:
+        """
+        Start the next waiting conversation on channels whose holder went silent.
+
+        A channel expires after session_ttl without traffic, and nobody is
+        told: without this the waitlist would only move on hand_over.
+
+        Args:
+            outbound: OutboundQueue the handoffs are sent through
+
+        Returns:
+            list[str]: Ids of the conversations that took a channel
+        """
+        promoted = []
+        for channel in self.redis.smembers(self.waiting_key):
+            channel = _decode(channel)
+            instance_id, bot_phone = channel.rsplit(":", 1)
+
+            next_id = _decode(self.promote_script(
+                keys=self._channel_keys(instance_id, bot_phone) + [self.waiting_key],
+                args=[self.session_ttl, channel],
+            ))
+            if not next_id:
+                continue
+
+            self._start(next_id, outbound, f"promote:{uuid.uuid4().hex}")
+            logger.info("Expired channel %s given to %s", channel, next_id)
+            promoted.append(next_id)
+
+        return promoted
+
+    def _start(self, next_id: str, outbound: Any, key: str) -> None:
+        """Send the handoff of a conversation that just took its channel."""
+        raw = self.redis.hgetall(f"{self.namespace}:conv:{next_id}")
+        conversation = {_decode(k): _decode(v) for k, v in raw.items()}
+        if not conversation:
+            # The channel expires on its own after session_ttl without traffic
+            logger.warning("Conversation %s took the channel but has no routing entry", next_id)
+            return
+
+        outbound.enqueue(
+            conversation["bot_phone"],
+            "send_message",
+            {"message": "Oi Porto!"},
+            key=f"{key}:handoff:{next_id}",
+        )
+        outbound.enqueue(
+            conversation["user_phone"],
+            "send_message",
+            {"message": "Chegou a sua vez! Estamos iniciando o seu atendimento com a Porto Seguro."},
+            key=f"{key}:turn:{next_id}",
+        )
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Discriminator, PrivateAttr, Tag, TypeAdapter
+from typing import Annotated, Any, Optional, List, Union
 
 
 class Text(BaseModel):
@@ -193,6 +193,26 @@ class Interactive(BaseModel):
         extra = "allow"
 
 
+# Content fields checked after text, in priority order; each field name is also its message type
+PAYLOAD_TYPE_FIELDS = (
+    "image",
+    "audio",
+    "video",
+    "document",
+    "location",
+    "contact",
+    "sticker",
+    "reaction",
+    "payment",
+    "order",
+    "listResponseMessage",
+    "buttonsResponseMessage",
+    "buttonReply",
+    "interactive",
+    "listMessage",
+)
+
+
 class WppPayload(BaseModel):
     isStatusReply: bool
     chatLid: Optional[str] = None
@@ -235,40 +255,141 @@ class WppPayload(BaseModel):
     interactive: Optional[Interactive] = None
     # New field for list messages (different from interactive lists)  
     listMessage: Optional[ListMessage] = None
+    # Set on notification events (e.g. REVOKE)
+    notification: Optional[str] = None
+
+    _payload_type: Optional[str] = PrivateAttr(default=None)
 
-    
     def get_payload_type(self) -> str:
+        # Resolved once per payload
+        if self._payload_type is None:
+            self._payload_type = self._resolve_payload_type()
+        return self._payload_type
+
+    def with_text(self, message: str) -> "WppPayload":
+        """A copy of this payload carrying ``message`` as its text, without validating it again."""
+        payload = self.model_copy(update={"text": Text(message=message)})
+        payload._payload_type = None
+        return payload
+
+    def _resolve_payload_type(self) -> str:
         if self.text and self.text.message:
             return "text"
-        elif self.image:
-            return "image"
-        elif self.audio:
-            return "audio"
-        elif self.video:
-            return "video"
-        elif self.document:
-            return "document"
-        elif self.location:
-            return "location"
-        elif self.contact:
-            return "contact"
-        elif self.sticker:
-            return "sticker"
-        elif self.reaction:
-            return "reaction"
-        elif self.payment:
-            return "payment"
-        elif self.order:
-            return "order"
-        elif self.listResponseMessage:
-            return "listResponseMessage"
-        elif self.buttonsResponseMessage:
-            return "buttonsResponseMessage"
-        elif self.buttonReply:
-            return "buttonReply"
-        elif self.interactive:
-            return "interactive"
-        elif self.listMessage:
-            return "listMessage"
-        else:
-            return "unknown"
\ No newline at end of file
+
+        for field in PAYLOAD_TYPE_FIELDS:
+            if getattr(self, field) is not None:
+                return field
+
+        return "unknown"
+
+
+# Built once: validating through it skips the per-call schema lookup
+PAYLOAD_ADAPTER = TypeAdapter(WppPayload)
+
+
+def parse_payload(raw: bytes | str) -> WppPayload:
+    """Validate a webhook body straight from the request bytes."""
+    return PAYLOAD_ADAPTER.validate_json(raw)
+
+
+class MessageStatusCallback(BaseModel):
+    """Delivery or read receipt of messages sent by the instance."""
+    type: Optional[str] = None
+    status: str
+    ids: list[str] = []
+    momment: Optional[int] = None
+    phone: Optional[str] = None
+    instanceId: Optional[str] = None
+    isGroup: bool = False
+
+
+class PresenceCallback(BaseModel):
+    """Chat presence (online, typing, ...) of a contact."""
+    type: Optional[str] = None
+    phone: Optional[str] = None
+    status: Optional[str] = None
+    lastSeen: Optional[int] = None
+    instanceId: Optional[str] = None
+
+
+class DeliveryCallback(BaseModel):
+    """Confirmation that a message sent through the API reached WhatsApp."""
+    type: Optional[str] = None
+    phone: Optional[str] = None
+    zaapId: Optional[str] = None
+    messageId: Optional[str] = None
+    error: Optional[str] = None
+    momment: Optional[int] = None
+    instanceId: Optional[str] = None
+
+
+class OtherCallback(BaseModel):
+    """Instance events (connected, disconnected, ...) and anything unknown."""
+    type: Optional[str] = None
+    instanceId: Optional[str] = None
+
+
+# Z-API callback "type" values, mapped to the kind of event
+CALLBACK_KINDS = {
+    "ReceivedCallback": "message",
+    "MessageStatusCallback": "status",
+    "PresenceChatCallback": "presence",
+    "DeliveryCallback": "delivery",
+    "ConnectedCallback": "other",
+    "DisconnectedCallback": "other",
+}
+
+
+def callback_kind(value: Any) -> str:
+    """
+    Classify a callback by a few top-level keys, before validating it.
+
+    Args:
+        value: The parsed body (or an already validated model)
+
+    Returns:
+        str: "message", "status", "presence", "delivery" or "other"
+    """
+    if isinstance(value, BaseModel):
+        value = value.__dict__
+    if not isinstance(value, dict):
+        return "other"
+
+    kind = CALLBACK_KINDS.get(value.get("type"))
+    if kind:
+        return kind
+
+    # Older payloads without a known "type"
+    if "ids" in value:
+        return "status"
+    if "lastSeen" in value:
+        return "presence"
+    if "senderName" in value:
+        return "message"
+    if "zaapId" in value:
+        return "delivery"
+    return "other"
+
+
+Callback = Annotated[
+    Union[
+        Annotated[WppPayload, Tag("message")],
+        Annotated[MessageStatusCallback, Tag("status")],
+        Annotated[PresenceCallback, Tag("presence")],
+        Annotated[DeliveryCallback, Tag("delivery")],
+        Annotated[OtherCallback, Tag("other")],
+    ],
+    Discriminator(callback_kind),
+]
+
+CALLBACK_ADAPTER = TypeAdapter(Callback)
+
+
+def parse_callback(raw: bytes | str) -> BaseModel:
+    """
+    Validate any webhook body from the request bytes.
+
+    Only the model of the callback's kind is validated, so receipts and
+    presence events never go through the message schema.
+    """
+    return CALLBACK_ADAPTER.validate_json(raw)
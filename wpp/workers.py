@@ -0,0 +1,186 @@
+"""
+Managed process pool for CPU-bound media work.
+
+PDF rendering, JPEG encoding and base64 conversion hold the GIL; running
+them here keeps the event loop free to acknowledge webhooks while a large
+document is processed.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Callable, Optional
+
+from wpp.metrics import Metrics
+from wpp.logging_config import configure_worker_logging
+
+logger = logging.getLogger(__name__)
+
+
+# forkserver where the platform has it (Linux), spawn otherwise
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def _timed_call(fn: Callable[..., Any], args: tuple, kwargs: dict) -> tuple[Any, float, float]:
+    """Run ``fn`` in the worker and report when it started and how long it took."""
+    started = time.time()
+    result = fn(*args, **kwargs)
+    return result, started, time.time() - started
+
+
+def _shared_call(fn: Callable[..., Any], name: str, size: int, args: tuple, kwargs: dict) -> Any:
+    """Attach to a shared memory block and pass its contents to ``fn`` without pickling them."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        view = block.buf[:size]
+        try:
+            return fn(view, *args, **kwargs)
+        finally:
+            view.release()
+    finally:
+        block.close()
+
+
+class MediaWorkerPool:
+    """
+    ProcessPoolExecutor with queue and execution latency reporting.
+
+    Created once per worker process in the FastAPI lifespan (see app.py) and
+    shared by every media transform.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, redis: Any = None) -> None:
+        """
+        Initialize the pool.
+
+        Args:
+            max_workers: Number of worker processes. Defaults to MEDIA_WORKERS or CPU count - 1
+            redis: Redis client used to report metrics (optional)
+        """
+        default_workers = max(1, (os.cpu_count() or 2) - 1)
+        self.max_workers = max_workers or int(os.getenv("MEDIA_WORKERS", str(default_workers)))
+        self.metrics = Metrics(redis) if redis is not None else None
+
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start the worker processes."""
+        if self.executor is None:
+            # Forking this process would copy its threads' locks (sender, reaper,
+            # log listener) in whatever state they are; workers start clean instead
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context(START_METHOD),
+                initializer=configure_worker_logging,
+            )
+            logger.info("Media worker pool started with %s processes", self.max_workers)
+
+    def shutdown(self) -> None:
+        """Stop the worker processes, cancelling queued work."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            logger.info("Media worker pool stopped")
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        """
+        Queue ``fn(*args, **kwargs)`` on a worker process.
+
+        Args:
+            fn: Picklable top-level function
+            args: Positional arguments for fn
+            kwargs: Keyword arguments for fn
+
+        Returns:
+            Future: Resolves to the result of fn
+        """
+        if self.executor is None:
+            self.start()
+
+        submitted = time.time()
+        inner = self.executor.submit(_timed_call, fn, args, kwargs)
+        outer: Future = Future()
+
+        with self.lock:
+            self.pending += 1
+            depth = self.pending
+        if self.metrics:
+            self.metrics.gauge("media_pool.queue_depth", depth)
+
+        def _done(future: Future) -> None:
+            with self.lock:
+                self.pending -= 1
+
+            try:
+                result, started, duration = future.result()
+            except BaseException as e:
+                outer.set_exception(e)
+                return
+
+            if self.metrics:
+                self.metrics.observe("media_pool.queue_wait", max(0.0, started - submitted))
+                self.metrics.observe("media_pool.exec", duration)
+            outer.set_result(result)
+
+        inner.add_done_callback(_done)
+        return outer
+
+    def submit_bytes(self, fn: Callable[..., Any], data: bytes, *args: Any, **kwargs: Any) -> Future:
+        """
+        Queue ``fn(buffer, *args, **kwargs)`` with ``data`` passed through shared memory.
+
+        The bytes are copied once into a shared memory block instead of being
+        pickled through the pool's pipe; ``fn`` receives a memoryview of it.
+        The block is released when the call completes.
+        """
+        block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        block.buf[:len(data)] = data
+
+        future = self.submit(_shared_call, fn, block.name, len(data), args, kwargs)
+
+        def _release(_: Future) -> None:
+            block.close()
+            block.unlink()
+
+        future.add_done_callback(_release)
+        return future
+
+    def run(self, fn: Callable[..., Any], *args: Any, timeout: Optional[float] = None, **kwargs: Any) -> Any:
+        """Run ``fn`` on the pool and wait for its result."""
+        return self.submit(fn, *args, **kwargs).result(timeout=timeout)
+
+    async def run_async(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run ``fn`` on the pool without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+
+_pool: Optional[MediaWorkerPool] = None
+
+
+def start_media_pool(redis: Any = None) -> MediaWorkerPool:
+    """Create and start the process-wide media pool (called from the app lifespan)."""
+    global _pool
+    if _pool is None:
+        _pool = MediaWorkerPool(redis=redis)
+    _pool.start()
+    return _pool
+
+
+def get_media_pool() -> MediaWorkerPool:
+    """Return the process-wide media pool, starting it lazily outside the app (scripts, shells)."""
+    return _pool or start_media_pool()
+
+
+def shutdown_media_pool() -> None:
+    """Stop the process-wide media pool."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None